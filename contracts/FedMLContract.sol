@@ -376,6 +376,32 @@ contract FedMLContract {
     ///@param workPart2 The sencond half of the hashed CID of the work
     ///@param votes The votes given to the works of the previous round
     function commit(uint _taskId, bytes32 workPart1, bytes32 workPart2, uint[] calldata votes) activeContract validTask(_taskId) external {
+        //the votes are copied to memory once, into the commit record, as before commitPacked existed
+        Commit memory work;
+        work.committer = msg.sender;
+        work.votes = votes;
+        _commit(_taskId, workPart1, workPart2, work);
+    }
+
+    ///@notice Same as commit, with the votes packed as big-endian uint16 (2 bytes of calldata per vote instead of 32)
+    ///@param _taskId The numerical identifier of the task
+    ///@param workPart1 The first half of the CID of the work (the digest, in the compact form)
+    ///@param workPart2 The second half of the CID of the work (the CID prefix, zero for a CIDv0, in the compact form)
+    ///@param packedVotes The votes given to the works of the previous round, 2 bytes each
+    function commitPacked(uint _taskId, bytes32 workPart1, bytes32 workPart2, bytes calldata packedVotes) activeContract validTask(_taskId) external {
+        require(packedVotes.length % 2 == 0, "Malformed votes!");
+        uint[] memory votes = new uint[](packedVotes.length / 2);
+        for (uint i = 0; i < votes.length; i++) {
+            votes[i] = uint(uint8(packedVotes[2 * i])) << 8 | uint(uint8(packedVotes[2 * i + 1]));
+        }
+        Commit memory work;
+        work.committer = msg.sender;
+        work.votes = votes;
+        _commit(_taskId, workPart1, workPart2, work);
+    }
+
+    function _commit(uint _taskId, bytes32 workPart1, bytes32 workPart2, Commit memory work) internal {
+        uint[] memory votes = work.votes; //a reference, not a copy
 
         Task storage task = taskList[_taskId];
         TaskMetadata storage taskMetadata = task.metadata;
@@ -397,10 +423,6 @@ contract FedMLContract {
             }
         }
 
-        Commit memory work;
-        work.committer = msg.sender;
-        work.votes = votes;
-
         //if the current round is the last round
         if (currentRound == taskMetadata.numberOfRounds-1) {
             taskMetadata.rounds[currentRound].committedWorks.push(work);
@@ -1,97 +1,296 @@
-import os
-from web3 import Web3
-import json
 import asyncio
+import argparse
+import functools
+import chain
 import ml_utils
+import training
+import running_mean
+import model_codec
+import keys
+import checkpoint
+from events import EventDispatcher
+from transactions import TxSubmitter
+from reads import BatchReader
+import ipfs_cache
+import ipfs_stub
+from metrics import metrics
 import requests
 import ipfshttpclient
-from utils import encode_CID_to_2_bytes_32, decode_2_bytes_32_to_CID
+from web3.exceptions import ContractLogicError
+from utils import encode_CID_to_2_bytes_32, encode_CID, pack_votes, decode_round_work
 
-ipfsclient = ipfshttpclient.connect()
+ipfsclient = None  # connected in main, pool processes of the training backend import this module too
 
-# Get contract abi
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
-data = json.load(f)
-abi = data['abi']
-f.close()
-
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-smartContract = w3.eth.contract(address=contract_address, abi=abi)
+w3 = chain.get_async_w3()
+smartContract = chain.get_async_contract(w3)
 
 device = ml_utils.getDevice()
 
 taskId = 0
+STATE_STARTED = 1
+STATE_COMPLETED = 2
+SENT_TIMEOUT = 30  # seconds given to a transaction sent before a restart to be mined, before sending it again
+
+class WorkerOptions:
+    # How the workers of a process train, score and commit (the async_workers.py options of the same names)
+    def __init__(self, aggregation='best', encoding='fp32', speedups='', pipelined=False, payload='legacy', scoring='exhaustive'):
+        self.aggregation = aggregation
+        self.encoding = encoding
+        self.speedups = speedups
+        self.pipelined = pipelined
+        self.payload = payload
+        self.scoring = scoring
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(aggregation=args.aggregation, encoding=args.encoding, speedups=args.speedups, pipelined=args.pipelined,
+                   payload=args.payload, scoring=args.scoring)
+
 
 class worker:
-    def __init__(self, address, contract, dataset):
+    def __init__(self, address, contract, dataset, shard=0, backend=None, dispatcher=None, txs=None, reader=None, taskId=taskId,
+                 options=None, checkpoint=None):
+        options = options or WorkerOptions()
         self.address = address
         self.contract = contract
+        self.taskId = taskId
+        self.dispatcher = dispatcher
+        # subscribed here rather than in simulate: main releases the held events once every worker exists
+        self.round_started = dispatcher.subscribe('RoundStarted', taskId)
+        self.txs = txs
+        self.reader = reader or BatchReader(contract, dispatcher=dispatcher)
+        self.shard = shard
+        self.aggregation = options.aggregation  # starting model of a round: the best one of the previous round, or an aggregate
+        self.encoding = options.encoding  # wire format of the uploaded models (model_codec)
+        self.speedups = options.speedups  # fast paths of the training loop (ml_utils.SPEEDUPS)
+        self.pipelined = options.pipelined  # score the previous round's models as their commits land, before being selected
+        self.scores = {}  # CID -> accuracy on the local test set, filled by prefetch
+        self.best_scored = None  # (CID, state dict) of the most accurate model in scores, the training starts from it
+        self.scoring = options.scoring  # exhaustive, or adaptive: clearly worse candidates are dropped after a subset of the test set
+        self.payload = options.payload  # commit encoding: legacy (base64 CID, uint[] votes) or compact (binary CID, uint16 votes)
+        self.checkpoint = checkpoint  # durable state (checkpoint.WorkerCheckpoint), None: nothing survives the process
+        self.resumed = False  # our round had started before this process, the chain may already have our transactions
+        # training, evaluation and the (blocking) IPFS client run in the backend, so that the event loop keeps serving the other workers
+        self.backend = backend or training.InProcessBackend(device, ipfsclient)
         self.selected = False
         self.round = 0
+        self.numberOfRounds = None
         self.traindata = dataset[0]
         self.testdata = dataset[1]
+        self.testset = None  # collated on first use, the process backend never needs it here
+        self.best_candidate = None
 
     async def simulate(self):
-        entrance_fee = self.contract.functions.getEntranceFee(taskId).call()
-        tx_hash = self.contract.functions.register(taskId).transact({'from':self.address, 'value':entrance_fee})
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+        # subscribed before registering: the last registration may trigger the first round right away
+        round_started = self.round_started
+        if self.checkpoint is not None:
+            self.checkpoint.load()
+        # after a restart the chain tells whether we registered already and whether our round has started
+        task = await self.reader.call('getTask', self.taskId)
+        if self.address in task[8]:
+            print(f'{self.address[:10]} already registered, resuming')
+            receipt = True
+        else:
+            with metrics.span('register', worker=self.address[:10]):
+                receipt = await self.txs.transact(self.contract.functions.register(self.taskId), {'from':self.address, 'value':task[3]})
         if receipt:
+            if self.checkpoint is not None:
+                self.checkpoint.update(registered=True)
             print(f'{self.address[:10]} registered to the task!')
             print(f'{self.address[:10]} listening for events...')
 
-            round_start_event_filter = self.contract.events['RoundStarted'].create_filter(fromBlock='latest')
-            numberOfRounds = self.contract.functions.getNumberOfRounds(taskId).call()
+            self.numberOfRounds = task[1]
+            prefetch = asyncio.create_task(self.prefetch()) if self.pipelined else None
+            position = await self.position()
 
             while not self.selected:
-
-                for event in round_start_event_filter.get_new_entries():
+                if position is not None:
+                    # our round started while this process was down: there is no RoundStarted left to wait for
+                    event = None
+                    round, commits = position
+                    self.selected = self.resumed = True
+                    print(f"{self.address[:10]} resuming round {round}")
+                    metrics.inc('rounds_resumed', worker=self.address[:10])
+                else:
+                    with metrics.span('wait_round_event', worker=self.address[:10]):
+                        event = await round_started.get()
                     round = event.args["roundNumber"]
-                    self.selected = self.contract.functions.isWorkerSelected(taskId,self.address,round).call({'from':self.address})
-                    if self.selected:
-                        self.round = round
-                        print(f"Worker at address {self.address[:10]} was selected for round {self.round}")
-                        if (round + 1 == numberOfRounds):
-                            await self.handle_last_round_start_event(event)
+                    metrics.record('event', 'RoundStarted', worker=self.address[:10], round=round, block=event['blockNumber'])
+                    # selection and previous work in the same batch, shared with the other workers of the process
+                    reads = [self.reader.call('isWorkerSelected', self.taskId, self.address, round, sender=self.address)]
+                    if round != 0:
+                        reads.append(self.reader.call('getRoundWork', self.taskId, round - 1))
+                    with metrics.span('round_reads', worker=self.address[:10], round=round):
+                        self.selected, *commits = await asyncio.gather(*reads)
+                    commits = commits[0] if commits else []
+                if self.selected:
+                    self.dispatcher.unsubscribe(round_started)
+                    self.round = round
+                    if prefetch is not None:
+                        # the round before ours is complete, the scoring of its last commits is about to end
+                        with metrics.span('prefetch_wait', worker=self.address[:10], round=round):
+                            await asyncio.gather(prefetch, return_exceptions=True)
+                    print(f"Worker at address {self.address[:10]} was selected for round {self.round}")
+                    metrics.inc('rounds_selected', worker=self.address[:10])
+                    with metrics.span('round', worker=self.address[:10], round=round):
+                        if (round + 1 == self.numberOfRounds):
+                            await self.handle_last_round_start_event(event, commits)
                         else:
-                            self.handle_round_start_event(event)
-                await asyncio.sleep(1)
+                            await self.handle_round_start_event(event, commits)
 
         print(f"Task ended, worker {self.address[:10]} exiting...")
-        
+
+    async def position(self):
+        # (our round, commits of the round before it) when that round has already started, None otherwise
+        task = await self.reader.call('getTask', self.taskId)
+        if task[6] not in (STATE_STARTED, STATE_COMPLETED):
+            return None
+        round = list(task[8]).index(self.address) // task[2]
+        rounds = task[9]
+        if round >= len(rounds):
+            return None
+        return round, (rounds[round - 1][1] if round else [])
+
+    async def committed(self):
+        # our commit of the current round is on chain: mined before the restart, or by a transaction we were waiting for
+        commits = await self.reader.call('getRoundWork', self.taskId, self.round)
+        return any(commit[0] == self.address for commit in commits), len(commits)
+
+    async def trained(self, previous_work, lastRound=False):
+        # a model trained before the restart is committed as it is, without training it again
+        done = self.checkpoint.trained(self.round) if self.checkpoint is not None else None
+        if done is not None:
+            print(f"{self.address[:10]} reusing the work of round {self.round} trained before the restart")
+            metrics.inc('trainings_skipped', worker=self.address[:10])
+            return done
+        with metrics.span('backend_train', worker=self.address[:10], round=self.round):
+            work, votes = await self.backend.train(self, previous_work, lastRound) #plug model training here. the work variable should contain the model CID
+        if self.checkpoint is not None:
+            self.checkpoint.update(round=self.round, trained=True, work=work, votes=votes, commit=None, commit_tx=None)
+        return work, votes
+
+    async def send(self, fn, step):
+        # step: 'commit' or 'score', stored as sent with its hash as soon as the node accepts it, then as mined
+        if self.checkpoint is None:
+            return await self.txs.submit(fn, {"from":self.address})
+
+        def sent(tx_hash):
+            self.checkpoint.update(**{step: 'sent', f'{step}_tx': '0x' + tx_hash.hex()})
+
+        def mined(future):
+            if not future.cancelled() and future.exception() is None and future.result()['status'] == 1:
+                self.checkpoint.update(**{step: 'mined'})
+
+        future = await self.txs.submit(fn, {"from":self.address}, on_sent=sent)
+        future.add_done_callback(mined)
+        return future
+
+    async def sent_before(self, step):
+        # a transaction sent before the restart: waited for if the node still has it, sent again if it was lost or reverted
+        if self.checkpoint is None or self.checkpoint.get(step) != 'sent':
+            return False
+        try:
+            receipt = await self.txs.w3.eth.wait_for_transaction_receipt(self.checkpoint.get(f'{step}_tx'), timeout=SENT_TIMEOUT)
+        except Exception:
+            return False
+        if receipt['status'] != 1:
+            return False
+        self.checkpoint.update(**{step: 'mined'})
+        return True
+
+
+    async def prefetch(self):
+        # pipelined mode: once the workers are shuffled our round is known, the commits of the round before it are read
+        # at every block and their models are fetched and scored in the background, while that round is still open
+        blocks = self.dispatcher.subscribe_blocks()
+        labels = {'worker': self.address[:10]}
+        myRound = None
+        wait = False  # the first pass reads right away: after a restart the round before ours may be complete already,
+        # and on an idle node no new block comes until our own commit
+        try:
+            while True:
+                if wait:
+                    await blocks.get()
+                    while not blocks.empty():
+                        blocks.get_nowait()
+                wait = True
+                if myRound is None:
+                    task = await self.reader.call('getTask', self.taskId)
+                    if task[6] not in (STATE_STARTED, STATE_COMPLETED):
+                        continue
+                    myRound = list(task[8]).index(self.address) // task[2]
+                    if myRound == 0:
+                        return
+                try:
+                    commits = await self.reader.call('getRoundWork', self.taskId, myRound - 1)
+                except ContractLogicError:
+                    continue  # that round has not started yet
+                hashes, _ = decode_round_work(commits)
+                missing = [hash for hash in hashes if hash not in self.scores]
+                if missing:
+                    accuracies, best = await self.backend.score(self, missing)
+                    self.scores.update(zip(missing, accuracies))
+                    if self.best_scored is None or self.scores[best[0]] > self.scores[self.best_scored[0]]:
+                        self.best_scored = best
+                    metrics.inc('prefetched_models', len(missing), **labels)
+                if len(commits) == task[2]:
+                    return
+        except Exception as e:
+            # the missing scores are computed when the round starts, as without pipelining
+            print(f"{self.address[:10]} prefetch stopped: {e}")
+        finally:
+            self.dispatcher.unsubscribe(blocks)
 
     #Handlers for SC events  
-    def handle_round_start_event(self, event):
+    async def handle_round_start_event(self, event, commits):
+        if self.resumed and ((await self.committed())[0] or await self.sent_before('commit')):
+            print(f"{self.address[:10]} already committed in round {self.round}")
+            return
         previous_work = []
         if self.round != 0:
-            commits = self.contract.functions.getRoundWork(taskId, self.round-1).call({'from':self.address})
-            previous_work = [decode_2_bytes_32_to_CID(commit[1],commit[2]) for commit in commits]
+            previous_work, _ = decode_round_work(commits)
             print(f"Previous work: {previous_work}")
         print(f"Round {self.round}:{self.address[:10]} start training...")
-        work, votes = self.train(previous_work, device, ipfsclient) #plug model training here. the work variable should contain the model CID
+        work, votes = await self.trained(previous_work)
         print(f"Votes: {votes}")
         print(f"{self.address[:10]} submitting work...\n")
-        part1, part2 = encode_CID_to_2_bytes_32(work)
-        tx_hash = self.contract.functions.commit(taskId, part1, part2, votes).transact({"from":self.address})
-        w3.eth.wait_for_transaction_receipt(tx_hash)
+        # the receipt is confirmed by the submitter's watcher, nothing else depends on it here
+        with metrics.span('commit_submit', worker=self.address[:10], round=self.round):
+            await self.send(self.commit_call(work, votes), 'commit')
     
-    async def handle_last_round_start_event(self, event):
-        commits = self.contract.functions.getRoundWork(taskId, self.round-1).call()
-        previous_work = [decode_2_bytes_32_to_CID(commit[1],commit[2]) for commit in commits]
-        votes = self.train(previous_work, device, ipfsclient)
-        tx_hash = self.contract.functions.commit(taskId, commits[0][1], commits[0][2], votes).transact({"from":self.address})
-        w3.eth.wait_for_transaction_receipt(tx_hash)
-
-        commit_ended_event = self.contract.events['LastRoundCommittmentEnded'].create_filter(fromBlock='latest')
-        done = False
-        while not done:
-            for event in commit_ended_event.get_new_entries():
-                done = True
-                print(f"Worker {self.address[:10]} computing last round score...")
-                tx_hash = self.contract.functions.computeLastRoundScore(taskId).transact({"from":self.address})
-                w3.eth.wait_for_transaction_receipt(tx_hash)
-            await asyncio.sleep(1)
+    async def handle_last_round_start_event(self, event, commits):
+        labels = {'worker': self.address[:10], 'round': self.round}
+        # listen before committing, our commit may be the one that ends the last round
+        commit_ended = self.dispatcher.subscribe('LastRoundCommittmentEnded', self.taskId)
+        committed, count = await self.committed() if self.resumed else (False, 0)
+        if not committed and not await self.sent_before('commit'):
+            previous_work, _ = decode_round_work(commits)
+            _, votes = await self.trained(previous_work, lastRound=True)
+            with metrics.span('commit_submit', **labels):
+                receipt = await (await self.send(self.commit_call(None, votes, commits[0][1:3]), 'commit'))
+            # a reverted last commit would leave us waiting for LastRoundCommittmentEnded forever
+            if receipt['status'] != 1:
+                raise RuntimeError(f"{self.address[:10]} last round commit {receipt['transactionHash'].hex()} reverted")
+
+        if count < len(commits):  # the last round has as many commits as the round before it
+            with metrics.span('wait_commitment_end', **labels):
+                await commit_ended.get()
+        self.dispatcher.unsubscribe(commit_ended)
+        if self.resumed and (await self.reader.call('hasLRScore', self.taskId, self.address) or await self.sent_before('score')):
+            print(f"{self.address[:10]} already computed its last round score")
+            return
+        print(f"Worker {self.address[:10]} computing last round score...")
+        with metrics.span('score_submit', **labels):
+            await self.send(self.contract.functions.computeLastRoundScore(self.taskId), 'score')
+
 
+    def commit_call(self, work, votes, parts=None):
+        # parts: the CID already encoded on chain (the last round commits the first work of the round)
+        if self.payload == 'compact':
+            part1, part2 = parts or encode_CID(work)
+            return self.contract.functions.commitPacked(self.taskId, part1, part2, pack_votes(votes))
+        part1, part2 = parts or encode_CID_to_2_bytes_32(work)
+        return self.contract.functions.commit(self.taskId, part1, part2, votes)
 
     def handle_end_event(self, event):
         print("Task ended, exiting...")
@@ -101,88 +300,81 @@ class worker:
         word = response.content.decode('utf-8')
         return word
     
-    def train(self, previousRoundHashes, device, ipfsclient):
-        votes = [0 for _ in previousRoundHashes]
-        if self.round == 0:
-            model = ml_utils.cnn().to(device)
-        else:
-            #receive models' CIDs from the SC
-            #download models from IPFS
-            model = ml_utils.cnn().to(device)
-            #evaluate all the models and select the best one
-            best_accuracy = 0
-            for i,hash in enumerate(previousRoundHashes):
-                state_dict = ml_utils.torch.load(ml_utils.downloadFromIPFS(ipfsclient, hash))
-                model.load_state_dict(state_dict)
-                model.eval()
-                correct = 0
-                total = 0
-                for data, target in self.testdata:
-                    data, target = data.to(device), target.to(device)
-                    output = model(data)
-                    _, predicted = ml_utils.torch.max(output.data, 1)
-                    total += target.size(0)
-                    correct += (predicted == target).sum().item()
-                accuracy = 100 * correct / total
-                votes[i] = int(accuracy * 10)
-                
-                if accuracy > best_accuracy:
-                    best_state_dict = state_dict
-            print("Check if worker is in the last round")
-            if self.round + 1 == self.contract.functions.getNumberOfRounds(taskId).call() : #worker of the last round
-                return votes
-                        
-            model.load_state_dict(best_state_dict)
-        
-        weightsPath = f'rounds/round{self.round}/cnn{self.address[:10]}.params'
-        accuracyPath = f'rounds/round{self.round}/accuracy{self.address[:10]}.json'
-
-        # Define loss function and optimizer (assuming you want to do this as well)
-        criterion = ml_utils.nn.CrossEntropyLoss()
-        optimizer = ml_utils.torch.optim.Adam(model.parameters(), lr = ml_utils.LEARNING_RATE)
-
-        model.train()
-        #print(f"Worker {worker_id} started. \n")
-        accuracy = []
-        for epoch in range(ml_utils.EPOCHS):  # number of epochs
-            correct = 0
-            total = 0
-            for data, target in self.traindata:
-                data, target = data.to(device), target.to(device)
-                optimizer.zero_grad()
-                output = model(data)
-                loss = criterion(output, target)
-                loss.backward()
-                optimizer.step() 
-
-                _, predicted = ml_utils.torch.max(output.data, 1)
-                total += target.size(0)
-                correct += (predicted == target).sum().item()
-            
-            epoch_accuracy = 100 * correct / total
-            accuracy.append(epoch_accuracy)
-        
-        if not os.path.exists(f'rounds/round{self.round}'):
-            os.makedirs(f'rounds/round{self.round}')
-
-        # Save accuracy to a JSON file
-        with open(accuracyPath, 'w') as f:
-            json.dump(accuracy, f)
-
-        ml_utils.torch.save(model.state_dict(), weightsPath)
-        response = ml_utils.saveToIPFS(ipfsclient, weightsPath)
-        hashFile = response['Hash']
+    def train(self, previousRoundHashes, device, ipfsclient, lastRound=False):
+        if self.testset is None:
+            with metrics.span('collate_testset', worker=self.address[:10]):
+                self.testset = ml_utils.collateDataLoader(self.testdata)
+        hashFile, votes, self.best_candidate = training.train_round(self.round, self.address, previousRoundHashes,
+                                                                    self.traindata, self.testset, device, ipfsclient, lastRound, self.aggregation, self.encoding, self.speedups,
+                                                                    self.scores, self.scoring, self.best_scored)
         return hashFile, votes
+
+    def score(self, hashes, device, ipfsclient):
+        if self.testset is None:
+            with metrics.span('collate_testset', worker=self.address[:10]):
+                self.testset = ml_utils.collateDataLoader(self.testdata)
+        return training.score_models(hashes, self.testset, device, ipfsclient, 'inference' in ml_utils.parseSpeedups(self.speedups),
+                                     {'worker': self.address[:10]})
     
-async def main():
+async def collect_rounds(dispatcher, started, limit):
+    # the local copies of the uploaded models are trimmed to the size limit whenever a round starts, except the
+    # directory of that round, which its workers are about to write
+    current = None
+    try:
+        while True:
+            removed = checkpoint.gc_rounds(limit, current=current)
+            if removed:
+                print(f"Removed the artifacts of rounds {removed} to keep rounds/ under {limit / 2**20:.0f}MiB")
+            current = (await started.get()).args['roundNumber']
+    finally:
+        dispatcher.unsubscribe(started)
+
+def get_loaders(datasetName, workersRequired):
+    if datasetName == 'tensor':
+        return ml_utils.getTensorLoaders(workersRequired)
+    if datasetName == 'synthetic':
+        return ml_utils.getSyntheticLoaders(workersRequired)
+    return ml_utils.getDataLoaders(workersRequired)
+
+async def main(backendName='thread', processes=None, threadsPerProcess=None, datasetName='tensor', task=taskId, options=None, threads=None,
+               localKeys=False, keySeed=keys.DEFAULT_SEED, signerPool='thread', signerWorkers=None, checkpoints=True, roundsLimit=checkpoint.ROUNDS_LIMIT, ipfsRoot=None):
+    global ipfsclient
+    # ipfsRoot: models stored in a directory instead of the IPFS daemon (benchmarks)
+    ipfs_factory = functools.partial(ipfs_stub.connect, ipfsRoot) if ipfsRoot else ipfshttpclient.connect
+    ipfsclient = ipfs_factory()
+    if threads:
+        # intra-op threads of the training running in this process (the process backend has --threads-per-process)
+        ml_utils.torch.set_num_threads(threads)
 
-    task = smartContract.functions.getTask(taskId).call()
-    workersRequired = task[1]*task[2]
-    dataLoader = ml_utils.getDataLoaders(workersRequired)
+    # a single log poller and a single batched reader for all the workers of the process; the events (and the backlog
+    # since the stored cursor) are held until the workers have subscribed, the blocks keep driving the submitter
+    dispatcher = await EventDispatcher(w3, smartContract).start(hold=True)
+    reader = BatchReader(smartContract, dispatcher=dispatcher)
+    metadata = await reader.call('getTask', task)
+    workersRequired = metadata[1]*metadata[2]
+    dataLoader = await asyncio.get_running_loop().run_in_executor(None, get_loaders, datasetName, workersRequired)
+    backend = training.make_backend(backendName, dataLoader, device, ipfsclient, processes, threadsPerProcess, ipfs_factory)
 
-    w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-    accounts = w3.eth.accounts
-    workers = [worker(address, smartContract, dataLoader[i]) for i,address in enumerate(accounts[:workersRequired])]
+    accounts = await chain.get_accounts_async(w3)
+    signer = None
+    if localKeys:
+        # as many workers as the task needs, whatever the number of node accounts: derived keys, signed here
+        local = keys.derive_keys(workersRequired, keySeed)
+        signer = keys.Signer(local, signerPool, signerWorkers)
+        txs = TxSubmitter(w3, dispatcher, signer=signer)
+        addresses = [account.address for account in local]
+        # funded by a node account that neither the oracles (first and last) nor the admin use
+        funded = await keys.fund_accounts(w3, txs, accounts[1], addresses, metadata[3] + keys.GAS_ALLOWANCE)
+        print(f"{funded} of {len(addresses)} local worker accounts funded")
+    else:
+        txs = TxSubmitter(w3, dispatcher)
+        addresses = accounts[:workersRequired]
+    # with checkpoints, a restarted process resumes every worker from its file and the chain instead of starting over
+    workers = [worker(address, smartContract, dataLoader[i], shard=i, backend=backend, dispatcher=dispatcher, txs=txs, reader=reader, taskId=task,
+                      options=options, checkpoint=checkpoint.WorkerCheckpoint(smartContract.address, task, address) if checkpoints else None)
+               for i,address in enumerate(addresses)]
+    collector = asyncio.create_task(collect_rounds(dispatcher, dispatcher.subscribe('RoundStarted', task), roundsLimit))
+    dispatcher.release()
     print(f"Activating {len(workers)} workers...")
     try:
         result = await asyncio.gather(*[w.simulate() for w in workers], return_exceptions=True)
@@ -193,6 +385,66 @@ async def main():
                 print(f"Worker {i} completed successfully with result: {result}")
     except Exception as e:
         print(e.args)
+    finally:
+        collector.cancel()
+        await txs.drain()
+        await txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+        backend.shutdown()
+        if signer is not None:
+            signer.shutdown()
+    print(f"IPFS cache: {ipfs_cache.cache.summary()}")
+    print(f"Transactions: {txs.summary()}")
+    if signer is not None:
+        print(f"Signatures: {signer.summary()}")
+    print(f"Reads: {reader.stats}")
+    metrics.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Simulate the workers of a FedML task')
+    parser.add_argument('--backend', choices=['thread', 'process'], default='thread',
+                        help='where local training runs: the event loop thread pool or a pool of processes')
+    parser.add_argument('--processes', type=int, default=None, help='size of the process pool (default: number of cores)')
+    parser.add_argument('--threads-per-process', type=int, default=None, help='torch intra-op threads of each pool process')
+    parser.add_argument('--dataset', choices=['tensor', 'torchvision', 'synthetic'], default='tensor',
+                        help='tensor: normalized once and cached under data/, torchvision: the original per-sample transforms, '
+                             'synthetic: MNIST-shaped random data, no download')
+    parser.add_argument('--task', type=int, default=taskId)
+    parser.add_argument('--aggregation', default='best',
+                        help='starting model of a round: best (the most accurate previous model), mean, weighted (by accuracy) '
+                             'or trimmed[:k] (coordinate-wise mean without the k largest and smallest values)')
+    parser.add_argument('--encoding', choices=model_codec.ENCODINGS, default='fp32',
+                        help='wire format of the uploaded models: fp32, fp16 or int8, optionally as a delta from the starting model')
+    parser.add_argument('--speedups', default='none',
+                        help=f"fast paths of the local training: none, fast ({ml_utils.FAST}) or a comma separated list of {', '.join(ml_utils.SPEEDUPS)}")
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads of the thread backend')
+    parser.add_argument('--pipelined', action='store_true',
+                        help="fetch and score the previous round's models as they are committed, before the round starts")
+    parser.add_argument('--local-keys', action='store_true',
+                        help='derive the worker keys locally (no limit on the number of workers), fund them and sign their transactions here')
+    parser.add_argument('--key-seed', default=keys.DEFAULT_SEED, help='seed of the derived worker keys')
+    parser.add_argument('--signer', choices=['thread', 'process'], default='thread', help='pool signing the transactions of the local keys')
+    parser.add_argument('--signer-workers', type=int, default=None)
+    parser.add_argument('--payload', choices=['legacy', 'compact'], default='legacy',
+                        help='commit encoding: legacy (base64 CID, 32 bytes per vote) or compact (binary CID, 2 bytes per vote, commitPacked)')
+    parser.add_argument('--scoring', default='exhaustive',
+                        help='scoring of the previous models: exhaustive (whole test set) or adaptive[:delta] (models clearly worse '
+                             'than the best are dropped on a growing random subset of the test set, delta: error probability, default 0.05)')
+    parser.add_argument('--checkpoint', action=argparse.BooleanOptionalAction, default=True,
+                        help=f'keep the state of every worker under {checkpoint.STATE_DIR}, so that a restarted process resumes the task '
+                             'without training or sending anything twice')
+    parser.add_argument('--rounds-limit', type=float, default=checkpoint.ROUNDS_LIMIT / 2**20,
+                        help='MiB of local model copies kept under rounds/, the least recently written rounds are removed first')
+    parser.add_argument('--ipfs-root', default=None,
+                        help='store the models in this directory instead of the local IPFS daemon (stub shared with the benchmarks)')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    ml_utils.parseSpeedups(args.speedups)  # fail before connecting anything
+    ml_utils.parseScoring(args.scoring)
+    running_mean.parse_aggregation(args.aggregation)
+    metrics.configure(args)
+    asyncio.run(main(backendName=args.backend, processes=args.processes, threadsPerProcess=args.threads_per_process, datasetName=args.dataset,
+                     task=args.task, options=WorkerOptions.from_args(args), threads=args.threads, localKeys=args.local_keys, keySeed=args.key_seed,
+                     signerPool=args.signer, signerWorkers=args.signer_workers, checkpoints=args.checkpoint, roundsLimit=int(args.rounds_limit * 2**20),
+                     ipfsRoot=args.ipfs_root))
\ No newline at end of file
@@ -0,0 +1,1040 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import asyncio
+import argparse
+import tempfile
+import functools
+import threading
+import ml_utils
+import training
+import ipfs_stub
+import ipfs_cache
+import chain
+import running_mean
+import number_oracle
+import time_oracle
+import model_codec
+import keys
+import indexer
+import checkpoint
+from utils import encode_CID_to_2_bytes_32, encode_CID, pack_votes
+from events import EventDispatcher
+from reads import BatchReader
+from transactions import TxSubmitter
+
+# Benchmarks of the worker pipeline, run from the repository root:
+#   python ./scripts/python/benchmark.py <benchmark> [options]
+
+
+class BenchWorker:
+    # The parts of async_workers.worker that the training backends rely on, without any chain connection
+    def __init__(self, index, dataset, aggregation='best', encoding='fp32', speedups='', scoring='exhaustive'):
+        self.address = f'0x{index:040x}'
+        self.round = 0
+        self.shard = index
+        self.aggregation = aggregation
+        self.encoding = encoding
+        self.speedups = speedups
+        self.scoring = scoring
+        self.traindata = dataset[0]
+        self.testdata = dataset[1]
+        self.testset = None
+        self.best_candidate = None
+        self.scores = {}
+        self.best_scored = None
+
+    def train(self, previousRoundHashes, device, ipfsclient, lastRound=False):
+        if self.testset is None:
+            self.testset = ml_utils.collateDataLoader(self.testdata)
+        hashFile, votes, self.best_candidate = training.train_round(self.round, self.address, previousRoundHashes,
+                                                                    self.traindata, self.testset, device, ipfsclient, lastRound, self.aggregation, self.encoding, self.speedups,
+                                                                    self.scores, self.scoring)
+        return hashFile, votes
+
+
+async def run_round(backend, workers):
+    start = time.perf_counter()
+    await asyncio.gather(*[backend.train(w, []) for w in workers])
+    return time.perf_counter() - start
+
+
+def get_loaders(name, workers):
+    if name == 'tensor':
+        return ml_utils.getTensorLoaders(workers)
+    if name == 'synthetic':
+        return ml_utils.getSyntheticLoaders(workers)
+    return ml_utils.getDataLoaders(workers)
+
+
+def shard_size(loader):
+    return len(loader.indices) if isinstance(loader, ml_utils.tensorBatches) else len(loader.dataset)
+
+
+def bench_backends(args):
+    datasets = get_loaders(args.dataset, args.workers)
+    samples = sum(shard_size(train) for train, _ in datasets) * ml_utils.EPOCHS
+    device = ml_utils.getDevice()
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # round artifacts are written under ./rounds
+        try:
+            for name in args.backends:
+                start = time.perf_counter()
+                if name == 'thread':
+                    backend = training.InProcessBackend(device, ipfs_stub.connect())
+                else:
+                    backend = training.ProcessPoolBackend(datasets, args.processes, args.threads_per_process, ipfs_stub.connect)
+                workers = [BenchWorker(i, dataset, speedups=args.speedups) for i, dataset in enumerate(datasets)]
+                try:
+                    elapsed = asyncio.run(run_round(backend, workers))
+                finally:
+                    backend.shutdown()
+                total = time.perf_counter() - start
+                results[name] = elapsed
+                print(f"{name:>8}: {args.workers} workers trained in {elapsed:.2f}s "
+                      f"({args.workers / elapsed:.2f} workers/s, {samples / elapsed:.0f} samples/s, {total:.2f}s including startup)")
+        finally:
+            os.chdir(cwd)
+    if 'thread' in results and 'process' in results:
+        print(f"speedup of the process pool: {results['thread'] / results['process']:.2f}x")
+
+
+def bench_dataset(args):
+    for name in args.datasets:
+        cached = os.path.exists(os.path.join('data', 'MNIST', 'normalized_images.npy'))
+        start = time.perf_counter()
+        datasets = get_loaders(name, args.workers)
+        startup = time.perf_counter() - start
+
+        samples = 0
+        start = time.perf_counter()
+        for train, _ in datasets:
+            for data, target in train:
+                samples += target.size(0)
+        epoch = time.perf_counter() - start
+        note = ' (decoded and cached the dataset)' if name == 'tensor' and not cached else ''
+        print(f"{name:>11}: startup {startup:.2f}s{note}, one epoch over {args.workers} shards {epoch:.2f}s ({samples / epoch:.0f} samples/s)")
+
+
+async def run_transactions(args):
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = (await chain.get_accounts_async(w3))[:args.senders]
+    txs = TxSubmitter(w3, poll_interval=0.05)
+    start = time.perf_counter()
+    # plain transfers, every sender keeps its own nonce sequence and nothing waits before the final drain
+    futures = await asyncio.gather(*[txs.submit(None, {'from': accounts[i % len(accounts)], 'to': accounts[(i + 1) % len(accounts)], 'value': 1})
+                                     for i in range(args.transactions)])
+    submitted = time.perf_counter() - start
+    await asyncio.gather(*futures)
+    elapsed = time.perf_counter() - start
+    await txs.stop()
+    summary = txs.summary()
+    print(f"{args.transactions} transactions from {len(accounts)} accounts: submitted in {submitted:.2f}s, "
+          f"confirmed in {elapsed:.2f}s ({args.transactions / elapsed:.1f} tx/s)")
+    print(f"latency p50 {summary.get('latency_p50', 0):.3f}s, p95 {summary.get('latency_p95', 0):.3f}s, "
+          f"reverted {summary['reverted']}, gas used {summary['gas_used']}")
+
+
+def bench_transactions(args):
+    asyncio.run(run_transactions(args))
+
+
+async def run_signing(args):
+    w3 = chain.get_async_w3(args.rpc)
+    funder = (await chain.get_accounts_async(w3))[1]
+    local = keys.derive_keys(args.keys, args.seed)
+    addresses = [account.address for account in local]
+    txs = TxSubmitter(w3, poll_interval=0.05)
+    try:
+        start = time.perf_counter()
+        funded = await keys.fund_accounts(w3, txs, funder, addresses, 10**16)
+        print(f"Funding: {funded} of {len(local)} accounts in {time.perf_counter() - start:.2f}s")
+    finally:
+        await txs.stop()
+
+    # one transfer per local account back to the funder, signed offline by every pool configuration
+    gas_price = await w3.eth.gas_price
+    chain_id = await chain.get_chain_id_async(w3)
+    nonces = await asyncio.gather(*[w3.eth.get_transaction_count(address, 'pending') for address in addresses])
+    transfers = [{'from': address, 'to': funder, 'value': 1, 'gas': keys.TRANSFER_GAS, 'gasPrice': gas_price,
+                  'nonce': nonce, 'chainId': chain_id} for address, nonce in zip(addresses, nonces)]
+    raw = None
+    for pool in args.pools:
+        for workers in args.signer_workers:
+            signer = keys.Signer(local, pool, workers)
+            try:
+                await signer.sign_many(transfers[:min(len(transfers), 64)])  # pool startup is not measured
+                signer.stats = {'signed': 0, 'sign_seconds': 0.0}
+                raw = await signer.sign_many(transfers)
+            finally:
+                signer.shutdown()
+            print(f"{pool:>7} x {workers:>2}: {signer.summary()['signatures_per_s']:9.1f} signatures/s")
+
+    # node side: how fast the raw transactions are accepted, then mined
+    start = time.perf_counter()
+    hashes = await asyncio.gather(*[w3.eth.send_raw_transaction(tx) for tx in raw])
+    accepted = time.perf_counter() - start
+    receipts = await asyncio.gather(*[w3.eth.wait_for_transaction_receipt(tx_hash, poll_latency=0.05) for tx_hash in hashes])
+    mined = time.perf_counter() - start
+    print(f"Ingest: {len(raw)} raw transactions accepted in {accepted:.2f}s ({len(raw) / accepted:.1f} tx/s), "
+          f"mined in {mined:.2f}s ({len(raw) / mined:.1f} tx/s), {sum(r['status'] != 1 for r in receipts)} reverted")
+
+
+def bench_signing(args):
+    asyncio.run(run_signing(args))
+
+
+def bench_bootstrap(args):
+    if args.mode is None:
+        # every mode runs in a fresh interpreter, so that nothing is cached in memory
+        for mode in ['legacy', 'chain']:
+            subprocess.run([sys.executable, __file__, 'bootstrap', '--mode', mode], check=True)
+        return
+
+    start = time.perf_counter()
+    if args.mode == 'legacy':
+        # what every script did at import time before the chain module
+        from web3 import Web3
+        with open(chain.ARTIFACT_PATH) as f:
+            abi = json.load(f)['abi']
+        w3 = Web3(Web3.HTTPProvider(chain.RPC_URL))
+        w3.middleware_onion.add(chain._count_rpc, 'rpc_counter')
+        contract = w3.eth.contract(address=Web3.to_checksum_address(chain.CONTRACT_ADDRESS), abi=abi)
+        accounts = w3.eth.accounts
+    else:
+        w3 = chain.get_w3()
+        contract = chain.get_contract(w3)
+        accounts = chain.get_accounts(w3)
+    ready = time.perf_counter() - start
+    contract.functions.getTask(args.task).call({'from': accounts[0]})  # first useful work
+    elapsed = time.perf_counter() - start
+    print(f"{args.mode:>6}: ready in {ready * 1000:.1f}ms, first getTask after {elapsed * 1000:.1f}ms, "
+          f"{sum(chain.rpc_counts.values())} RPCs ({dict(chain.rpc_counts)})")
+
+
+def bench_speed(args):
+    # training and scoring throughput of one worker, baseline path against each speedup
+    train, test = get_loaders(args.dataset, args.workers)[0]
+    testset = ml_utils.collateDataLoader(test)
+    samples = shard_size(train) * ml_utils.EPOCHS
+    device = ml_utils.getDevice()
+    candidates = [ml_utils.cnn().state_dict() for _ in range(args.candidates)]
+    if not ml_utils.bf16Supported(device):
+        print("bf16 is not supported natively here, the bf16 runs use fp32")
+    for threads in args.threads:
+        ml_utils.torch.set_num_threads(threads)
+        for spec in args.configs:
+            speedups = ml_utils.parseSpeedups(spec)
+            ml_utils.torch.manual_seed(0)
+            model = ml_utils.cnn().to(device)
+            if 'compile' in speedups:
+                # compilation happens on the first batches, warm it up outside of the measured epoch
+                training.train_epochs(model, [next(iter(train))], device, speedups)
+            start = time.perf_counter()
+            accuracy = training.train_epochs(model, train, device, speedups)
+            trained = time.perf_counter() - start
+            start = time.perf_counter()
+            ml_utils.evaluateModels(model, candidates, *testset, inferenceMode='inference' in speedups)
+            scored = time.perf_counter() - start
+            print(f"{threads:>2} threads, {spec:>32}: train {samples / trained:8.0f} samples/s (accuracy {accuracy[-1]:.1f}%), "
+                  f"score {args.candidates * testset[1].size(0) / scored:8.0f} samples/s")
+
+
+def bench_scoring(args):
+    # one round of candidates of increasing quality: snapshots of a model along its training, the last ones close
+    # to each other, scored exhaustively and adaptively on the same test set
+    train, test = get_loaders(args.dataset, args.workers)[0]
+    testset = ml_utils.collateDataLoader(test)
+    batches = list(train)
+    step = max(1, len(batches) // args.candidates)
+    ml_utils.torch.manual_seed(0)
+    model = ml_utils.cnn()
+    candidates = []
+    for i in range(args.candidates):
+        training.train_epochs(model, batches[i * step:(i + 1) * step], None)
+        candidates.append({name: tensor.clone() for name, tensor in model.state_dict().items()})
+    budget = len(candidates) * testset[1].size(0)
+
+    start = time.perf_counter()
+    exact = ml_utils.evaluateModels(model, candidates, *testset, inferenceMode=True)
+    elapsed = time.perf_counter() - start
+    print(f"{args.candidates} candidates ({exact.min().item():.1f}% to {exact.max().item():.1f}%) on {testset[1].size(0)} test samples, "
+          f"exhaustive: {elapsed * 1000:.0f}ms")
+    exact_votes = (exact * 10).long()
+    exact_ranks = exact.argsort().argsort().double()
+    for delta in args.deltas:
+        start = time.perf_counter()
+        accuracies, evaluations = ml_utils.evaluateModelsAdaptive(model, candidates, *testset, inferenceMode=True, delta=delta)
+        adaptive = time.perf_counter() - start
+        ranks = accuracies.argsort().argsort().double()
+        spearman = ml_utils.np.corrcoef(exact_ranks.numpy(), ranks.numpy())[0, 1]
+        difference = ((accuracies * 10).long() - exact_votes).abs()
+        print(f"delta {delta:>5}: {adaptive * 1000:6.0f}ms ({elapsed / adaptive:.2f}x), {1 - evaluations / budget:.1%} of the evaluations saved, "
+              f"same best model: {accuracies.argmax().item() == exact.argmax().item()}, rank correlation {spearman:.3f}, "
+              f"vote error mean {difference.double().mean().item():.1f} max {difference.max().item()} (votes are accuracy x 10)")
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def bench_aggregation(args):
+    if args.mode is None:
+        # every aggregator runs in a fresh interpreter, so that the peak memory of one does not hide the next
+        for mode in ['stack', 'mean', 'weighted', f'trimmed:{args.trim}']:
+            subprocess.run([sys.executable, __file__, 'aggregation', '--mode', mode, '--models', str(args.models)], check=True)
+        return
+
+    # the serialized models of a round, as a worker finds them in IPFS
+    ipfsclient = ipfs_stub.connect()
+    generator = ml_utils.torch.Generator().manual_seed(0)
+    cids = []
+    for _ in range(args.models):
+        state_dict = ml_utils.cnn().state_dict()
+        for tensor in state_dict.values():
+            tensor.add_(ml_utils.torch.randn(tensor.shape, generator=generator), alpha=0.01)
+        buffer = ml_utils.io.BytesIO()
+        ml_utils.torch.save(state_dict, buffer)
+        cids.append(ipfsclient.add_bytes(buffer.getvalue()))
+        del state_dict
+    baseline = current_rss()
+
+    start = time.perf_counter()
+    if args.mode == 'stack':
+        # what a mean costs with every model in memory at once
+        state_dicts = [ml_utils.torch.load(ml_utils.io.BytesIO(ipfsclient.cat(cid))) for cid in cids]
+        result = {name: ml_utils.torch.stack([sd[name] for sd in state_dicts]).mean(dim=0) for name in state_dicts[0]}
+    else:
+        aggregator = None
+        for i, cid in enumerate(cids):
+            state_dict = ml_utils.torch.load(ml_utils.io.BytesIO(ipfsclient.cat(cid)))
+            if aggregator is None:
+                aggregator = running_mean.make_aggregator(args.mode, state_dict, len(cids))
+            aggregator.add(state_dict, 1.0 + i / len(cids))
+            del state_dict
+        result = aggregator.state_dict()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    model_bytes = sum(tensor.numel() * tensor.element_size() for tensor in result.values())
+    print(f"{args.mode:>10}: {args.models} models in {elapsed * 1000:.1f}ms, "
+          f"peak memory +{max(peak, 0) / 2**20:.1f}MiB ({max(peak, 0) / model_bytes:.1f} models)")
+
+
+def bench_codec(args):
+    # two consecutive rounds of one worker give a model and its parent, then every encoding is applied to the child
+    train, test = get_loaders(args.dataset, 1)[0]
+    testset = ml_utils.collateDataLoader(test)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            ipfsclient = ipfs_stub.connect()
+            address = BenchWorker(0, (train, test)).address
+            parent_cid, _, _ = training.train_round(0, address, [], train, testset, None, ipfsclient)
+            child_cid, _, _ = training.train_round(1, address, [parent_cid], train, testset, None, ipfsclient)
+        finally:
+            os.chdir(cwd)
+    parent = ml_utils.loadModelFromIPFS(ipfsclient, parent_cid)
+    child = {name: tensor.clone() for name, tensor in ml_utils.loadModelFromIPFS(ipfsclient, child_cid).items()}
+
+    results = []
+    start = time.perf_counter()
+    buffer = ml_utils.io.BytesIO()
+    ml_utils.torch.save(child, buffer)
+    blob = buffer.getvalue()
+    encoded = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = ml_utils.torch.load(ml_utils.io.BytesIO(blob))
+    results.append(('torch.save', len(blob), encoded, time.perf_counter() - start, decoded))
+    for encoding in model_codec.ENCODINGS:
+        start = time.perf_counter()
+        blob = model_codec.encode(child, encoding, parent, parent_cid)
+        encoded = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = model_codec.decode(blob, lambda cid: parent)
+        results.append((encoding, len(blob), encoded, time.perf_counter() - start, decoded))
+
+    accuracies = ml_utils.evaluateModels(ml_utils.cnn(), [child] + [decoded for *_, decoded in results], *testset)
+    print(f"reference model: {accuracies[0].item():.2f}% on {testset[1].size(0)} test samples")
+    for (name, size, encoded, decoded, _), accuracy in zip(results, accuracies[1:].tolist()):
+        print(f"{name:>11}: {size / 1024:8.1f}KiB per model, {size * args.workers_per_round / 2**20:7.2f}MiB per round, "
+              f"encode {encoded * 1000:6.2f}ms, decode {decoded * 1000:6.2f}ms, accuracy {accuracy - accuracies[0].item():+.2f} points")
+
+
+class TimedBackend:
+    # Wraps a training backend to measure the training/evaluation time of every worker
+    def __init__(self, backend):
+        self.backend = backend
+        self.durations = []  # (round, last round, seconds)
+        self.scored = []  # (models, seconds) of the background scoring of the pipelined mode
+
+    async def train(self, worker, previousRoundHashes, lastRound=False):
+        start = time.perf_counter()
+        result = await self.backend.train(worker, previousRoundHashes, lastRound)
+        self.durations.append((worker.round, lastRound, time.perf_counter() - start))
+        return result
+
+    async def score(self, worker, hashes):
+        start = time.perf_counter()
+        result = await self.backend.score(worker, hashes)
+        self.scored.append((len(hashes), time.perf_counter() - start))
+        return result
+
+    def shutdown(self):
+        self.backend.shutdown()
+
+
+async def run_oracle(args):
+    # many tasks asking for randomness in the same few blocks, answered by the oracle service
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    admin, oracle_account, workers = accounts[-1], accounts[0], accounts[1:5]
+    contract = await chain.deploy_contract_async(w3, admin)
+    txs = TxSubmitter(w3, poll_interval=0.05)
+    part1, part2 = encode_CID_to_2_bytes_32(ipfs_stub.compute_cid(b'model'))
+
+    start = time.perf_counter()
+    receipts = await asyncio.gather(*[txs.transact(contract.functions.deployTask(part1, part2, 2, 2, 1), {'from': admin})
+                                      for _ in range(args.tasks)])
+    taskIds = [contract.events.Deployed().process_receipt(receipt)[0].args['taskId'] for receipt in receipts]
+    await asyncio.gather(*[txs.transact(contract.functions.register(taskId), {'from': worker, 'value': 1})
+                           for taskId in taskIds for worker in workers])
+    print(f"{args.tasks} tasks deployed and registered in {time.perf_counter() - start:.1f}s")
+
+    dispatcher = await EventDispatcher(w3, contract, name='benchmark', cursor_path=None, poll_interval=args.poll_interval).start()
+    reader = BatchReader(contract, endpoint=args.rpc, dispatcher=dispatcher)
+    oracle_txs = TxSubmitter(w3, dispatcher)
+    oracle = number_oracle.RandomnessOracle(w3, contract, oracle_account, dispatcher, reader, oracle_txs, state_path=None)
+    service = asyncio.create_task(oracle.run())
+    started = dispatcher.subscribe('RoundStarted')
+    rpcs_before = sum(chain.rpc_counts.values())
+    try:
+        start = time.perf_counter()
+        # every stopFunding completes a task, which asks for a seed
+        await asyncio.gather(*[txs.submit(contract.functions.stopFunding(taskId), {'from': admin}) for taskId in taskIds])
+        for _ in taskIds:
+            await next_event(started, service)
+        elapsed = time.perf_counter() - start
+    finally:
+        service.cancel()
+        await txs.stop()
+        await oracle_txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+    summary = oracle.summary()
+    print(f"{args.tasks} requests fulfilled in {elapsed:.2f}s ({args.tasks / elapsed:.1f} tasks/s), "
+          f"{sum(chain.rpc_counts.values()) - rpcs_before} RPCs")
+    print(f"request to seed confirmed: p50 {summary.get('latency_p50', 0) * 1000:.0f}ms, "
+          f"p95 {summary.get('latency_p95', 0) * 1000:.0f}ms, max {summary.get('latency_max', 0) * 1000:.0f}ms; {summary}")
+
+
+async def run_payload_task(w3, contract, txs, admin, workers, payload, seed):
+    # a 2-round task with len(workers) // 2 workers per round: the first round commits CIDs only, the second
+    # (last) one as many votes as there are workers per round. Returns the gas of every commit of both rounds.
+    workersPerRound = len(workers) // 2
+    part1, part2 = encode_CID_to_2_bytes_32(ipfs_stub.compute_cid(b'model'))
+    receipt = await txs.transact(contract.functions.deployTask(part1, part2, 2, workersPerRound, 1), {'from': admin})
+    taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+    await asyncio.gather(*[txs.transact(contract.functions.register(taskId), {'from': worker, 'value': 1}) for worker in workers])
+    await txs.transact(contract.functions.stopFunding(taskId), {'from': admin})
+    await txs.transact(contract.functions.setRandomness(taskId, seed), {'from': admin})
+    order = (await contract.functions.getTask(taskId).call())[8]
+
+    def commit(work, votes):
+        if payload == 'compact':
+            return contract.functions.commitPacked(taskId, *encode_CID(work), pack_votes(votes))
+        return contract.functions.commit(taskId, *encode_CID_to_2_bytes_32(work), votes)
+
+    gas = {}
+    for r in range(2):
+        votes = [] if r == 0 else [(i * 37) % 1001 for i in range(workersPerRound)]
+        receipts = await asyncio.gather(*[txs.transact(commit(ipfs_stub.compute_cid(f'{taskId}/{worker}'.encode()), votes), {'from': worker})
+                                          for worker in order[r * workersPerRound:(r + 1) * workersPerRound]])
+        gas[r] = [receipt['gasUsed'] for receipt in receipts]
+    return gas
+
+
+async def run_payload(args):
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    admin = accounts[-1]
+    contract = await chain.deploy_contract_async(w3, admin)
+    # 2 x votes workers per task: derived keys, the node does not have that many accounts
+    local = keys.derive_keys(2 * max(args.votes), 'fedml-payload')
+    signer = keys.Signer(local, 'thread')
+    txs = TxSubmitter(w3, poll_interval=0.05, signer=signer)
+    try:
+        await keys.fund_accounts(w3, txs, accounts[1], [account.address for account in local], 10**18)
+        print(f"{'votes':>5} {'payload':>8} {'CID commit':>11} {'vote commit':>12} {'calldata':>9}")
+        for count in args.votes:
+            workers = [account.address for account in local[:2 * count]]
+            results = {}
+            for payload in ['legacy', 'compact']:
+                gas = await run_payload_task(w3, contract, txs, admin, workers, payload, args.seed)
+                # calldata of a vote commit: selector, task id, two CID words, then the dynamic votes
+                calldata = 4 + 32 * 5 + (32 * count if payload == 'legacy' else 32 * ((2 * count + 31) // 32))
+                results[payload] = (sum(gas[0]) / len(gas[0]), sum(gas[1]) / len(gas[1]))
+                print(f"{count:>5} {payload:>8} {results[payload][0]:>11.0f} {results[payload][1]:>12.0f} {calldata:>8}B")
+            saved = 1 - results['compact'][1] / results['legacy'][1]
+            print(f"{count:>5} {'saved':>8} {results['legacy'][0] - results['compact'][0]:>11.0f} "
+                  f"{results['legacy'][1] - results['compact'][1]:>12.0f} ({saved * 100:.1f}% of a vote commit)")
+    finally:
+        await txs.stop()
+        signer.shutdown()
+
+
+def bench_payload(args):
+    asyncio.run(run_payload(args))
+
+
+async def run_index(args):
+    # catch-up speed of the indexer over the current chain, then round work read from the chain and from the index
+    w3 = chain.get_async_w3(args.rpc)
+    contract = chain.get_async_contract(w3, args.contract)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'index.sqlite')
+        task_indexer = indexer.Indexer(w3, contract, path)
+        start = time.perf_counter()
+        latest = await task_indexer.catch_up()
+        elapsed = time.perf_counter() - start
+        print(f"Catch-up: {latest + 1} blocks in {elapsed:.2f}s ({(latest + 1) / elapsed:.0f} blocks/s), {task_indexer.stats}")
+        index = indexer.TaskIndex(path)
+        rounds = [(task['task_id'], r) for task in index.tasks() for r in range(task['rounds']) if index.round_cids(task['task_id'], r)]
+        if not rounds:
+            print("No committed round on this chain, run a task first (e.g. benchmark.py e2e --no-deploy)")
+            return
+        start = time.perf_counter()
+        for taskId, r in rounds:
+            await contract.functions.getRoundWork(taskId, r).call()
+        rpc = (time.perf_counter() - start) / len(rounds)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for taskId, r in rounds:
+                index.round_work(taskId, r)
+                index.vote_matrix(taskId, r)
+        local = (time.perf_counter() - start) / (len(rounds) * args.repeat)
+        print(f"Round work of {len(rounds)} rounds: {rpc * 1e6:.0f}us per getRoundWork call, "
+              f"{local * 1e6:.0f}us per local round work + vote matrix")
+        index.close()
+
+
+def bench_index(args):
+    asyncio.run(run_index(args))
+
+
+def bench_oracle(args):
+    asyncio.run(run_oracle(args))
+
+
+async def run_deadlines(args):
+    # a burst of deployments, all with the same funding window, served by the deadline scheduler
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    admin = accounts[-1]
+    contract = await chain.deploy_contract_async(w3, admin)
+    dispatcher = await EventDispatcher(w3, contract, name='benchmark', cursor_path=None, poll_interval=args.poll_interval).start()
+    reader = BatchReader(contract, endpoint=args.rpc, dispatcher=dispatcher)
+    txs = TxSubmitter(w3, dispatcher)
+    scheduler = time_oracle.DeadlineScheduler(w3, contract, admin, dispatcher, reader, txs, args.window, state_path=None)
+    service = asyncio.create_task(scheduler.run())
+    stopped = dispatcher.subscribe('StopFunding')
+    part1, part2 = encode_CID_to_2_bytes_32(ipfs_stub.compute_cid(b'model'))
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[txs.submit(contract.functions.deployTask(part1, part2, 2, 2, 1), {'from': admin})
+                               for _ in range(args.tasks)])
+        print(f"{args.tasks} deployments submitted in {time.perf_counter() - start:.1f}s, threads: {threading.active_count()}")
+        for _ in range(args.tasks):
+            await next_event(stopped, service)
+        print(f"all the funding windows closed {time.perf_counter() - start:.1f}s after the first deployment")
+
+        # nothing left to schedule: the process should sleep until the next block or deadline
+        cpu, wall = time.process_time(), time.perf_counter()
+        await asyncio.sleep(args.idle)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    finally:
+        service.cancel()
+        await txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+    summary = scheduler.summary()
+    print(f"deadline to stopFunding read: p50 {summary.get('jitter_p50', 0) * 1000:.0f}ms, "
+          f"p95 {summary.get('jitter_p95', 0) * 1000:.0f}ms, max {summary.get('jitter_max', 0) * 1000:.0f}ms")
+    print(f"idle: {cpu / wall * 100:.2f}% of a core over {wall:.1f}s, threads: {threading.active_count()}; {summary}")
+
+
+def bench_deadlines(args):
+    asyncio.run(run_deadlines(args))
+
+
+async def next_event(queue, guard):
+    # wait for the next event, but fail instead of hanging if the workers exit first
+    getter = asyncio.ensure_future(queue.get())
+    done, _ = await asyncio.wait({getter, guard}, return_when=asyncio.FIRST_COMPLETED)
+    if getter in done:
+        return getter.result()
+    getter.cancel()
+    guard.result()
+    raise RuntimeError('the workers exited before the event was emitted')
+
+
+async def run_task(args, w3, contract, admin, workerAccounts, datasets, ipfsclient, ipfs_factory, phases):
+    # deploy -> register -> rounds -> last round score of one task, driven against the local chain
+    # (imported here: async_workers loads the contract at import, which the bootstrap benchmark must not pay)
+    import async_workers
+    workersRequired = args.rounds * args.workers_per_round
+    dispatcher = await EventDispatcher(w3, contract, name='benchmark', cursor_path=None, poll_interval=args.poll_interval).start()
+    reader = BatchReader(contract, endpoint=args.rpc, dispatcher=dispatcher)
+    txs = TxSubmitter(w3, dispatcher)
+
+    start = time.perf_counter()
+    model = ml_utils.io.BytesIO()
+    ml_utils.torch.save(ml_utils.cnn().state_dict(), model)
+    part1, part2 = encode_CID_to_2_bytes_32(ipfsclient.add_bytes(model.getvalue()))
+    receipt = await txs.transact(contract.functions.deployTask(part1, part2, args.rounds, args.workers_per_round, args.entrance_fee), {'from': admin})
+    taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+    await txs.transact(contract.functions.fund(taskId), {'from': admin, 'value': args.funding})
+    phases['deploy'] = time.perf_counter() - start
+
+    if args.backend == 'thread':
+        backend = TimedBackend(training.InProcessBackend(ml_utils.getDevice(), ipfsclient))
+    else:
+        backend = TimedBackend(training.ProcessPoolBackend(datasets, args.processes, args.threads_per_process, ipfs_factory))
+    registered = dispatcher.subscribe('Registered', taskId)
+    if args.local_keys:
+        local = keys.derive_keys(workersRequired, args.key_seed)
+        txs.signer = keys.Signer(local, args.signer)
+        start = time.perf_counter()
+        await keys.fund_accounts(w3, txs, workerAccounts[1], [account.address for account in local], args.entrance_fee + keys.GAS_ALLOWANCE)
+        phases['fund_workers'] = time.perf_counter() - start
+        workerAccounts = [account.address for account in local]
+    round_started = dispatcher.subscribe('RoundStarted', taskId)
+    commit_ended = dispatcher.subscribe('LastRoundCommittmentEnded', taskId)
+    task_ended = dispatcher.subscribe('TaskEnded', taskId)
+    options = async_workers.WorkerOptions.from_args(args)
+    workers = [async_workers.worker(address, contract, datasets[i], shard=i, backend=backend, dispatcher=dispatcher, txs=txs, reader=reader,
+                                    taskId=taskId, options=options)
+               for i, address in enumerate(workerAccounts[:workersRequired])]
+
+    try:
+        start = time.perf_counter()
+        simulation = asyncio.ensure_future(asyncio.gather(*[w.simulate() for w in workers]))
+        for _ in range(workersRequired):
+            await next_event(registered, simulation)
+        phases['register'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await txs.transact(contract.functions.stopFunding(taskId), {'from': admin})
+        await txs.transact(contract.functions.setRandomness(taskId, args.seed), {'from': admin})
+        await next_event(round_started, simulation)
+        phases['start'] = time.perf_counter() - start
+
+        for r in range(args.rounds - 1):
+            start = time.perf_counter()
+            await next_event(round_started, simulation)
+            phases[f'round{r}'] = time.perf_counter() - start
+        start = time.perf_counter()
+        await next_event(commit_ended, simulation)
+        phases[f'round{args.rounds - 1}'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await next_event(task_ended, simulation)
+        await simulation
+        await txs.drain()
+        phases['last_round_score'] = time.perf_counter() - start
+    finally:
+        await txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+        backend.shutdown()
+        if txs.signer is not None:
+            txs.signer.shutdown()
+    return backend, txs, reader
+
+
+async def run_e2e(args):
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    workersRequired = args.rounds * args.workers_per_round
+    if args.rounds < 2:
+        raise SystemExit("a task needs at least 2 rounds: the last one only scores the previous one")
+    if workersRequired > len(accounts) - 1 and not args.local_keys:
+        raise SystemExit(f"{workersRequired} workers need {workersRequired + 1} node accounts, the node has {len(accounts)}")
+    admin = accounts[-1]
+    chain.get_abi()  # loaded before leaving the repository root
+
+    phases = {}
+    start = time.perf_counter()
+    contract = await chain.deploy_contract_async(w3, admin) if args.deploy else chain.get_async_contract(w3)
+    phases['deploy_contract'] = time.perf_counter() - start
+    start = time.perf_counter()
+    datasets = get_loaders(args.dataset, workersRequired)
+    phases['dataset'] = time.perf_counter() - start
+    samples = sum(shard_size(train) for train, _ in datasets) * ml_utils.EPOCHS
+
+    rpcs_before = sum(chain.rpc_counts.values())
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # round artifacts are written under ./rounds
+        try:
+            ipfs_root = os.path.join(workdir, 'ipfs')
+            ipfsclient = ipfs_stub.connect(ipfs_root)
+            backend, txs, reader = await run_task(args, w3, contract, admin, accounts, datasets, ipfsclient,
+                                                  functools.partial(ipfs_stub.connect, ipfs_root), phases)
+            stored = sum(os.path.getsize(os.path.join(ipfs_root, cid)) for cid in os.listdir(ipfs_root))
+        finally:
+            os.chdir(cwd)
+
+    trained = [seconds for _, lastRound, seconds in backend.durations if not lastRound]
+    # models are trained in every round but the last one, which only votes
+    training_wall = sum(phases[f'round{r}'] for r in range(args.rounds - 1))
+    training_samples = samples * (args.rounds - 1) // args.rounds
+    report = {
+        'config': {'rounds': args.rounds, 'workers_per_round': args.workers_per_round, 'backend': args.backend, 'dataset': args.dataset,
+                   'aggregation': args.aggregation, 'encoding': args.encoding,
+                   'speedups': args.speedups, 'pipelined': args.pipelined, 'local_keys': args.local_keys, 'payload': args.payload,
+                   'scoring': args.scoring},
+        'phases': phases,
+        # per round: from its RoundStarted to the next one (the last commitment for the last round), and the mean
+        # time a worker of the round spends in the backend once selected (scoring of the previous models + training)
+        'critical_path': {r: {'seconds': phases[f'round{r}'],
+                              'worker_seconds': sum(s for round, _, s in backend.durations if round == r) /
+                                                max(1, sum(1 for round, _, _ in backend.durations if round == r))}
+                          for r in range(args.rounds)},
+        'prefetch': {'models': sum(n for n, _ in backend.scored), 'worker_seconds': sum(s for _, s in backend.scored)},
+        'total': sum(phases.values()),
+        'rpc': {'requests': sum(chain.rpc_counts.values()) - rpcs_before, 'by_method': dict(chain.rpc_counts), 'read_batches': reader.stats},
+        'ipfs': {'stored_bytes': stored, 'coordinator_client': ipfsclient.stats, 'cache': ipfs_cache.cache.summary()},
+        'transactions': txs.summary(),
+        'signatures': txs.signer.summary() if txs.signer is not None else None,
+        'training': {'models': len(trained), 'worker_seconds': sum(trained), 'wall_seconds': training_wall,
+                     'models_per_s': len(trained) / training_wall if trained else 0,
+                     'samples_per_s': training_samples / training_wall if trained else 0},
+    }
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+def bench_e2e(args):
+    asyncio.run(run_e2e(args))
+
+
+WORKERS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'async_workers.py')
+
+
+async def launch_workers(args, contract, taskId, run_dir, mode, log):
+    # a real async_workers.py process, in its own directory: its checkpoints, event cursor and rounds/ live there
+    env = dict(os.environ, FEDML_RPC_URL=args.rpc, FEDML_CONTRACT_ADDRESS=contract.address,
+               FEDML_ARTIFACT=os.path.abspath(chain.ARTIFACT_PATH), FEDML_ABI_CACHE=os.path.abspath(chain.ABI_CACHE_PATH))
+    for name in ['FEDML_WORKER_STATE', 'FEDML_EVENTS_CURSOR', 'FEDML_METRICS', 'FEDML_TRACE']:
+        env.pop(name, None)
+    command = [sys.executable, WORKERS_SCRIPT, '--task', str(taskId), '--dataset', args.dataset, '--rounds-limit', str(args.rounds_limit),
+               '--ipfs-root', os.path.join(run_dir, 'ipfs'), '--trace', os.path.join(run_dir, 'trace.jsonl')]
+    if mode == 'chain-only':
+        command.append('--no-checkpoint')
+    return await asyncio.create_subprocess_exec(*command, cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def completed_trainings(trace_path):
+    # pid of the worker process -> trainings it completed (a training cut by the kill leaves no span)
+    trainings = {}
+    with open(trace_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'span' and record['name'] == 'backend_train' and record['error'] is None:
+                trainings[record['pid']] = trainings.get(record['pid'], 0) + 1
+    return trainings
+
+
+async def mined_transactions(w3, contract, addresses, first_block):
+    # function -> [mined, reverted] of the worker transactions to the contract, read back from the chain: what the
+    # two processes actually paid for, whatever they believed they had sent
+    addresses = set(addresses)
+    latest = await w3.eth.block_number
+    blocks = await asyncio.gather(*[w3.eth.get_block(n, full_transactions=True) for n in range(first_block, latest + 1)])
+    sent = [tx for block in blocks for tx in block['transactions'] if tx['to'] == contract.address and tx['from'] in addresses]
+    receipts = await asyncio.gather(*[w3.eth.get_transaction_receipt(tx['hash']) for tx in sent])
+    counts = {}
+    for tx, receipt in zip(sent, receipts):
+        fn, _ = contract.decode_function_input(tx['input'])
+        count = counts.setdefault(fn.fn_name, [0, 0])
+        count[0] += 1
+        count[1] += receipt['status'] != 1
+    return counts
+
+
+async def run_recovery_task(args, w3, contract, admin, accounts, ipfsclient, run_dir, mode):
+    # one task whose worker process is SIGKILLed in the middle of a round, then relaunched in the same directory
+    workersRequired = args.rounds * args.workers_per_round
+    monitor = await EventDispatcher(w3, contract, name='benchmark', cursor_path=None, poll_interval=args.poll_interval).start()
+    admin_txs = TxSubmitter(w3, monitor)
+    model = ml_utils.io.BytesIO()
+    ml_utils.torch.save(ml_utils.cnn().state_dict(), model)
+    part1, part2 = encode_CID_to_2_bytes_32(ipfsclient.add_bytes(model.getvalue()))
+    receipt = await admin_txs.transact(contract.functions.deployTask(part1, part2, args.rounds, args.workers_per_round, args.entrance_fee), {'from': admin})
+    taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+    await admin_txs.transact(contract.functions.fund(taskId), {'from': admin, 'value': args.funding})
+    registered = monitor.subscribe('Registered', taskId)
+    round_started = monitor.subscribe('RoundStarted', taskId)
+    commit_ended = monitor.subscribe('LastRoundCommittmentEnded', taskId)
+    task_ended = monitor.subscribe('TaskEnded', taskId)
+
+    result = {}
+    logs = [open(os.path.join(run_dir, f'workers{run}.log'), 'w') for run in range(2)]
+    process = await launch_workers(args, contract, taskId, run_dir, mode, logs[0])
+    killed = process.pid
+    exited = asyncio.ensure_future(process.wait())
+    try:
+        for _ in range(workersRequired):
+            await next_event(registered, exited)
+        await admin_txs.transact(contract.functions.stopFunding(taskId), {'from': admin})
+        await admin_txs.transact(contract.functions.setRandomness(taskId, args.seed), {'from': admin})
+        while (await next_event(round_started, exited)).args['roundNumber'] != args.kill_round:
+            pass
+        await asyncio.sleep(args.kill_delay)
+        # the kill: no cleanup at all, whatever was in memory or waiting to be sent is lost
+        process.kill()
+        await exited
+        while not round_started.empty():
+            round_started.get_nowait()
+
+        start = time.perf_counter()
+        process = await launch_workers(args, contract, taskId, run_dir, mode, logs[1])
+        exited = asyncio.ensure_future(process.wait())
+        # recovered when the interrupted round completes: the next round starts, or the last commitment ends
+        await next_event(commit_ended if args.kill_round == args.rounds - 1 else round_started, exited)
+        result['recovery'] = time.perf_counter() - start
+        await next_event(task_ended, exited)
+        result['completion'] = time.perf_counter() - start
+        if await exited:
+            raise RuntimeError(f"the relaunched worker process exited with {process.returncode}, see {logs[1].name}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        for log in logs:
+            log.close()
+        await admin_txs.stop()
+        await monitor.stop()
+
+    # every worker trains (or only scores, in the last round) once when nothing is repeated
+    trainings = completed_trainings(os.path.join(run_dir, 'trace.jsonl'))
+    result['trainings_before_kill'] = trainings.get(killed, 0)
+    result['trainings_repeated'] = sum(trainings.values()) - workersRequired
+    with open(logs[1].name) as f:
+        result['trainings_reused'] = sum('trained before the restart' in line for line in f)
+    result['transactions'] = await mined_transactions(w3, contract, accounts[:workersRequired], receipt['blockNumber'])
+    result['rounds_kept'] = sum(checkpoint.round_sizes(os.path.join(run_dir, 'rounds')).values())
+    return result
+
+
+async def run_recovery(args):
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    workersRequired = args.rounds * args.workers_per_round
+    if workersRequired > len(accounts) - 1:
+        raise SystemExit(f"{workersRequired} workers need {workersRequired + 1} node accounts, the node has {len(accounts)}")
+    if not 0 <= args.kill_round < args.rounds:
+        raise SystemExit(f"--kill-round must be a round of the task (0 to {args.rounds - 1})")
+    admin = accounts[-1]
+    chain.get_abi()
+    os.makedirs('data', exist_ok=True)  # seen by the worker processes through a link: datasets and ABI cache
+    contract = await chain.deploy_contract_async(w3, admin)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes:
+            run_dir = os.path.join(workdir, mode)
+            os.makedirs(run_dir)
+            os.symlink(os.path.abspath('data'), os.path.join(run_dir, 'data'))
+            ipfsclient = ipfs_stub.connect(os.path.join(run_dir, 'ipfs'))
+            results[mode] = await run_recovery_task(args, w3, contract, admin, accounts, ipfsclient, run_dir, mode)
+    print(f"killed {args.kill_delay}s into round {args.kill_round} of {args.rounds} x {args.workers_per_round} workers")
+    for mode, result in results.items():
+        mined = ', '.join(f"{fn} {count} ({reverted} reverted)" for fn, (count, reverted) in sorted(result['transactions'].items()))
+        print(f"{mode:>13}: interrupted round completed {result['recovery']:.2f}s after the relaunch, task {result['completion']:.2f}s, "
+              f"{result['trainings_repeated']} trainings repeated ({result['trainings_before_kill']} done before the kill, "
+              f"{result['trainings_reused']} reused), mined: {mined}, "
+              f"rounds/ {result['rounds_kept'] / 2**20:.2f}MiB (limit {args.rounds_limit}MiB)")
+
+
+def bench_recovery(args):
+    asyncio.run(run_recovery(args))
+
+
+def bench_pipeline(args):
+    # the same task without and with pipelining, each in a fresh interpreter (no model left in the IPFS cache)
+    reports = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ['sequential', 'pipelined']:
+            output = os.path.join(workdir, f'{mode}.json')
+            command = [sys.executable, __file__, 'e2e', '--rpc', args.rpc, '--rounds', str(args.rounds),
+                       '--workers-per-round', str(args.workers_per_round), '--dataset', args.dataset, '--backend', args.backend,
+                       '--speedups', args.speedups, '--poll-interval', str(args.poll_interval), '--output', output]
+            if mode == 'pipelined':
+                command.append('--pipelined')
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                reports[mode] = json.load(f)
+
+    print(f"{'round':>5} {'sequential':>11} {'pipelined':>10} {'worker seq':>11} {'worker pipe':>12}")
+    for r in range(args.rounds):
+        sequential, pipelined = (reports[mode]['critical_path'][str(r)] for mode in ['sequential', 'pipelined'])
+        print(f"{r:>5} {sequential['seconds']:>10.2f}s {pipelined['seconds']:>9.2f}s "
+              f"{sequential['worker_seconds']:>10.2f}s {pipelined['worker_seconds']:>11.2f}s")
+    prefetch = reports['pipelined']['prefetch']
+    print(f"total {reports['sequential']['total']:.2f}s -> {reports['pipelined']['total']:.2f}s, "
+          f"{prefetch['models']} models scored ahead of their round ({prefetch['worker_seconds']:.2f} worker-seconds off the critical path)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the FedML worker pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    backends = subparsers.add_parser('backends', help='throughput of a training round for each training backend')
+    backends.add_argument('--workers', type=int, default=8)
+    backends.add_argument('--backends', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+    backends.add_argument('--processes', type=int, default=None)
+    backends.add_argument('--threads-per-process', type=int, default=None)
+    backends.add_argument('--dataset', choices=['tensor', 'torchvision', 'synthetic'], default='tensor')
+    backends.add_argument('--speedups', default='none')
+    backends.set_defaults(run=bench_backends)
+
+    dataset = subparsers.add_parser('dataset', help='startup and per-epoch time of the dataset loading paths')
+    dataset.add_argument('--workers', type=int, default=8)
+    dataset.add_argument('--datasets', nargs='+', choices=['tensor', 'torchvision', 'synthetic'], default=['torchvision', 'tensor'])
+    dataset.set_defaults(run=bench_dataset)
+
+    transactions = subparsers.add_parser('transactions', help='transaction pipeline throughput against a local node')
+    transactions.add_argument('--rpc', default=chain.RPC_URL)
+    transactions.add_argument('--transactions', type=int, default=500)
+    transactions.add_argument('--senders', type=int, default=10)
+    transactions.set_defaults(run=bench_transactions)
+
+    bootstrap = subparsers.add_parser('bootstrap', help='cold start time and RPCs before the first contract call')
+    bootstrap.add_argument('--mode', choices=['legacy', 'chain'], default=None)
+    bootstrap.add_argument('--task', type=int, default=0)
+    bootstrap.set_defaults(run=bench_bootstrap)
+
+    e2e = subparsers.add_parser('e2e', help='a complete task (deploy, register, rounds, last round score) on a local dev chain with a stub IPFS')
+    e2e.add_argument('--rpc', default=chain.RPC_URL)
+    e2e.add_argument('--rounds', type=int, default=3)
+    e2e.add_argument('--workers-per-round', type=int, default=4)
+    e2e.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='synthetic')
+    e2e.add_argument('--backend', choices=['thread', 'process'], default='thread')
+    e2e.add_argument('--processes', type=int, default=None)
+    e2e.add_argument('--threads-per-process', type=int, default=None)
+    e2e.add_argument('--deploy', action=argparse.BooleanOptionalAction, default=True,
+                     help='deploy a fresh contract (default) or use the one at FEDML_CONTRACT_ADDRESS')
+    e2e.add_argument('--entrance-fee', type=int, default=10**15)
+    e2e.add_argument('--funding', type=int, default=10**18)
+    e2e.add_argument('--seed', type=int, default=42)
+    e2e.add_argument('--poll-interval', type=float, default=0.1)
+    e2e.add_argument('--aggregation', default='best', help='best, mean, weighted or trimmed[:k]')
+    e2e.add_argument('--encoding', choices=model_codec.ENCODINGS, default='fp32')
+    e2e.add_argument('--speedups', default='none')
+    e2e.add_argument('--pipelined', action='store_true', help="score the previous round's models as they are committed")
+    e2e.add_argument('--local-keys', action='store_true', help='derived worker keys signed here, for more workers than node accounts')
+    e2e.add_argument('--key-seed', default=keys.DEFAULT_SEED)
+    e2e.add_argument('--signer', choices=['thread', 'process'], default='thread')
+    e2e.add_argument('--payload', choices=['legacy', 'compact'], default='legacy')
+    e2e.add_argument('--scoring', default='exhaustive', help='exhaustive or adaptive[:delta]')
+    e2e.add_argument('--output', default=None, help='also write the report to this JSON file')
+    e2e.set_defaults(run=bench_e2e)
+
+    aggregation = subparsers.add_parser('aggregation', help='time and peak memory of the aggregators over one round of models')
+    aggregation.add_argument('--mode', default=None, help="stack (all the models in memory), mean, weighted or trimmed:k")
+    aggregation.add_argument('--models', type=int, default=50)
+    aggregation.add_argument('--trim', type=int, default=2)
+    aggregation.set_defaults(run=bench_aggregation)
+
+    codec = subparsers.add_parser('codec', help='size, encode/decode time and accuracy of the model wire encodings')
+    codec.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='synthetic')
+    codec.add_argument('--workers-per-round', type=int, default=10, help='models uploaded per round, for the bytes per round')
+    codec.set_defaults(run=bench_codec)
+
+    oracle = subparsers.add_parser('oracle', help='randomness oracle under many simultaneous requests on a local node')
+    oracle.add_argument('--rpc', default=chain.RPC_URL)
+    oracle.add_argument('--tasks', type=int, default=200)
+    oracle.add_argument('--poll-interval', type=float, default=0.1)
+    oracle.set_defaults(run=bench_oracle)
+
+    deadlines = subparsers.add_parser('deadlines', help='funding deadline scheduler under a burst of deployments on a local node')
+    deadlines.add_argument('--rpc', default=chain.RPC_URL)
+    deadlines.add_argument('--tasks', type=int, default=1000)
+    deadlines.add_argument('--window', type=float, default=10)
+    deadlines.add_argument('--idle', type=float, default=10, help='seconds of idle CPU measurement after the burst')
+    deadlines.add_argument('--poll-interval', type=float, default=1)
+    deadlines.set_defaults(run=bench_deadlines)
+
+    speed = subparsers.add_parser('speed', help='samples/s of the local training and scoring, baseline and each speedup')
+    speed.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='tensor')
+    speed.add_argument('--workers', type=int, default=8, help='the measured shard is 1/workers of the dataset')
+    speed.add_argument('--candidates', type=int, default=10, help='models scored per pass')
+    speed.add_argument('--threads', type=int, nargs='+', default=[ml_utils.torch.get_num_threads()])
+    speed.add_argument('--configs', nargs='+', default=['none', 'metrics', 'metrics,inference', 'metrics,inference,channels_last',
+                                                        'metrics,inference,compile', 'metrics,inference,bf16', 'fast', 'fast,compile,bf16'])
+    speed.set_defaults(run=bench_speed)
+
+    scoring = subparsers.add_parser('scoring', help='evaluations saved and ranking error of the adaptive scoring of the candidates')
+    scoring.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='tensor')
+    scoring.add_argument('--workers', type=int, default=8, help='the test set is the one of a worker out of this many')
+    scoring.add_argument('--candidates', type=int, default=50, help='models of the previous round')
+    scoring.add_argument('--deltas', type=float, nargs='+', default=[0.01, 0.05, 0.2])
+    scoring.set_defaults(run=bench_scoring)
+
+    pipeline = subparsers.add_parser('pipeline', help='critical path of every round of a task, without and with pipelined scoring')
+    pipeline.add_argument('--rpc', default=chain.RPC_URL)
+    pipeline.add_argument('--rounds', type=int, default=3)
+    pipeline.add_argument('--workers-per-round', type=int, default=4)
+    pipeline.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='synthetic')
+    pipeline.add_argument('--backend', choices=['thread', 'process'], default='thread')
+    pipeline.add_argument('--speedups', default='none')
+    pipeline.add_argument('--poll-interval', type=float, default=0.1)
+    pipeline.set_defaults(run=bench_pipeline)
+
+    signing = subparsers.add_parser('signing', help='bulk funding, offline signing throughput and raw transaction ingest of local keys')
+    signing.add_argument('--rpc', default=chain.RPC_URL)
+    signing.add_argument('--keys', type=int, default=1000)
+    signing.add_argument('--seed', default='fedml-benchmark')
+    signing.add_argument('--pools', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+    signing.add_argument('--signer-workers', type=int, nargs='+', default=[1, os.cpu_count()])
+    signing.set_defaults(run=bench_signing)
+
+    payload = subparsers.add_parser('payload', help='gas of a commit with the legacy and the compact payload, per number of votes')
+    payload.add_argument('--rpc', default=chain.RPC_URL)
+    payload.add_argument('--votes', type=int, nargs='+', default=[10, 50, 200])
+    payload.add_argument('--seed', type=int, default=42)
+    payload.set_defaults(run=bench_payload)
+
+    index = subparsers.add_parser('index', help='indexer catch-up over the current chain, and local versus RPC round work reads')
+    index.add_argument('--rpc', default=chain.RPC_URL)
+    index.add_argument('--contract', default=chain.CONTRACT_ADDRESS)
+    index.add_argument('--repeat', type=int, default=100)
+    index.set_defaults(run=bench_index)
+
+    recovery = subparsers.add_parser('recovery', help='restart of a worker process killed in the middle of a round, with and without checkpoints')
+    recovery.add_argument('--rpc', default=chain.RPC_URL)
+    recovery.add_argument('--rounds', type=int, default=3)
+    recovery.add_argument('--workers-per-round', type=int, default=4)
+    recovery.add_argument('--dataset', choices=['synthetic', 'tensor', 'torchvision'], default='synthetic')
+    recovery.add_argument('--kill-round', type=int, default=1, help='round during which the worker process is killed')
+    recovery.add_argument('--kill-delay', type=float, default=1.0, help='seconds after the start of that round')
+    recovery.add_argument('--modes', nargs='+', choices=['checkpoint', 'chain-only'], default=['checkpoint', 'chain-only'],
+                          help='chain-only: the restarted workers only rebuild their position from the chain')
+    recovery.add_argument('--rounds-limit', type=float, default=0.5, help='MiB of model copies the worker process keeps under rounds/')
+    recovery.add_argument('--entrance-fee', type=int, default=10**15)
+    recovery.add_argument('--funding', type=int, default=10**18)
+    recovery.add_argument('--seed', type=int, default=42)
+    recovery.add_argument('--poll-interval', type=float, default=0.1)
+    recovery.set_defaults(run=bench_recovery)
+
+    args = parser.parse_args()
+    args.run(args)
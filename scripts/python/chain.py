@@ -0,0 +1,136 @@
+import os
+import json
+import functools
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3, AsyncWeb3
+
+# Shared bootstrap of every script: endpoint and contract address from the environment, ABI-only extract of the
+# hardhat artifact cached on disk, one pooled HTTP session per endpoint, and cached accounts/chain id.
+
+RPC_URL = os.environ.get('FEDML_RPC_URL', 'http://127.0.0.1:8545')
+CONTRACT_ADDRESS = os.environ.get('FEDML_CONTRACT_ADDRESS', '0x5fbdb2315678afecb367f032d93f642f64180aa3')
+ARTIFACT_PATH = os.environ.get('FEDML_ARTIFACT', './artifacts/contracts/FedMLContract.sol/FedMLContract.json')
+ABI_CACHE_PATH = os.environ.get('FEDML_ABI_CACHE', './data/FedMLContract.abi.json')
+
+# number of JSON-RPC requests sent by this process, per method
+rpc_counts = Counter()
+
+
+@functools.lru_cache(maxsize=None)
+def get_abi():
+    # The artifact also holds bytecode and sources, parse it only when it changed since the last extract
+    stat = os.stat(ARTIFACT_PATH)
+    key = [stat.st_mtime_ns, stat.st_size]
+    if os.path.exists(ABI_CACHE_PATH):
+        with open(ABI_CACHE_PATH) as f:
+            cached = json.load(f)
+        if cached.get('artifact') == key:
+            return cached['abi']
+    with open(ARTIFACT_PATH) as f:
+        abi = json.load(f)['abi']
+    os.makedirs(os.path.dirname(ABI_CACHE_PATH) or '.', exist_ok=True)
+    tmp_path = f'{ABI_CACHE_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'artifact': key, 'abi': abi}, f)
+    os.replace(tmp_path, ABI_CACHE_PATH)
+    return abi
+
+
+def get_bytecode():
+    # only needed to deploy the contract, never cached
+    with open(ARTIFACT_PATH) as f:
+        return json.load(f)['bytecode']
+
+
+def _count_rpc(make_request, w3):
+    def middleware(method, params):
+        rpc_counts[method] += 1
+        return make_request(method, params)
+    return middleware
+
+
+async def _count_rpc_async(make_request, w3):
+    async def middleware(method, params):
+        rpc_counts[method] += 1
+        return await make_request(method, params)
+    return middleware
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(endpoint=RPC_URL):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=64)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def get_w3(endpoint=RPC_URL):
+    w3 = Web3(Web3.HTTPProvider(endpoint, session=get_session(endpoint)))
+    w3.middleware_onion.add(_count_rpc, 'rpc_counter')
+    return w3
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_w3(endpoint=RPC_URL):
+    # AsyncHTTPProvider keeps one aiohttp session per endpoint for the whole process
+    w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(endpoint))
+    w3.middleware_onion.add(_count_rpc_async, 'rpc_counter')
+    return w3
+
+
+def get_contract(w3=None, address=CONTRACT_ADDRESS):
+    w3 = w3 or get_w3()
+    return w3.eth.contract(address=Web3.to_checksum_address(address), abi=get_abi())
+
+
+def get_async_contract(w3=None, address=CONTRACT_ADDRESS):
+    w3 = w3 or get_async_w3()
+    return w3.eth.contract(address=Web3.to_checksum_address(address), abi=get_abi())
+
+
+async def deploy_contract_async(w3, account, oracle=None):
+    # a fresh FedMLContract (benchmarks, gas sweeps), the deployer is the oracle unless told otherwise
+    factory = w3.eth.contract(abi=get_abi(), bytecode=get_bytecode())
+    tx_hash = await factory.constructor(oracle or account).transact({'from': account})
+    receipt = await w3.eth.wait_for_transaction_receipt(tx_hash)
+    return get_async_contract(w3, receipt['contractAddress'])
+
+
+# Node accounts and chain id never change for an endpoint, they are requested once
+_accounts = {}
+_chain_ids = {}
+
+def get_accounts(w3=None):
+    w3 = w3 or get_w3()
+    endpoint = w3.provider.endpoint_uri
+    if endpoint not in _accounts:
+        _accounts[endpoint] = list(w3.eth.accounts)
+    return _accounts[endpoint]
+
+
+def get_chain_id(w3=None):
+    w3 = w3 or get_w3()
+    endpoint = w3.provider.endpoint_uri
+    if endpoint not in _chain_ids:
+        _chain_ids[endpoint] = w3.eth.chain_id
+    return _chain_ids[endpoint]
+
+
+async def get_accounts_async(w3=None):
+    w3 = w3 or get_async_w3()
+    endpoint = w3.provider.endpoint_uri
+    if endpoint not in _accounts:
+        _accounts[endpoint] = list(await w3.eth.accounts)
+    return _accounts[endpoint]
+
+
+async def get_chain_id_async(w3=None):
+    w3 = w3 or get_async_w3()
+    endpoint = w3.provider.endpoint_uri
+    if endpoint not in _chain_ids:
+        _chain_ids[endpoint] = await w3.eth.chain_id
+    return _chain_ids[endpoint]
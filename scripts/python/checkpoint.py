@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+
+# Durable state of the simulated workers, so that a killed async_workers process resumes where it stopped: one small
+# JSON file per worker and task (registration, round, trained model CID and votes, commit and last round score sent
+# with their hash or mined), replaced atomically and fsynced at every step. The chain stays the reference on restart,
+# the file only says what the chain cannot: a model trained but not committed yet, a transaction sent but not mined.
+# The local copies of the uploaded models under rounds/ are bounded in size, least recently written rounds first.
+
+STATE_DIR = os.environ.get('FEDML_WORKER_STATE', 'state/workers')
+ROUNDS_DIR = 'rounds'
+ROUNDS_LIMIT = 512 * 2**20  # bytes kept under rounds/
+
+
+class WorkerCheckpoint:
+    def __init__(self, contract, taskId, address, root=STATE_DIR):
+        self.path = os.path.join(root, contract, str(taskId), f'{address}.json')
+        self.state = {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+        return self.state
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **fields):
+        self.state.update(fields)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())  # a kill right after the update must not lose it
+        os.replace(tmp_path, self.path)
+
+    def trained(self, round):
+        # (model CID, votes) of a round already trained, None otherwise
+        if self.state.get('round') == round and self.state.get('trained'):
+            return self.state.get('work'), self.state['votes']
+        return None
+
+
+def round_usage(root=ROUNDS_DIR):
+    # {round number: (bytes, last write time)} of the round directories. rounds/ has no task component, so the
+    # round numbers say nothing about age: round0 of a task started later is newer than round5 of an earlier one
+    usage = {}
+    if not os.path.isdir(root):
+        return usage
+    for name in os.listdir(root):
+        if not name.startswith('round') or not name[5:].isdigit():
+            continue
+        path = os.path.join(root, name)
+        try:
+            stats = [os.stat(path)] + [os.stat(os.path.join(path, f)) for f in os.listdir(path)]
+        except FileNotFoundError:
+            continue  # removed meanwhile
+        usage[int(name[5:])] = (sum(s.st_size for s in stats[1:]), max(s.st_mtime for s in stats))
+    return usage
+
+
+def round_sizes(root=ROUNDS_DIR):
+    # {round number: bytes} of the round directories
+    return {round: size for round, (size, _) in round_usage(root).items()}
+
+
+def gc_rounds(limit=ROUNDS_LIMIT, root=ROUNDS_DIR, current=None):
+    # Removes the least recently written round directories until rounds/ fits in limit bytes. The most recently
+    # written one and current (the round of the last RoundStarted, which may be training right now) are always kept.
+    # Returns the removed rounds
+    usage = round_usage(root)
+    total = sum(size for size, _ in usage.values())
+    removed = []
+    for round in sorted(usage, key=lambda round: usage[round][1])[:-1]:
+        if total <= limit:
+            break
+        if round == current:
+            continue
+        shutil.rmtree(os.path.join(root, f'round{round}'), ignore_errors=True)
+        total -= usage[round][0]
+        removed.append(round)
+    return removed
@@ -1,20 +1,11 @@
-from web3 import Web3
-import json
+import asyncio
+import chain
 import utils
-import random
-from utils import encode_CID_to_2_bytes_32, decode_2_bytes_32_to_CID
+import estimate_cost
+from transactions import TxSubmitter
 
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
-data = json.load(f)
-abi = data['abi']
-f.close()
-
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-contract = w3.eth.contract(address=contract_address, abi=abi)
-
-accounts = w3.eth.accounts
-my_address = accounts[50]
+w3 = chain.get_async_w3()
+contract = chain.get_async_contract(w3)
 
 cid = 'QmPP8kQvfs7fbg6kTjfUdJ4rvLiRbLXGzgcHNBQAPPGtNv'
 part1, part2 = utils.encode_CID_to_2_bytes_32(cid)
@@ -23,42 +14,46 @@ rounds = 2
 workersPerRound = 2
 entranceFee = 1000000000000000000
 
-tx_hash = contract.functions.deployTask(part1, part2, rounds, workersPerRound, entranceFee).transact({"from":my_address})
-receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-
-
-#compute entrance fee based on current gas price
-gas_price = w3.eth.gas_price
-
-#estimate cost for registering
-registerTx = contract.functions.register(0).build_transaction({
-    'from': my_address,  # L'indirizzo dell'account che esegue la transazione
-    'nonce': w3.eth.get_transaction_count(my_address)
-})
-register_gas_estimate = w3.eth.estimate_gas(registerTx)
-register_cost = register_gas_estimate * gas_price
-
-print(f"Gas price: {gas_price}")
-print(f"Registering cost: {register_cost}")
-""" 
-Estimating cost for the commit function requires the task to be started
-#estimate cost for committing work
-votes= [random.randint(1,1000) for i in range(10)]
-commitTx = contract.functions.commitWork(0, part1, part2, votes).buildTransaction({
-    'from': my_address,  # L'indirizzo dell'account che esegue la transazione
-    'nonce': w3.eth.getTransactionCount(my_address)
-})
-commit_gas_estimate = w3.eth.estimate_gas(commitTx)
-commit_cost = commit_gas_estimate * gas_price """
-
-entrance_fee = register_cost
-funding = (entrance_fee + register_cost) * workersPerRound * rounds * 1000
-
-#set the fee and fund the task
-print(f"Entrance fee set at: {entrance_fee}")
-print(f"Funding {funding} wei")
-contract.functions.setEntranceFee(0,entrance_fee).transact({"from":my_address})
-contract.functions.fund(0).transact({"value":funding,"from":my_address})
-
-
-
+# the funding covers this many times the gas of the most expensive kind of worker, for every worker
+FUNDING_MARGIN = 2
+
+async def main():
+    accounts = await chain.get_accounts_async(w3)
+    my_address = accounts[50]
+    txs = TxSubmitter(w3)
+    gas_price = await w3.eth.gas_price
+    print(f"Gas price: {gas_price}")
+
+    profile = estimate_cost.load_profile()
+    if profile is not None:
+        # measured by the gas sweep of estimate_cost.py, projected to the size of this task
+        projection = estimate_cost.project(profile, rounds, workersPerRound)
+        print(f"Projected gas: {projection['total']} for the task, per worker {projection['per_worker']}")
+        entrance_fee = projection['per_call']['register'] * gas_price
+        funding = max(projection['per_worker'].values()) * gas_price * workersPerRound * rounds * FUNDING_MARGIN
+    else:
+        print(f"No gas profile at {estimate_cost.GAS_PROFILE_PATH} (run estimate_cost.py), using the default entrance fee and funding")
+        entrance_fee = entranceFee
+        funding = None
+
+    receipt = await txs.transact(contract.functions.deployTask(part1, part2, rounds, workersPerRound, entrance_fee), {"from":my_address})
+    taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+    print(f"Task {taskId} deployed")
+
+    if funding is None:
+        #estimate cost for registering (the entrance fee has to be sent along, otherwise the call reverts)
+        register_gas_estimate = await contract.functions.register(taskId).estimate_gas({'from': my_address, 'value': entrance_fee})
+        register_cost = register_gas_estimate * gas_price
+        print(f"Registering cost: {register_cost}")
+        funding = 2 * register_cost * workersPerRound * rounds * 1000
+
+    #fund the task
+    print(f"Entrance fee: {entrance_fee}")
+    print(f"Funding {funding} wei")
+    receipt = await txs.transact(contract.functions.fund(taskId), {"value":funding,"from":my_address})
+    print(f"Task {taskId} funded (gas used: {receipt['gasUsed']})")
+    await txs.stop()
+    print(f"Transactions: {txs.summary()}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
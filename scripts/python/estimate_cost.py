@@ -1,47 +1,176 @@
 import os
-from web3 import Web3
 import json
 import random
-import ipfshttpclient
-from utils import encode_CID_to_2_bytes_32, decode_2_bytes_32_to_CID
-
-ipfsclient = ipfshttpclient.connect()
-
-# Get contract abi
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
-data = json.load(f)
-abi = data['abi']
-f.close()
-
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-smartContract = w3.eth.contract(address=contract_address, abi=abi)
-
-gas_price = w3.eth.gas_price
-
-registerTx = smartContract.functions.register(0).buildTransaction({
-    'from': w3.eth.accounts[-1],  # L'indirizzo dell'account che esegue la transazione
-    'nonce': w3.eth.getTransactionCount(w3.eth.accounts[-1])
-})
-
-register_gas_estimate = w3.eth.estimate_gas(registerTx)
-register_cost = register_gas_estimate * gas_price
-register_in_ether = Web3.fromWei(register_cost, 'ether')
-print(f"""Register cost estimate: {register_cost}\n
-      Corresponding to {register_in_ether} ETH\n
-      Corresponding to {register_in_ether * 3500} EUR\n""")
-
-
-votes= [random.randint(1,1000) for i in range(10)]
-work = 'QmPP8kQvfs7fbg6kTjfUdJ4rvLiRbLXGzgcHNBQAPPGtNv'
-part1, part2 = encode_CID_to_2_bytes_32(work)
-commitTx = smartContract.functions.commitWork(0, part1, part2, votes).buildTransaction({
-    'from': w3.eth.accounts[-1],  # L'indirizzo dell'account che esegue la transazione
-    'nonce': w3.eth.getTransactionCount(w3.eth.accounts[-1])
-})
-commit_gas_estimate = w3.eth.estimate_gas(commitTx)
-commit_cost = commit_gas_estimate * gas_price
-commit_in_ether = Web3.fromWei(commit_cost, 'ether')
-print(f"""Commit cost estimate: {commit_cost}\n
-      Corresponding to {commit_in_ether} ETH\n
-      Corresponding to {commit_in_ether * 3500} EUR\n""")
+import asyncio
+import argparse
+import numpy as np
+import chain
+from transactions import TxSubmitter
+from utils import encode_CID_to_2_bytes_32
+
+# Gas sweep: complete tasks are run on a local dev chain over a grid of (rounds, workersPerRound), the gas of every
+# lifecycle call is measured from its receipt and fitted as a linear function of the task size, and the fit is
+# saved to a gas profile that projects the cost of any task (deployTask.py sizes the entrance fee and the funding with it).
+#   python ./scripts/python/estimate_cost.py --rounds 2 3 4 --workers-per-round 2 3 5 8
+
+GAS_PROFILE_PATH = os.environ.get('FEDML_GAS_PROFILE', './data/gas_profile.json')
+STATE_STARTED = 1
+WORK = 'QmPP8kQvfs7fbg6kTjfUdJ4rvLiRbLXGzgcHNBQAPPGtNv'
+# the per-call gas is fitted on these features of the task size
+FEATURES = ['1', 'rounds', 'workersPerRound', 'rounds*workersPerRound']
+
+
+def features(rounds, workersPerRound):
+    return [1, rounds, workersPerRound, rounds * workersPerRound]
+
+
+def call_counts(rounds, workersPerRound):
+    # number of calls of every kind in a complete task
+    workers = rounds * workersPerRound
+    return {'deployTask': 1, 'fund': 1, 'register': workers, 'stopFunding': 1, 'setRandomness': 1,
+            'commit_first': workersPerRound, 'commit': (rounds - 2) * workersPerRound, 'commit_last': workersPerRound,
+            'computeLastRoundScore': workersPerRound, 'withdrawReward': workers}
+
+
+# calls paid by a worker, for each kind of worker
+WORKER_CALLS = {
+    'first_round': ['register', 'commit_first', 'withdrawReward'],
+    'middle_round': ['register', 'commit', 'withdrawReward'],
+    'last_round': ['register', 'commit_last', 'computeLastRoundScore', 'withdrawReward'],
+}
+
+
+async def run_task(contract, txs, admin, workers, rounds, workersPerRound, funding):
+    # one complete task, returns the gas used by every call: {label: [gas, ...]}
+    gas = {}
+
+    async def record(label, calls):
+        receipts = await asyncio.gather(*[txs.transact(fn, tx, label) for fn, tx in calls])
+        gas.setdefault(label, []).extend(receipt['gasUsed'] for receipt in receipts)
+        return receipts
+
+    part1, part2 = encode_CID_to_2_bytes_32(WORK)
+    entranceFee = 10**15
+    receipt, = await record('deployTask', [(contract.functions.deployTask(part1, part2, rounds, workersPerRound, entranceFee), {'from': admin})])
+    taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+    await record('fund', [(contract.functions.fund(taskId), {'from': admin, 'value': funding})])
+    await record('register', [(contract.functions.register(taskId), {'from': worker, 'value': entranceFee}) for worker in workers])
+    await record('stopFunding', [(contract.functions.stopFunding(taskId), {'from': admin})])
+    await record('setRandomness', [(contract.functions.setRandomness(taskId, random.getrandbits(64)), {'from': admin})])
+
+    # after the shuffle, the workers of round r are registeredWorkers[r*workersPerRound:(r+1)*workersPerRound]
+    task = await contract.functions.getTask(taskId).call()
+    assert task[6] == STATE_STARTED
+    order = task[8]
+    for r in range(rounds):
+        selected = order[r * workersPerRound:(r + 1) * workersPerRound]
+        label = 'commit_first' if r == 0 else 'commit_last' if r == rounds - 1 else 'commit'
+        # the commits of a round are sequential: the last one starts the next round, and it is the most expensive
+        for worker in selected:
+            workerVotes = [] if r == 0 else [random.randint(1, 1000) for _ in range(workersPerRound)]
+            await record(label, [(contract.functions.commit(taskId, part1, part2, workerVotes), {'from': worker})])
+    await record('computeLastRoundScore', [(contract.functions.computeLastRoundScore(taskId), {'from': worker})
+                                           for worker in order[(rounds - 1) * workersPerRound:]])
+    await record('withdrawReward', [(contract.functions.withdrawReward(taskId), {'from': worker}) for worker in order])
+    return gas
+
+
+def fit(samples):
+    # samples: [(rounds, workersPerRound, {label: [gas, ...]})] -> per label, coefficients of the mean gas of a call.
+    # Raises ValueError when the task sizes of a call do not determine every coefficient (e.g. a single number of
+    # rounds: the rounds and rounds*workersPerRound columns are then proportional to the others), the least-squares
+    # solution would still fit the samples but project any other size arbitrarily
+    profile = {'features': FEATURES, 'calls': {}, 'max_relative_error': {}}
+    labels = sorted({label for _, _, gas in samples for label in gas})
+    for label in labels:
+        points = [(features(r, w), np.mean(gas[label])) for r, w, gas in samples if gas.get(label)]
+        X = np.array([x for x, _ in points], dtype=float)
+        y = np.array([y for _, y in points], dtype=float)
+        coefficients, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+        if rank < len(FEATURES):
+            sizes = ', '.join(f'{r}x{w}' for r, w, gas in samples if gas.get(label))
+            raise ValueError(f"{label}: the measured task sizes ({sizes}) determine {rank} of the {len(FEATURES)} coefficients "
+                             f"({', '.join(FEATURES)}), vary both --rounds and --workers-per-round")
+        profile['calls'][label] = coefficients.tolist()
+        profile['max_relative_error'][label] = float(np.max(np.abs(X @ coefficients - y) / y))
+    return profile
+
+
+def project(profile, rounds, workersPerRound):
+    # projected gas of a task: per call, per kind of worker, and in total
+    x = np.array(features(rounds, workersPerRound), dtype=float)
+    per_call = {label: max(0, int(np.ceil(x @ np.array(coefficients)))) for label, coefficients in profile['calls'].items()}
+    counts = call_counts(rounds, workersPerRound)
+    per_worker = {kind: sum(per_call.get(label, 0) for label in calls) for kind, calls in WORKER_CALLS.items()}
+    if rounds == 2:
+        del per_worker['middle_round']
+    return {'per_call': per_call,
+            'per_worker': per_worker,
+            'workers_total': sum(per_call.get(label, 0) * counts[label] for label in counts if label not in ('deployTask', 'fund', 'stopFunding', 'setRandomness')),
+            'admin_total': sum(per_call.get(label, 0) for label in ('deployTask', 'fund', 'stopFunding')),
+            'total': sum(per_call.get(label, 0) * count for label, count in counts.items())}
+
+
+def load_profile(path=GAS_PROFILE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+async def main(args):
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    admin = accounts[-1]
+    contract = await chain.deploy_contract_async(w3, admin)  # a fresh contract, the sweep does not touch the real tasks
+    txs = TxSubmitter(w3, poll_interval=0.05)
+    random.seed(args.seed)
+
+    samples = []
+    try:
+        for rounds in args.rounds:
+            for workersPerRound in args.workers_per_round:
+                if rounds < 2 or workersPerRound < 2 or rounds * workersPerRound > len(accounts) - 1:
+                    print(f"Skipping {rounds} rounds x {workersPerRound} workers (not a valid task on this node)")
+                    continue
+                gas = await run_task(contract, txs, admin, accounts[:rounds * workersPerRound], rounds, workersPerRound, args.funding)
+                samples.append((rounds, workersPerRound, gas))
+                total = sum(sum(values) for values in gas.values())
+                print(f"{rounds} rounds x {workersPerRound} workers: {total} gas "
+                      f"({', '.join(f'{label} {int(np.mean(values))}' for label, values in gas.items())})")
+    finally:
+        await txs.stop()
+    if len(samples) < len(FEATURES):
+        raise SystemExit(f"The fit needs at least {len(FEATURES)} task sizes, {len(samples)} were measured")
+
+    try:
+        profile = fit(samples)
+    except ValueError as e:
+        raise SystemExit(f"Cannot fit the gas profile: {e}")
+    profile['samples'] = [{'rounds': r, 'workersPerRound': w, 'gas': gas} for r, w, gas in samples]
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print(f"Gas profile saved to {args.output}, worst fit error {max(profile['max_relative_error'].values()) * 100:.2f}%")
+
+    gas_price = await w3.eth.gas_price
+    for rounds, workersPerRound in args.project:
+        projection = project(profile, rounds, workersPerRound)
+        cost = projection['total'] * gas_price
+        eth = w3.from_wei(cost, 'ether')
+        print(f"Projected {rounds} rounds x {workersPerRound} workers: {projection['total']} gas, {eth} ETH "
+              f"({float(eth) * args.eth_eur:.2f} EUR at gas price {gas_price}); per worker {projection['per_worker']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gas sweep of the task lifecycle on a local dev chain')
+    parser.add_argument('--rpc', default=chain.RPC_URL)
+    parser.add_argument('--rounds', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--workers-per-round', type=int, nargs='+', default=[2, 3, 5, 8])
+    parser.add_argument('--funding', type=int, default=10**18)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=GAS_PROFILE_PATH)
+    parser.add_argument('--project', type=lambda s: tuple(int(v) for v in s.split('x')), nargs='*',
+                        default=[(5, 10), (10, 50)], help='task sizes to project, as ROUNDSxWORKERS')
+    parser.add_argument('--eth-eur', type=float, default=3500)
+    asyncio.run(main(parser.parse_args()))
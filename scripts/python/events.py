@@ -0,0 +1,161 @@
+import os
+import json
+import asyncio
+from eth_utils import event_abi_to_log_topic
+from metrics import metrics
+
+# One event source per process: the contract logs are fetched with a single eth_getLogs per new block range,
+# decoded once, and fanned out to the asyncio queues of the subscribers (workers, oracles, ...).
+# The last processed block is stored on disk, so that a restarted process resumes where it stopped: one file per
+# dispatcher name ({contract address: block}), so that the workers and the oracles never write the same file.
+
+DEFAULT_CURSOR_PATH = os.environ.get('FEDML_EVENTS_CURSOR', 'state/events/{name}.json')
+MAX_BLOCK_RANGE = 2000
+
+
+class EventDispatcher:
+    def __init__(self, w3, contract, name='workers', cursor_path=DEFAULT_CURSOR_PATH, poll_interval=1, from_block=None):
+        self.w3 = w3
+        self.name = name  # role of the process, names its cursor file
+        self.contract = contract
+        self.cursor_path = cursor_path.format(name=name) if cursor_path else None
+        self.poll_interval = poll_interval
+        self.from_block = from_block  # first block to scan when there is no stored cursor (default: the current block)
+        self.cursor = None  # last block whose logs were dispatched
+        self._saved = None  # cursor last written to disk
+        self._events = {event_abi_to_log_topic(abi): abi['name'] for abi in contract.abi if abi['type'] == 'event'}
+        self._subscribers = []  # (event name, task id or None, queue)
+        self._block_subscribers = []
+        self._held = None  # events kept for the subscribers that do not exist yet, see start(hold=True)
+        self._before_save = []  # callbacks run before the cursor moves past the dispatched events on disk
+        self._task = None
+
+    def subscribe(self, event_name, task_id=None):
+        queue = asyncio.Queue()
+        self._subscribers.append((event_name, task_id, queue))
+        return queue
+
+    def subscribe_blocks(self):
+        # receives the number of every new block once its logs have been dispatched
+        queue = asyncio.Queue()
+        self._block_subscribers.append(queue)
+        return queue
+
+    def before_cursor_save(self, callback):
+        # callback() runs once the events of a block range are in the subscribers' queues and before the stored
+        # cursor moves past them: a subscriber that must not lose an event across a restart persists it there
+        self._before_save.append(callback)
+
+    def unsubscribe(self, queue):
+        self._subscribers = [s for s in self._subscribers if s[2] is not queue]
+        self._block_subscribers = [q for q in self._block_subscribers if q is not queue]
+
+    async def start(self, hold=False):
+        # hold: the events (the backlog since a stored cursor included) are kept until release(), so that the
+        # subscribers created after start() still receive them; block notifications are never held
+        self._held = [] if hold else None
+        latest = await self.w3.eth.block_number
+        if self.cursor is None:
+            self.cursor = self._load_cursor()
+        if self.cursor is not None and self.cursor > latest:
+            # the stored cursor belongs to a chain that was reset (e.g. a restarted hardhat node)
+            self.cursor = None
+        if self.cursor is None:
+            self.cursor = latest if self.from_block is None else self.from_block - 1
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def release(self):
+        held, self._held = self._held or [], None
+        for name, event in held:
+            self._fan_out(name, event)
+        self._commit()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def poll(self):
+        latest = await self.w3.eth.block_number
+        while self.cursor < latest:
+            to_block = min(latest, self.cursor + MAX_BLOCK_RANGE)
+            with metrics.span('get_logs', dispatcher=self.name):
+                logs = await self.w3.eth.get_logs({'address': self.contract.address,
+                                                   'fromBlock': self.cursor + 1, 'toBlock': to_block})
+            for log in logs:
+                self._dispatch(log)
+            for block in range(self.cursor + 1, to_block + 1):
+                for queue in self._block_subscribers:
+                    queue.put_nowait(block)
+            self.cursor = to_block
+            self._commit()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event dispatcher error (retrying): {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def _dispatch(self, log):
+        if not log['topics']:
+            return
+        name = self._events.get(bytes(log['topics'][0]))
+        if name is None:
+            return
+        event = self.contract.events[name]().process_log(log)
+        metrics.inc('events', dispatcher=self.name, event=name)
+        if self._held is not None:
+            self._held.append((name, event))
+        else:
+            self._fan_out(name, event)
+
+    def _fan_out(self, name, event):
+        task_id = event.args.get('taskId')
+        for event_name, subscribed_task, queue in self._subscribers:
+            if event_name == name and (subscribed_task is None or subscribed_task == task_id):
+                queue.put_nowait(event)
+
+    def _commit(self):
+        # held events are not delivered yet: the stored cursor waits for release()
+        if self._held is not None:
+            return
+        for callback in self._before_save:
+            callback()
+        self._save_cursor()
+
+    def _read_cursors(self):
+        if not self.cursor_path or not os.path.exists(self.cursor_path):
+            return {}
+        try:
+            with open(self.cursor_path) as f:
+                return json.load(f)
+        except ValueError:
+            # unreadable (e.g. written by an older version), the scan restarts from from_block
+            print(f"Ignoring the unreadable event cursor {self.cursor_path}")
+            return {}
+
+    def _load_cursor(self):
+        self._saved = self._read_cursors().get(self.contract.address)
+        return self._saved
+
+    def _save_cursor(self):
+        if not self.cursor_path or self.cursor == self._saved:
+            return
+        cursors = self._read_cursors()
+        cursors[self.contract.address] = self.cursor
+        os.makedirs(os.path.dirname(self.cursor_path) or '.', exist_ok=True)
+        # unique per process: two processes of the same role never share a half-written file
+        tmp_path = f'{self.cursor_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cursors, f)
+        os.replace(tmp_path, self.cursor_path)
+        self._saved = self.cursor
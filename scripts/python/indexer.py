@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import numpy as np
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector
+import chain
+from utils import decode_CID, unpack_votes
+
+# Local history of the tasks: every block is scanned for the transactions sent to the contract, their logs
+# (Deployed, Registered, NewFunding, RoundStarted, LastRoundCommittmentEnded, TaskEnded) and the calldata of the
+# commits are stored in SQLite, with the last indexed block in the same database transaction. A restarted indexer
+# resumes from there. TaskIndex answers the history queries (round work, vote matrices, workers) without any RPC.
+#   python ./scripts/python/indexer.py              # follow the chain
+#   python ./scripts/python/indexer.py --task 0     # print the indexed history of a task
+
+DEFAULT_DB_PATH = os.environ.get('FEDML_INDEX', 'state/index.sqlite')
+BLOCK_BATCH = 100  # blocks fetched concurrently while catching up
+ZERO = bytes(32)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id INTEGER PRIMARY KEY, admin TEXT, rounds INTEGER, workers_per_round INTEGER, entrance_fee TEXT,
+    model_cid TEXT, deployed_block INTEGER, funding_stopped_block INTEGER, last_round_ended_block INTEGER, ended_block INTEGER);
+CREATE TABLE IF NOT EXISTS registrations (task_id INTEGER, worker TEXT, block INTEGER, PRIMARY KEY (task_id, worker));
+CREATE TABLE IF NOT EXISTS fundings (task_id INTEGER, funder TEXT, value TEXT, funder_total TEXT, funders INTEGER, block INTEGER);
+CREATE TABLE IF NOT EXISTS rounds (task_id INTEGER, round INTEGER, started_block INTEGER, PRIMARY KEY (task_id, round));
+CREATE TABLE IF NOT EXISTS commits (
+    task_id INTEGER, round INTEGER, position INTEGER, worker TEXT, part1 BLOB, part2 BLOB, cid TEXT, votes TEXT,
+    block INTEGER, gas_used INTEGER, PRIMARY KEY (task_id, round, position));
+CREATE TABLE IF NOT EXISTS withdrawals (task_id INTEGER, worker TEXT, reward TEXT, block INTEGER, PRIMARY KEY (task_id, worker));
+CREATE INDEX IF NOT EXISTS registrations_worker ON registrations (worker);
+CREATE INDEX IF NOT EXISTS fundings_task ON fundings (task_id);
+CREATE INDEX IF NOT EXISTS commits_worker ON commits (worker);
+CREATE INDEX IF NOT EXISTS withdrawals_worker ON withdrawals (worker);
+'''
+
+
+def connect(path=DEFAULT_DB_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')  # readers (TaskIndex) are not blocked by the indexer
+    db.executescript(SCHEMA)
+    return db
+
+
+class Indexer:
+    def __init__(self, w3, contract, db_path=DEFAULT_DB_PATH, from_block=0, poll_interval=1):
+        self.w3 = w3
+        self.contract = contract
+        self.db = connect(db_path)
+        self.from_block = from_block
+        self.poll_interval = poll_interval
+        self._events = {event_abi_to_log_topic(abi): abi['name'] for abi in contract.abi if abi['type'] == 'event'}
+        self._withdraw = function_abi_to_4byte_selector(contract.get_function_by_name('withdrawReward').abi)
+        self._rounds = {}  # task id -> current round
+        self._sizes = {}  # task id -> (rounds, workers per round)
+        self.stats = {'blocks': 0, 'transactions': 0, 'commits': 0, 'events': 0}
+        self._check_contract()
+        for taskId, rounds, workersPerRound in self.db.execute('SELECT task_id, rounds, workers_per_round FROM tasks'):
+            self._sizes[taskId] = (rounds, workersPerRound)
+        for taskId, round in self.db.execute('SELECT task_id, MAX(round) FROM rounds GROUP BY task_id'):
+            self._rounds[taskId] = round
+
+    @property
+    def cursor(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone()
+        return int(row[0]) if row else self.from_block - 1
+
+    async def catch_up(self):
+        latest = await self.w3.eth.block_number
+        if self.cursor > latest:
+            # the chain was reset (e.g. a restarted hardhat node): the stored history belongs to the old one
+            self._reset()
+        while self.cursor < latest:
+            numbers = range(self.cursor + 1, min(latest, self.cursor + BLOCK_BATCH) + 1)
+            blocks = await asyncio.gather(*[self.w3.eth.get_block(n, full_transactions=True) for n in numbers])
+            for block in blocks:
+                await self._index_block(block)
+        return latest
+
+    async def run(self):
+        while True:
+            try:
+                await self.catch_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Indexer error (retrying): {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _index_block(self, block):
+        txs = [tx for tx in block['transactions'] if tx['to'] == self.contract.address]
+        receipts = await asyncio.gather(*[self.w3.eth.get_transaction_receipt(tx['hash']) for tx in txs])
+        rewards = await self._rewards(block, txs, receipts)
+        # one database transaction per block, the cursor included: a crash never leaves half a block indexed
+        with self.db:
+            for tx, receipt, reward in zip(txs, receipts, rewards):
+                if receipt['status'] == 1:
+                    self._index_transaction(block['number'], tx, receipt, reward)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('cursor', ?)", (str(block['number']),))
+        self.stats['blocks'] += 1
+        self.stats['transactions'] += len(txs)
+
+    def _index_transaction(self, number, tx, receipt, reward):
+        if len(tx['input']) < 4:
+            return  # plain transfer to the contract
+        fn, params = self.contract.decode_function_input(tx['input'])
+        name = fn.fn_name
+        if name in ('commit', 'commitPacked'):
+            # the commit is stored before the logs of its transaction: the last commit of a round starts the next one
+            votes = params['votes'] if name == 'commit' else unpack_votes(params['packedVotes']).tolist()
+            self._commit(number, params['_taskId'], tx['from'], params['workPart1'], params['workPart2'], votes, receipt['gasUsed'])
+        elif name == 'withdrawReward':
+            self.db.execute('INSERT OR REPLACE INTO withdrawals VALUES (?, ?, ?, ?)', (params['_taskId'], tx['from'], str(reward), number))
+        for log in receipt['logs']:
+            event = self._events.get(bytes(log['topics'][0])) if log['topics'] else None
+            if event is not None and log['address'] == self.contract.address:
+                self._event(number, tx, params, self.contract.events[event]().process_log(log))
+
+    def _commit(self, number, taskId, worker, part1, part2, votes, gasUsed):
+        round = self._rounds.get(taskId, 0)
+        rounds, _ = self._sizes.get(taskId, (None, None))
+        if rounds is not None and round == rounds - 1:
+            # the last round only votes, its works are not stored on chain
+            part1, part2, cid = ZERO, ZERO, None
+        else:
+            cid = decode_CID(part1, part2)
+        position = self.db.execute('SELECT COUNT(*) FROM commits WHERE task_id = ? AND round = ?', (taskId, round)).fetchone()[0]
+        self.db.execute('INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (taskId, round, position, worker, bytes(part1), bytes(part2), cid, json.dumps(list(votes)), number, gasUsed))
+        self.stats['commits'] += 1
+
+    def _event(self, number, tx, params, event):
+        name, args = event['event'], event['args']
+        taskId = args['taskId']
+        self.stats['events'] += 1
+        if name == 'Deployed':
+            self._sizes[taskId] = (params['_numberOfRounds'], params['_workersPerRound'])
+            self.db.execute('INSERT OR REPLACE INTO tasks (task_id, admin, rounds, workers_per_round, entrance_fee, model_cid, deployed_block) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (taskId, tx['from'], params['_numberOfRounds'], params['_workersPerRound'], str(params['_entranceFee']),
+                             decode_CID(params['_hashPart1'], params['_hashPart2']), number))
+        elif name == 'Registered':
+            self.db.execute('INSERT OR REPLACE INTO registrations VALUES (?, ?, ?)', (taskId, args['worker'], number))
+        elif name == 'NewFunding':
+            # emitted as (taskId, number of funders, msg.value, total of the funder)
+            self.db.execute('INSERT INTO fundings VALUES (?, ?, ?, ?, ?, ?)',
+                            (taskId, tx['from'], str(args['updatedBalance']), str(args['value']), args['numFunders'], number))
+        elif name == 'StopFunding':
+            self.db.execute('UPDATE tasks SET funding_stopped_block = ? WHERE task_id = ?', (number, taskId))
+        elif name == 'RoundStarted':
+            self._rounds[taskId] = args['roundNumber']
+            self.db.execute('INSERT OR REPLACE INTO rounds VALUES (?, ?, ?)', (taskId, args['roundNumber'], number))
+        elif name == 'LastRoundCommittmentEnded':
+            self.db.execute('UPDATE tasks SET last_round_ended_block = ? WHERE task_id = ?', (number, taskId))
+        elif name == 'TaskEnded':
+            self.db.execute('UPDATE tasks SET ended_block = ? WHERE task_id = ?', (number, taskId))
+
+    async def _rewards(self, block, txs, receipts):
+        # the reward is an internal transfer without a log: balance change of the worker over the block, plus its fee
+        # (exact when the withdrawal is the worker's only transaction of the block, as on an automining dev node)
+        rewards = []
+        for tx, receipt in zip(txs, receipts):
+            if receipt['status'] != 1 or bytes(tx['input'][:4]) != self._withdraw:
+                rewards.append(None)
+                continue
+            before, after = await asyncio.gather(self.w3.eth.get_balance(tx['from'], block['number'] - 1),
+                                                 self.w3.eth.get_balance(tx['from'], block['number']))
+            rewards.append(after - before + receipt['gasUsed'] * receipt['effectiveGasPrice'])
+        return rewards
+
+    def _check_contract(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'contract'").fetchone()
+        if row and row[0] != self.contract.address:
+            raise SystemExit(f"{row[0]} is indexed in this database, use another --db for {self.contract.address}")
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('contract', ?)", (self.contract.address,))
+
+    def _reset(self):
+        with self.db:
+            for table in ('tasks', 'registrations', 'fundings', 'rounds', 'commits', 'withdrawals'):
+                self.db.execute(f'DELETE FROM {table}')
+            self.db.execute("DELETE FROM meta WHERE key = 'cursor'")
+        self._rounds.clear()
+        self._sizes.clear()
+
+
+class TaskIndex:
+    # Read-only queries on the indexed history, safe to use while the indexer is writing
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+    @property
+    def cursor(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone()
+        return int(row[0]) if row else None
+
+    def tasks(self):
+        return [self._task(row) for row in self.db.execute('SELECT * FROM tasks ORDER BY task_id')]
+
+    def task(self, taskId):
+        row = self.db.execute('SELECT * FROM tasks WHERE task_id = ?', (taskId,)).fetchone()
+        return self._task(row) if row else None
+
+    def current_round(self, taskId):
+        return self.db.execute('SELECT MAX(round) FROM rounds WHERE task_id = ?', (taskId,)).fetchone()[0]
+
+    def round_work(self, taskId, round):
+        # same shape as getRoundWork: [(committer, hashPart1, hashPart2, votes)] in commit order
+        return [(worker, part1, part2, json.loads(votes)) for worker, part1, part2, votes in self.db.execute(
+            'SELECT worker, part1, part2, votes FROM commits WHERE task_id = ? AND round = ? ORDER BY position', (taskId, round))]
+
+    def round_cids(self, taskId, round):
+        return [cid for cid, in self.db.execute('SELECT cid FROM commits WHERE task_id = ? AND round = ? ORDER BY position', (taskId, round))]
+
+    def vote_matrix(self, taskId, round):
+        # votes given in a round to the works of the previous one: (committers, array committers x works)
+        rows = self.db.execute('SELECT worker, votes FROM commits WHERE task_id = ? AND round = ? ORDER BY position', (taskId, round)).fetchall()
+        votes = [json.loads(v) for _, v in rows]
+        width = max((len(v) for v in votes), default=0)
+        matrix = np.zeros((len(votes), width), dtype=np.int64)
+        for i, v in enumerate(votes):
+            matrix[i, :len(v)] = v
+        return [worker for worker, _ in rows], matrix
+
+    def registrations(self, taskId):
+        return [worker for worker, in self.db.execute('SELECT worker FROM registrations WHERE task_id = ? ORDER BY block', (taskId,))]
+
+    def fundings(self, taskId):
+        return self._dicts('SELECT funder, value, funder_total, block FROM fundings WHERE task_id = ? ORDER BY block', (taskId,))
+
+    def withdrawals(self, taskId):
+        return self._dicts('SELECT worker, reward, block FROM withdrawals WHERE task_id = ? ORDER BY block', (taskId,))
+
+    def worker_history(self, worker):
+        # every task the worker registered to, with its round, its work and what it withdrew
+        return self._dicts('SELECT r.task_id, c.round, c.cid, c.votes, w.reward FROM registrations r '
+                           'LEFT JOIN commits c ON c.task_id = r.task_id AND c.worker = r.worker '
+                           'LEFT JOIN withdrawals w ON w.task_id = r.task_id AND w.worker = r.worker '
+                           'WHERE r.worker = ? ORDER BY r.task_id', (worker,))
+
+    def close(self):
+        self.db.close()
+
+    def _task(self, row):
+        columns = ['task_id', 'admin', 'rounds', 'workers_per_round', 'entrance_fee', 'model_cid', 'deployed_block',
+                   'funding_stopped_block', 'last_round_ended_block', 'ended_block']
+        task = dict(zip(columns, row))
+        task['entrance_fee'] = int(task['entrance_fee'])
+        return task
+
+    def _dicts(self, query, params):
+        cursor = self.db.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+def print_task(index, taskId):
+    task = index.task(taskId)
+    if task is None:
+        raise SystemExit(f"Task {taskId} is not indexed (indexed up to block {index.cursor})")
+    print(json.dumps(task, indent=2))
+    print(f"Registered: {len(index.registrations(taskId))}, fundings: {index.fundings(taskId)}")
+    for round in range(task['rounds']):
+        committers, votes = index.vote_matrix(taskId, round)
+        if committers:
+            print(f"Round {round}: {index.round_cids(taskId, round)}\n  votes:\n{votes}")
+    print(f"Withdrawals: {index.withdrawals(taskId)}")
+
+
+async def main(args):
+    w3 = chain.get_async_w3(args.rpc)
+    contract = chain.get_async_contract(w3, args.contract)
+    indexer = Indexer(w3, contract, args.db, args.from_block, args.poll_interval)
+    start = time.perf_counter()
+    latest = await indexer.catch_up()
+    print(f"Indexed up to block {latest} in {time.perf_counter() - start:.2f}s: {indexer.stats}")
+    if not args.once:
+        await indexer.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Indexes the task history of the contract into SQLite')
+    parser.add_argument('--rpc', default=chain.RPC_URL)
+    parser.add_argument('--contract', default=chain.CONTRACT_ADDRESS)
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--from-block', type=int, default=0, help='first block indexed when the database is empty')
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--once', action='store_true', help='catch up and exit')
+    parser.add_argument('--task', type=int, default=None, help='print the indexed history of this task and exit')
+    args = parser.parse_args()
+    if args.task is not None:
+        print_task(TaskIndex(args.db), args.task)
+    else:
+        try:
+            asyncio.run(main(args))
+        except KeyboardInterrupt:
+            print('Exiting indexer...')
@@ -0,0 +1,129 @@
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Process-wide, content-addressed cache for IPFS blobs.
+# CIDs are content hashes, so a cached blob never becomes stale and can be shared by every worker of the process.
+
+DEFAULT_MAX_BYTES = int(os.environ.get('FEDML_IPFS_CACHE_BYTES', 512 * 1024 * 1024))
+DEFAULT_STORE_DIR = os.environ.get('FEDML_IPFS_CACHE_DIR')  # e.g. 'data/ipfs_cache', disabled when unset
+
+
+class ModelCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, store_dir=DEFAULT_STORE_DIR):
+        self.max_bytes = max_bytes
+        self.store_dir = store_dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # cid -> bytes (or read-only mmap of the store), least recently used first
+        self._size = 0
+        self._inflight = {}  # cid -> Future of the fetch currently running
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'deduped': 0, 'evictions': 0,
+                      'bytes_served': 0, 'bytes_fetched': 0}
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def get(self, client, cid):
+        with self._lock:
+            blob = self._entries.get(cid)
+            if blob is not None:
+                self._entries.move_to_end(cid)
+                self.stats['hits'] += 1
+                self.stats['bytes_served'] += len(blob)
+                return blob
+            future = self._inflight.get(cid)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[cid] = future
+            else:
+                self.stats['deduped'] += 1
+
+        if not owner:
+            # another thread is already fetching this CID, wait for its result
+            blob = future.result()
+            with self._lock:
+                self.stats['bytes_served'] += len(blob)
+            return blob
+
+        try:
+            blob = self._read_store(cid)
+            from_disk = blob is not None
+            if not from_disk:
+                blob = client.cat(cid)
+                self._write_store(cid, blob)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[cid]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[cid]
+            if from_disk:
+                self.stats['disk_hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                self.stats['bytes_fetched'] += len(blob)
+            self.stats['bytes_served'] += len(blob)
+            self._insert(cid, blob)
+        future.set_result(blob)
+        return blob
+
+    def put(self, cid, blob):
+        # Seed the cache with a blob we produced ourselves (e.g. right after uploading it)
+        with self._lock:
+            if cid not in self._entries:
+                self._insert(cid, blob)
+        self._write_store(cid, blob)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+            stats['cached_bytes'] = self._size
+        stats['bytes_saved'] = stats['bytes_served'] - stats['bytes_fetched']
+        return stats
+
+    # must be called with the lock held
+    def _insert(self, cid, blob):
+        if len(blob) > self.max_bytes:
+            return
+        self._entries[cid] = blob
+        self._size += len(blob)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.stats['evictions'] += 1
+
+    def _store_path(self, cid):
+        return os.path.join(self.store_dir, cid)
+
+    def _read_store(self, cid):
+        if not self.store_dir:
+            return None
+        path = self._store_path(cid)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        # the mapping itself, not a copy: the pages come from the OS page cache when they are read, and the mapping is
+        # unmapped once nothing references it (the cache entry, the tensors decoded from it with torch.frombuffer)
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _write_store(self, cid, blob):
+        if not self.store_dir or os.path.exists(self._store_path(cid)):
+            return
+        # write to a temporary file and rename it, so that readers never see a partial blob
+        tmp_path = f'{self._store_path(cid)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, self._store_path(cid))
+
+
+cache = ModelCache()
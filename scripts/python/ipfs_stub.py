@@ -0,0 +1,69 @@
+import os
+import hashlib
+import threading
+import base58
+
+# In-process stand-in for the subset of the ipfshttpclient API used by the scripts (add/add_bytes/cat).
+# Blobs are addressed by a CIDv0-shaped hash (base58 sha2-256 multihash), so CIDs keep the 46 characters the contract encoding expects.
+
+def compute_cid(data):
+    return base58.b58encode(b'\x12\x20' + hashlib.sha256(data).digest()).decode()
+
+
+class MemoryIPFS:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blobs = {}
+        self.stats = {'adds': 0, 'cats': 0, 'bytes_added': 0, 'bytes_served': 0}
+
+    def add_bytes(self, data):
+        cid = compute_cid(data)
+        self._put(cid, bytes(data))
+        with self._lock:
+            self.stats['adds'] += 1
+            self.stats['bytes_added'] += len(data)
+        return cid
+
+    def add(self, filePath):
+        with open(filePath, 'rb') as f:
+            data = f.read()
+        return {'Name': filePath, 'Hash': self.add_bytes(data), 'Size': str(len(data))}
+
+    def cat(self, cid):
+        data = self._get(cid)
+        with self._lock:
+            self.stats['cats'] += 1
+            self.stats['bytes_served'] += len(data)
+        return data
+
+    def _put(self, cid, data):
+        with self._lock:
+            self._blobs[cid] = data
+
+    def _get(self, cid):
+        with self._lock:
+            return self._blobs[cid]
+
+
+class DirectoryIPFS(MemoryIPFS):
+    # Same store backed by a directory, shared by all the processes of a benchmark (e.g. the training pool)
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _put(self, cid, data):
+        path = os.path.join(self.root, cid)
+        if not os.path.exists(path):
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _get(self, cid):
+        with open(os.path.join(self.root, cid), 'rb') as f:
+            return f.read()
+
+
+def connect(root=None):
+    return DirectoryIPFS(root) if root else MemoryIPFS()
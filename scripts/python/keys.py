@@ -0,0 +1,85 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from eth_account import Account
+from eth_utils import keccak
+
+# Local worker keys: any number of accounts derived from a seed (the same seed gives the same accounts), funded in
+# bulk from a node account, whose transactions are signed here in a thread or process pool and sent raw, so that a
+# simulated task is no longer bounded by the accounts the dev node unlocks.
+
+DEFAULT_SEED = os.environ.get('FEDML_KEY_SEED', 'fedml-workers')
+GAS_ALLOWANCE = 10**17  # wei given to every worker on top of the entrance fee
+TRANSFER_GAS = 21000
+
+
+def derive_keys(count, seed=DEFAULT_SEED, start=0):
+    # private key i = keccak(seed | i), a valid secp256k1 key with overwhelming probability
+    return [Account.from_key(keccak(seed.encode() + i.to_bytes(32, 'big'))) for i in range(start, start + count)]
+
+
+def _sign(key, tx):
+    return bytes(Account.sign_transaction(tx, key).rawTransaction)
+
+
+def _sign_many(key_txs):
+    return [_sign(key, tx) for key, tx in key_txs]
+
+
+class Signer:
+    # Offline signatures of the local accounts, run in a pool so that the event loop keeps submitting
+    def __init__(self, accounts, pool='thread', workers=None):
+        self.keys = {account.address: account.key for account in accounts}
+        self.pool = pool
+        if pool == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers or 4)
+        self.stats = {'signed': 0, 'sign_seconds': 0.0}
+
+    def __contains__(self, address):
+        return address in self.keys
+
+    async def sign(self, tx):
+        # tx: a complete transaction (nonce, gas, gasPrice, chainId), returns the raw signed bytes
+        start = time.perf_counter()
+        raw = await asyncio.get_running_loop().run_in_executor(self.executor, _sign, self.keys[tx['from']], _unsigned(tx))
+        self.stats['signed'] += 1
+        self.stats['sign_seconds'] += time.perf_counter() - start
+        return raw
+
+    async def sign_many(self, txs, chunk=64):
+        # bulk signing: one pool job per chunk, the process pool then pays one pickling round trip per chunk
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        jobs = [[(self.keys[tx['from']], _unsigned(tx)) for tx in txs[i:i + chunk]] for i in range(0, len(txs), chunk)]
+        chunks = await asyncio.gather(*[loop.run_in_executor(self.executor, _sign_many, job) for job in jobs])
+        self.stats['signed'] += len(txs)
+        self.stats['sign_seconds'] += time.perf_counter() - start
+        return [raw for signed in chunks for raw in signed]
+
+    def summary(self):
+        stats = dict(self.stats, pool=self.pool)
+        if self.stats['sign_seconds']:
+            stats['signatures_per_s'] = self.stats['signed'] / self.stats['sign_seconds']
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def _unsigned(tx):
+    return {key: value for key, value in tx.items() if key != 'from'}
+
+
+async def fund_accounts(w3, txs, funder, addresses, amount):
+    # Tops up every account below the amount with one transfer each, all submitted before the first is mined
+    balances = await asyncio.gather(*[w3.eth.get_balance(address) for address in addresses])
+    futures = [await txs.submit(None, {'from': funder, 'to': address, 'value': amount - balance, 'gas': TRANSFER_GAS})
+               for address, balance in zip(addresses, balances) if balance < amount]
+    receipts = await asyncio.gather(*futures)
+    failed = sum(receipt['status'] != 1 for receipt in receipts)
+    if failed:
+        raise RuntimeError(f"{failed} funding transfers reverted")
+    return len(receipts)
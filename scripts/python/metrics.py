@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instrumentation of the workers and the oracles: timing spans, counters and histograms with labels
+# (e.g. worker and round), written as a JSON-lines trace and exported in the Prometheus text format
+# (file and/or HTTP endpoint). The training pool processes send their counters and histograms back to the parent. Disabled by default: a span is then a shared no-op context manager.
+# One round can also be profiled with cProfile or the torch profiler.
+
+# latency buckets in seconds, the same as the default ones of the Prometheus clients
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.registry.observe(f'{self.name}_seconds', duration, **self.labels)
+        self.registry.record('span', self.name, duration=duration, error=exc_type.__name__ if exc_type else None, **self.labels)
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled=False, trace_path=None, prometheus_path=None, prefix='fedml'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.prometheus_path = prometheus_path
+        self.profile_round = None
+        self.profiler = 'cprofile'
+        self.profile_dir = 'profiles'
+        self._profiling = False  # a single capture at a time (cProfile cannot run in several threads at once)
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._trace = None
+        self._server = None
+        if trace_path:
+            self.open_trace(trace_path)
+
+    def span(self, name, **labels):
+        if not self.enabled:
+            return _NOOP
+        return _Span(self, name, labels)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def drain(self):
+        # counters and histograms recorded since the last drain, removed from this registry: a pool process returns
+        # them with every job result and the parent merges them, the trace is the only file the processes share
+        with self._lock:
+            delta = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+        return delta if delta[0] or delta[1] else None
+
+    def merge(self, delta):
+        if delta is None:
+            return
+        counters, histograms = delta
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in histograms.items():
+                histogram = self._histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def record(self, kind, name, **fields):
+        # one line of the JSON trace
+        if not self.enabled or self._trace is None:
+            return
+        line = json.dumps(dict(ts=time.time(), pid=os.getpid(), kind=kind, name=name, **fields), default=str)
+        with self._lock:
+            self._trace.write(line + '\n')
+
+    def open_trace(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._trace = open(path, 'a', buffering=1)  # line buffered: every record reaches the file
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f'{self.prefix}_{name}_total'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} counter')
+                typed.add(metric)
+            lines.append(f'{metric}{_labels(labels)} {value}')
+        for (name, labels), values in histograms:
+            metric = f'{self.prefix}_{name}'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} histogram')
+                typed.add(metric)
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f'{metric}_bucket{_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{metric}_bucket{_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+            lines.append(f'{metric}_sum{_labels(labels)} {values[-2]}')
+            lines.append(f'{metric}_count{_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=None):
+        path = path or self.prometheus_path
+        if not self.enabled or not path:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        # /metrics endpoint, served by one daemon thread
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.write_prometheus()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--metrics', action='store_true', help='collect spans, counters and histograms')
+        parser.add_argument('--trace', default=None, help='JSON-lines trace file (implies --metrics)')
+        parser.add_argument('--prometheus', default=None, help='Prometheus text file written at exit (implies --metrics)')
+        parser.add_argument('--metrics-port', type=int, default=None, help='serve /metrics on this port (implies --metrics)')
+        parser.add_argument('--profile-round', type=int, default=None, help='profile this round')
+        parser.add_argument('--profiler', choices=['cprofile', 'torch'], default='cprofile')
+
+    def configure(self, args):
+        # the settings are also exported to the environment, so that spawned pool processes record into the same trace
+        if args.metrics or args.trace or args.prometheus or args.metrics_port:
+            self.enabled = True
+            os.environ['FEDML_METRICS'] = '1'
+        if args.trace:
+            self.open_trace(args.trace)
+            os.environ['FEDML_TRACE'] = args.trace
+        if args.prometheus:
+            self.prometheus_path = args.prometheus
+        if args.metrics_port:
+            self.serve(args.metrics_port)
+        if args.profile_round is not None:
+            self.profile_round = args.profile_round
+            self.profiler = args.profiler
+            os.environ['FEDML_PROFILE_ROUND'] = str(args.profile_round)
+            os.environ['FEDML_PROFILER'] = args.profiler
+
+    @contextlib.contextmanager
+    def profile(self, name, round):
+        # cProfile (the calling thread) or the torch profiler around the chosen round only
+        with self._lock:
+            selected = self.profile_round is not None and round == self.profile_round and not self._profiling
+            self._profiling = self._profiling or selected
+        if not selected:
+            yield
+            return
+        try:
+            with self._capture(name, round):
+                yield
+        finally:
+            with self._lock:
+                self._profiling = False
+                self.profile_round = None  # one capture per process: the first worker of the round
+
+    @contextlib.contextmanager
+    def _capture(self, name, round):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'{name}_round{round}')
+        if self.profiler == 'torch':
+            import torch.profiler
+            with torch.profiler.profile(record_shapes=True) as profiler:
+                yield
+            profiler.export_chrome_trace(f'{path}.json')
+            print(f"Torch profile of round {round} saved to {path}.json")
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f'{path}.prof')
+                print(f"Profile of round {round} saved to {path}.prof")
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# process-wide registry, configured by the entry points (or the environment, e.g. in the training pool processes)
+metrics = Metrics(enabled=bool(os.environ.get('FEDML_METRICS')), trace_path=os.environ.get('FEDML_TRACE'),
+                  prometheus_path=os.environ.get('FEDML_PROMETHEUS'))
+if os.environ.get('FEDML_PROFILE_ROUND'):
+    metrics.profile_round = int(os.environ['FEDML_PROFILE_ROUND'])
+    metrics.profiler = os.environ.get('FEDML_PROFILER', 'cprofile')
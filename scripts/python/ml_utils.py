@@ -1,23 +1,77 @@
 import torch
 import torchvision
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import DataLoader, Dataset, Subset
 import torch.nn as nn
 from sklearn.model_selection import train_test_split
 import io
+import os
+import math
+import numpy as np
 import torch.nn.functional as F
+from torch.func import functional_call, vmap
 import json
+import threading
+import collections
+from ipfs_cache import cache
+import model_codec
 
 
 EPOCHS = 1
 LEARNING_RATE = 1e-2
+DECODED_MODELS = 8  # decoded state dicts kept in memory: the parents of the next delta-encoded models (LRU)
+
+_decoded = collections.OrderedDict()
+_decodedLock = threading.Lock()
 
 
 def saveToIPFS(client, filePath):
 	res = client.add(filePath)
+	# our own upload is a candidate of the next round, keep it in the local cache
+	with open(filePath, 'rb') as f:
+		cache.put(res['Hash'], f.read())
 	return res
 
 def downloadFromIPFS(client, hashFile):
-	return io.BytesIO(client.cat(hashFile))
+	# served from the process-wide content-addressed cache, IPFS is hit only on a miss
+	return io.BytesIO(cache.get(client, hashFile))
+
+def saveModelToIPFS(client, stateDict, encoding='fp32', parent=None):
+	# uploaded straight from memory, parent: (CID, decoded state dict) of the starting model for the delta encodings
+	parentCid, parentStateDict = parent if parent else (None, None)
+	blob = model_codec.encode(stateDict, encoding, parentStateDict, parentCid)
+	hashFile = client.add_bytes(blob)
+	cache.put(hashFile, blob)
+	return hashFile, blob
+
+def loadModelFromIPFS(client, hashFile):
+	# The returned state dict is shared, read it only. A delta chain is decoded from its most recent model already
+	# decoded (or its full model) forward, each model once, instead of decoding every parent again at every round
+	pending, stateDict = [], None
+	while hashFile is not None:
+		stateDict = _getDecoded(hashFile)
+		if stateDict is not None:
+			break
+		blob = cache.get(client, hashFile)
+		pending.append((hashFile, blob))
+		hashFile = model_codec.parent_cid(blob)
+	for cid, blob in reversed(pending):
+		stateDict = model_codec.decode(blob, lambda parent, stateDict=stateDict: stateDict)
+		_putDecoded(cid, stateDict)
+	return stateDict
+
+def _getDecoded(hashFile):
+	with _decodedLock:
+		stateDict = _decoded.get(hashFile)
+		if stateDict is not None:
+			_decoded.move_to_end(hashFile)
+		return stateDict
+
+def _putDecoded(hashFile, stateDict):
+	with _decodedLock:
+		_decoded[hashFile] = stateDict
+		_decoded.move_to_end(hashFile)
+		while len(_decoded) > DECODED_MODELS:
+			_decoded.popitem(last=False)
 
 class cnn(nn.Module):
 	def __init__(self):
@@ -41,10 +95,148 @@ class cnn(nn.Module):
 		x = self.fc2(x)
 		return F.log_softmax(x, dim=1)  # Using log_softmax for numerical stability
 
+class tensorMNIST(Dataset):
+	# Same samples as MNIST+ToTensor+Normalize, but read from (shared) uint8 tensors instead of PIL images
+	def __init__(self, data, targets, indices):
+		self.data = data
+		self.targets = targets
+		self.indices = indices
+
+	def __len__(self):
+		return len(self.indices)
+
+	def __getitem__(self, i):
+		j = self.indices[i]
+		x = self.data[j].float().div(255).unsqueeze(0)
+		return (x - 0.1307) / 0.3081, int(self.targets[j])
+
+class tensorBatches:
+	# Drop-in replacement of a DataLoader over a shard: batches are sliced out of the whole (normalized) dataset tensor
+	def __init__(self, data, targets, indices, batch_size, shuffle=False):
+		self.data = data
+		self.targets = targets
+		self.indices = indices
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+
+	def __len__(self):
+		return math.ceil(len(self.indices) / self.batch_size)
+
+	def __iter__(self):
+		order = self.indices[torch.randperm(len(self.indices))] if self.shuffle else self.indices
+		for i in range(0, len(order), self.batch_size):
+			idx = order[i:i + self.batch_size]
+			yield self.data[idx], self.targets[idx]
+
+def collateDataLoader(loader):
+	# Materialize a (test) DataLoader into two contiguous tensors, so that it can be scored many times without re-collating
+	if isinstance(loader, tensorBatches):
+		return loader.data[loader.indices], loader.targets[loader.indices]
+	batches = list(loader)
+	data = torch.cat([data for data, _ in batches])
+	target = torch.cat([target for _, target in batches])
+	return data, target
+
+def evaluateModels(model, stateDicts, data, target, batchSize=256, chunkSize=None, inferenceMode=False):
+	# Score all the candidate state dicts in a single pass over the test set, returns the accuracies (in %) as a tensor
+	# inferenceMode: torch.inference_mode instead of no_grad (no version counters nor views tracking)
+	device = next(model.parameters()).device
+	params = {name: torch.stack([sd[name] for sd in stateDicts]).to(device) for name in stateDicts[0]}
+	model.eval()
+	with torch.inference_mode() if inferenceMode else torch.no_grad():
+		correct = countCorrect(model, params, data, target, batchSize, chunkSize)
+	return 100 * correct.cpu().double() / target.size(0)
+
+def countCorrect(model, params, data, target, batchSize=256, chunkSize=None):
+	# Correct predictions of every stacked model (params: name -> (models, ...)) on the given samples
+	device = next(model.parameters()).device
+
+	def forward(p, x):
+		return functional_call(model, p, (x,))
+
+	batchedForward = vmap(forward, in_dims=(0, None), chunk_size=chunkSize)
+	correct = torch.zeros(next(iter(params.values())).size(0), dtype=torch.long, device=device)
+	for i in range(0, target.size(0), batchSize):
+		x = data[i:i + batchSize].to(device)
+		y = target[i:i + batchSize].to(device)
+		output = batchedForward(params, x)  # (models, batch, classes)
+		correct += (output.argmax(dim=2) == y).sum(dim=1)
+	return correct
+
+def evaluateModelsAdaptive(model, stateDicts, data, target, batchSize=256, chunkSize=None, inferenceMode=False, delta=0.05,
+		firstStage=None, seed=0):
+	# Early stopping of the candidates: they are scored on a growing random subset of the test set (doubled at every
+	# stage), a candidate whose accuracy is below the best one by more than the two confidence radii (Hoeffding, union
+	# bound over candidates and stages, failure probability delta) is dropped and keeps the accuracy measured on its
+	# subset. The close contenders go through the whole test set, their accuracies are the exhaustive ones.
+	# Returns the accuracies (in %) and the number of (model, sample) evaluations spent
+	device = next(model.parameters()).device
+	size = target.size(0)
+	order = torch.randperm(size, generator=torch.Generator().manual_seed(seed))
+	data, target = data[order], target[order]
+	params = {name: torch.stack([sd[name] for sd in stateDicts]).to(device) for name in stateDicts[0]}
+	correct = torch.zeros(len(stateDicts), dtype=torch.long)
+	seen = torch.full((len(stateDicts),), size, dtype=torch.long)
+	alive = torch.arange(len(stateDicts))
+	end = min(size, firstStage or max(batchSize, size >> max(1, math.ceil(math.log2(len(stateDicts))))))
+	stages = math.ceil(math.log2(size / end)) + 1
+	start, evaluations = 0, 0
+	model.eval()
+	with torch.inference_mode() if inferenceMode else torch.no_grad():
+		while start < size:
+			survivors = {name: p[alive.to(device)] for name, p in params.items()}
+			correct[alive] += countCorrect(model, survivors, data[start:end], target[start:end], batchSize, chunkSize).cpu()
+			evaluations += len(alive) * (end - start)
+			if len(alive) > 1 and end < size:
+				accuracy = correct[alive].double() / end
+				radius = math.sqrt(math.log(2 * len(stateDicts) * stages / delta) / (2 * end))
+				keep = accuracy >= accuracy.max() - 2 * radius
+				seen[alive[~keep]] = end
+				alive = alive[keep]
+			start, end = end, min(size, 2 * end)
+	return 100 * correct.double() / seen.double(), evaluations
+
+def parseScoring(spec):
+	# 'exhaustive' or 'adaptive[:delta]', returns (mode, delta)
+	mode, _, delta = (spec or 'exhaustive').partition(':')
+	if mode not in ('exhaustive', 'adaptive'):
+		raise ValueError(f"Unknown scoring: {spec}")
+	return mode, float(delta) if delta else 0.05
+
 def getDevice():
 	# Check for GPU availability
 	device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 	print(f"Using device: {device}")
+	return device
+
+# Optional speedups of the local training and scoring, the baseline path is used when none is selected:
+#   metrics: training accuracy accumulated on the device, read once per epoch instead of once per batch
+#   inference: candidate scoring under torch.inference_mode
+#   channels_last: NHWC layout for the model and the image batches
+#   compile: torch.compile of the training forward
+#   bf16: bfloat16 autocast, only where the device supports it
+SPEEDUPS = ['metrics', 'inference', 'channels_last', 'compile', 'bf16']
+FAST = 'metrics,inference,channels_last'
+
+def parseSpeedups(spec):
+	# 'none', 'fast' or a comma separated list of SPEEDUPS
+	if not spec or spec == 'none':
+		return frozenset()
+	names = set((FAST if spec == 'fast' else spec).split(','))
+	unknown = names - set(SPEEDUPS)
+	if unknown:
+		raise ValueError(f"Unknown speedups: {', '.join(sorted(unknown))}")
+	return frozenset(names)
+
+def bf16Supported(device):
+	device = torch.device(device or 'cpu')
+	if device.type == 'cuda':
+		return torch.cuda.is_bf16_supported()
+	try:
+		# native bf16 kernels (AVX512-BF16 / AMX), emulated bf16 is slower than fp32
+		return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+	except (AttributeError, RuntimeError):
+		return False
 
 def getDataLoaders(num_workers, batch_size=32, batch_size_test=256, train_test_ratio=0.8):
 	transform = torchvision.transforms.Compose([
@@ -77,4 +269,44 @@ def getDataLoaders(num_workers, batch_size=32, batch_size_test=256, train_test_r
 	worker_dataloaders = [(DataLoader(worker_subsets[i][0], batch_size=batch_size, shuffle=True), 
 						DataLoader(worker_subsets[i][1], batch_size=batch_size_test, shuffle=False)) for i in range(num_workers)]
 	
-	return worker_dataloaders
\ No newline at end of file
+	return worker_dataloaders
+
+def loadNormalizedMNIST(root='data/'):
+	# Decode and normalize MNIST once, then memory-map the cached arrays on every following run
+	imagesPath = os.path.join(root, 'MNIST', 'normalized_images.npy')
+	targetsPath = os.path.join(root, 'MNIST', 'normalized_targets.npy')
+	if not (os.path.exists(imagesPath) and os.path.exists(targetsPath)):
+		mnist_dataset = torchvision.datasets.MNIST(root = root, download = True, train = True)
+		images = ((mnist_dataset.data.float() / 255 - 0.1307) / 0.3081).unsqueeze(1).contiguous()
+		np.save(imagesPath, images.numpy())
+		np.save(targetsPath, mnist_dataset.targets.numpy())
+	# copy-on-write mapping: pages are shared with the page cache and the tensors stay writable for torch
+	data = torch.from_numpy(np.load(imagesPath, mmap_mode='c'))
+	targets = torch.from_numpy(np.load(targetsPath, mmap_mode='c'))
+	return data, targets
+
+def getTensorLoaders(num_workers, batch_size=32, batch_size_test=256, train_test_ratio=0.8, root='data/'):
+	# Fast path of getDataLoaders: same sharding, but the shards are index tensors over one contiguous normalized tensor
+	data, targets = loadNormalizedMNIST(root)
+	return shardTensors(data, targets, num_workers, batch_size, batch_size_test, train_test_ratio)
+
+def getSyntheticLoaders(num_workers, num_samples=60000, batch_size=32, batch_size_test=256, train_test_ratio=0.8, seed=0):
+	# MNIST-shaped data generated locally (no download): one random prototype per class plus noise, so that the cnn can still learn it
+	generator = torch.Generator().manual_seed(seed)
+	prototypes = torch.randn(10, 1, 28, 28, generator=generator)
+	targets = torch.randint(0, 10, (num_samples,), generator=generator)
+	data = prototypes[targets] + 2 * torch.randn(num_samples, 1, 28, 28, generator=generator)
+	return shardTensors(data, targets, num_workers, batch_size, batch_size_test, train_test_ratio)
+
+def shardTensors(data, targets, num_workers, batch_size=32, batch_size_test=256, train_test_ratio=0.8):
+	split_size = len(data) // num_workers
+	indices = torch.randperm(len(data))
+	train_size = int(split_size * train_test_ratio)
+
+	worker_dataloaders = []
+	for i in range(num_workers):
+		worker_idx = indices[i * split_size:(i + 1) * split_size]
+		worker_idx = worker_idx[torch.randperm(split_size)]
+		worker_dataloaders.append((tensorBatches(data, targets, worker_idx[:train_size], batch_size, shuffle=True),
+								tensorBatches(data, targets, worker_idx[train_size:], batch_size_test, shuffle=False)))
+	return worker_dataloaders
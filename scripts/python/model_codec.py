@@ -0,0 +1,123 @@
+import io
+import json
+import struct
+import warnings
+import torch
+
+# Model wire format: a small JSON header followed by the raw tensors, each one aligned to 64 bytes.
+#   magic (4 bytes) | header length (uint32, little endian) | JSON header | padding | tensor data
+# Unlike a pickle, a blob decodes without executing anything and the fp32 tensors are views of the blob itself.
+# Encodings: fp32, fp16, int8 (per-tensor symmetric scale), each optionally as a delta from the parent model
+# (the model the worker started from, referenced by its CID), e.g. 'int8+delta'.
+
+MAGIC = b'FMLW'
+ALIGNMENT = 64
+ENCODINGS = ['fp32', 'fp16', 'int8', 'fp32+delta', 'fp16+delta', 'int8+delta']
+_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'int8': torch.int8}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def parse_encoding(encoding):
+    base, _, delta = encoding.partition('+')
+    if base not in _DTYPES or delta not in ('', 'delta'):
+        raise ValueError(f"Unknown model encoding: {encoding}")
+    return base, delta == 'delta'
+
+
+def encode(state_dict, encoding='fp32', parent=None, parent_cid=None):
+    # parent: the decoded parent state dict, required by the delta encodings
+    base, delta = parse_encoding(encoding)
+    if delta and (parent is None or parent_cid is None):
+        raise ValueError(f"The {encoding} encoding needs the parent model and its CID")
+    entries = []
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        entry = {'name': name, 'shape': list(tensor.shape)}
+        if tensor.is_floating_point():
+            values = tensor.float()
+            if delta:
+                values = values - parent[name].float()
+            if base == 'int8':
+                scale = values.abs().max().item() / 127 if values.numel() else 0.0
+                entry['scale'] = scale
+                values = (values / scale).round_().clamp_(-127, 127) if scale > 0 else torch.zeros_like(values)
+            values = values.to(_DTYPES[base])
+            entry['dtype'] = base
+        else:
+            # integer buffers (e.g. counters) are stored as they are
+            values = tensor
+            entry['dtype'] = str(tensor.dtype).replace('torch.', '')
+        values = values.contiguous()
+        entry['offset'] = offset
+        entry['nbytes'] = values.numel() * values.element_size()
+        offset = _align(offset + entry['nbytes'])
+        entries.append(entry)
+        tensors.append(values)
+
+    header = json.dumps({'encoding': encoding, 'parent': parent_cid if delta else None, 'tensors': entries},
+                        separators=(',', ':')).encode()
+    data_start = _align(len(MAGIC) + 4 + len(header))
+    blob = bytearray(data_start + offset)
+    blob[:len(MAGIC)] = MAGIC
+    struct.pack_into('<I', blob, len(MAGIC), len(header))
+    blob[len(MAGIC) + 4:len(MAGIC) + 4 + len(header)] = header
+    view = memoryview(blob)
+    for entry, values in zip(entries, tensors):
+        start = data_start + entry['offset']
+        if entry['nbytes']:
+            view[start:start + entry['nbytes']] = values.reshape(-1).view(torch.uint8).numpy()
+    return bytes(blob)
+
+
+def read_header(blob):
+    (length,) = struct.unpack_from('<I', blob, len(MAGIC))
+    header = json.loads(bytes(blob[len(MAGIC) + 4:len(MAGIC) + 4 + length]))
+    header['data_start'] = _align(len(MAGIC) + 4 + length)
+    return header
+
+
+def is_encoded(blob):
+    return bytes(blob[:len(MAGIC)]) == MAGIC
+
+
+def parent_cid(blob):
+    # CID of the model a delta-encoded blob is relative to, None for a full model
+    return read_header(blob)['parent'] if is_encoded(blob) else None
+
+
+def decode(blob, resolve_parent=None):
+    # resolve_parent(cid) -> state dict of the parent, needed by the delta encodings.
+    # Older blobs written with torch.save are still accepted.
+    if not is_encoded(blob):
+        return torch.load(io.BytesIO(blob))
+    header = read_header(blob)
+    parent = None
+    if header['parent'] is not None:
+        if resolve_parent is None:
+            raise ValueError(f"The model is a delta from {header['parent']}, which cannot be resolved here")
+        parent = resolve_parent(header['parent'])
+    state_dict = {}
+    with warnings.catch_warnings():
+        # the blob is read-only (bytes or a read-only mmap): the views are only read, load_state_dict copies them
+        warnings.filterwarnings('ignore', message='The given buffer is not writable')
+        for entry in header['tensors']:
+            dtype = _DTYPES.get(entry['dtype']) or getattr(torch, entry['dtype'])
+            count = entry['nbytes'] // torch.tensor([], dtype=dtype).element_size()
+            if count:
+                values = torch.frombuffer(blob, dtype=dtype, count=count, offset=header['data_start'] + entry['offset'])
+            else:
+                values = torch.empty(0, dtype=dtype)
+            values = values.view(entry['shape'])
+            if 'scale' in entry:
+                values = values.float() * entry['scale']
+            elif dtype == torch.float16:
+                values = values.float()
+            if parent is not None and values.is_floating_point():
+                values = values + parent[entry['name']]
+            state_dict[entry['name']] = values
+    return state_dict
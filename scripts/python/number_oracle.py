@@ -1,35 +1,184 @@
-from web3 import Web3
+import os
 import json
+import time
 import random
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-
-# Get contract abi
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
-data = json.load(f)
-abi = data['abi']
-f.close()
-
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-contract = w3.eth.contract(address=contract_address, abi=abi)
-
-# Master contract should emit event and specify the address of the task contract
-
-event_filter = contract.events['NeedRandomness'].create_filter(fromBlock='latest')
-
-accounts = w3.eth.accounts
-#the oracle address and the task admin address are the same
-# my_address = accounts[len(accounts) - 1]
-
-my_address = accounts[0]; # the first account is the oracle address
-
-print('Number oracle is ready to serve...\n')
-try:
-    while True:
-        for event in event_filter.get_new_entries():
-            # retrive specific task address from event (in smart contract: put address inside event)
-            rnd = random.randint(0,event.args['upperBound'] - 1)
-            print(f"Sending randomness to Smart Contract at address: {contract_address}...")
-            print(f"\nSelected randomness is: {rnd}")
-            contract.functions.setRandomness(event.args['taskId'],rnd).transact({"from":my_address})
-except KeyboardInterrupt:
-    print('Exiting oracle...')
\ No newline at end of file
+import asyncio
+import argparse
+import chain
+from events import EventDispatcher
+from reads import BatchReader
+from transactions import TxSubmitter
+from metrics import metrics
+
+# Randomness oracle: wakes up on every new block, takes all the NeedRandomness events of the block range at once
+# (any task), checks the state of the tasks with one batched read and sends the seeds concurrently, without
+# waiting for one transaction before sending the next. The event cursor and the requests not fulfilled yet are
+# stored on disk, so that a restarted oracle answers the requests it missed.
+
+STATE_DEPLOYED = 0
+STATE_PATH = os.environ.get('FEDML_NUMBER_ORACLE_STATE', 'state/number_oracle.json')
+MAX_RETRIES = 3
+
+
+class RandomnessOracle:
+    def __init__(self, w3, contract, account, dispatcher, reader, txs, state_path=STATE_PATH):
+        self.w3 = w3
+        self.contract = contract
+        self.account = account
+        self.dispatcher = dispatcher
+        self.reader = reader
+        self.txs = txs
+        self.state_path = state_path
+        self.pending = {}  # task id -> (upper bound, time the request was seen, attempts)
+        self.inflight = set()
+        self.latencies = []  # seconds from the request seen to the seed confirmed
+        self.stats = {'requests': 0, 'fulfilled': 0, 'skipped': 0, 'retries': 0, 'failed': 0}
+        self._requests = dispatcher.subscribe('NeedRandomness')
+        self._blocks = dispatcher.subscribe_blocks()
+        self._tasks = set()
+        # a request is on disk before the event cursor moves past it, a kill in between cannot lose it (the stored
+        # requests are loaded first, the next save keeps them)
+        self._load_state()
+        dispatcher.before_cursor_save(self._take_requests)
+
+    async def run(self):
+        while True:
+            if self.pending:
+                await self.serve()
+            await self._blocks.get()
+            while not self._blocks.empty():
+                self._blocks.get_nowait()
+            self._take_requests()
+
+    def _take_requests(self):
+        # the NeedRandomness events dispatched so far become pending requests, stored at once
+        added = False
+        while not self._requests.empty():
+            event = self._requests.get_nowait()
+            taskId = event.args['taskId']
+            if taskId not in self.pending and taskId not in self.inflight:
+                self.stats['requests'] += 1
+                metrics.inc('randomness_requests')
+                self.pending[taskId] = (event.args['upperBound'], time.perf_counter(), 0)
+                added = True
+        if added:
+            self._save_state()
+
+    async def serve(self):
+        # one batched read for the state of every task waiting for a seed, then all the seeds are sent at once
+        taskIds = [taskId for taskId in self.pending if taskId not in self.inflight]
+        if not taskIds:
+            return
+        with metrics.span('read_tasks', oracle='number'):
+            tasks = await self.reader.call_many([('getTask', (taskId,), None) for taskId in taskIds])
+        for taskId, task in zip(taskIds, tasks):
+            if task[6] != STATE_DEPLOYED:
+                print(f"Task {taskId} already started, skipping")
+                self.stats['skipped'] += 1
+                del self.pending[taskId]
+                continue
+            self.inflight.add(taskId)
+            job = asyncio.create_task(self._fulfill(taskId))
+            self._tasks.add(job)
+            job.add_done_callback(self._tasks.discard)
+        self._save_state()
+
+    async def _fulfill(self, taskId):
+        upperBound, seen, attempts = self.pending[taskId]
+        seed = random.randint(0, upperBound - 1)
+        try:
+            receipt = await self.txs.transact(self.contract.functions.setRandomness(taskId, seed), {'from': self.account})
+        except Exception as e:
+            # reverted: the task may have been started in the meantime, its state is read again at the next block
+            attempts += 1
+            self.inflight.discard(taskId)
+            if attempts > MAX_RETRIES:
+                print(f"Task {taskId}: giving up after {attempts} attempts ({e})")
+                self.stats['failed'] += 1
+                del self.pending[taskId]
+            else:
+                print(f"Task {taskId}: setRandomness failed, retrying at the next block ({e})")
+                self.stats['retries'] += 1
+                metrics.inc('randomness_retries')
+                self.pending[taskId] = (upperBound, seen, attempts)
+            self._save_state()
+            return
+        latency = time.perf_counter() - seen
+        self.latencies.append(latency)
+        self.stats['fulfilled'] += 1
+        metrics.observe('randomness_latency_seconds', latency)
+        metrics.record('randomness', 'fulfilled', task=taskId, block=receipt['blockNumber'], latency=latency)
+        self.inflight.discard(taskId)
+        del self.pending[taskId]
+        self._save_state()
+        print(f"Task {taskId}: seed {seed} set in block {receipt['blockNumber']} ({latency * 1000:.0f}ms after the request)")
+
+    def summary(self):
+        stats = dict(self.stats, pending=len(self.pending))
+        latencies = sorted(self.latencies)
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            stats['latency_max'] = latencies[-1]
+        return stats
+
+    def _load_state(self):
+        # requests seen before a restart but not fulfilled, their state is checked again before answering
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as f:
+            stored = json.load(f).get(self.contract.address, {})
+        now = time.perf_counter()
+        for taskId, upperBound in stored.items():
+            self.pending.setdefault(int(taskId), (upperBound, now, 0))
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+        state[self.contract.address] = {str(taskId): upperBound for taskId, (upperBound, _, _) in self.pending.items()}
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+
+async def main(account_index=0, poll_interval=1):
+    w3 = chain.get_async_w3()
+    contract = chain.get_async_contract(w3)
+    accounts = await chain.get_accounts_async(w3)
+    #the oracle address and the task admin address are the same
+    # my_address = accounts[len(accounts) - 1]
+    my_address = accounts[account_index]  # the first account is the oracle address
+
+    # the cursor is persisted: a restarted oracle receives the requests emitted while it was down
+    dispatcher = await EventDispatcher(w3, contract, name='number_oracle', poll_interval=poll_interval).start()
+    reader = BatchReader(contract, dispatcher=dispatcher)
+    txs = TxSubmitter(w3, dispatcher)
+    oracle = RandomnessOracle(w3, contract, my_address, dispatcher, reader, txs)
+    print('Number oracle is ready to serve...\n')
+    try:
+        await oracle.run()
+    finally:
+        await txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+        print(f"Oracle: {oracle.summary()}")
+        metrics.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Randomness oracle of the FedML tasks')
+    parser.add_argument('--account', type=int, default=0, help='index of the node account sending the seeds')
+    parser.add_argument('--poll-interval', type=float, default=1)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    try:
+        asyncio.run(main(args.account, args.poll_interval))
+    except KeyboardInterrupt:
+        print('Exiting oracle...')
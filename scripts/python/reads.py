@@ -0,0 +1,150 @@
+import asyncio
+import aiohttp
+from eth_utils import to_checksum_address
+from eth_utils.abi import collapse_if_tuple
+from web3.exceptions import ContractLogicError
+import chain
+
+# Batched read layer: contract view calls are grouped into a single JSON-RPC batch (one HTTP round trip).
+# Concurrent callers of the same event loop tick share one batch, and identical calls are sent only once.
+# Values are cached for one block.
+
+
+class BatchReader:
+    def __init__(self, contract, endpoint=chain.RPC_URL, dispatcher=None):
+        self.contract = contract
+        self.endpoint = endpoint
+        self.block = None  # last block seen by the reader
+        self.per_block = {}
+        self.stats = {'batches': 0, 'calls': 0, 'cache_hits': 0}
+        self._queue = []
+        self._inflight = {}
+        self._session = None
+        self._types = {}
+        self._flushes = set()  # running _flush tasks, referenced until they finish
+        self._blocks = None
+        if dispatcher is not None:
+            # new blocks invalidate the per-block cache as soon as the dispatcher sees them
+            self._blocks = dispatcher.subscribe_blocks()
+
+    async def call(self, name, *args, sender=None):
+        key = (name, args, sender)
+        found, value = self._cached(key)
+        if found:
+            return value
+        if key not in self._inflight:
+            self._inflight[key] = asyncio.get_running_loop().create_future()
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                asyncio.get_running_loop().call_soon(self._start_flush)
+        return await asyncio.shield(self._inflight[key])
+
+    async def call_many(self, calls):
+        # calls: [(name, args, sender)], answered in one batch
+        return await asyncio.gather(*[self.call(name, *args, sender=sender) for name, args, sender in calls])
+
+    async def close(self):
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _refresh_block(self):
+        if self._blocks is None:
+            return
+        while not self._blocks.empty():
+            self._set_block(self._blocks.get_nowait())
+
+    def _set_block(self, block):
+        if self.block is None or block > self.block:
+            self.block = block
+            self.per_block.clear()
+
+    def _cached(self, key):
+        self._refresh_block()
+        if key in self.per_block:
+            self.stats['cache_hits'] += 1
+            return True, self.per_block[key]
+        return False, None
+
+    def _payload(self, keys):
+        # the block number travels in the same batch, so that the per-block cache knows which block it holds
+        payload = [{'jsonrpc': '2.0', 'id': 0, 'method': 'eth_blockNumber', 'params': []}]
+        for i, (name, args, sender) in enumerate(keys, start=1):
+            tx = {'to': self.contract.address, 'data': self.contract.encodeABI(fn_name=name, args=list(args))}
+            if sender is not None:
+                tx['from'] = sender
+            payload.append({'jsonrpc': '2.0', 'id': i, 'method': 'eth_call', 'params': [tx, 'latest']})
+        self.stats['batches'] += 1
+        self.stats['calls'] += len(keys)
+        chain.rpc_counts['batch'] += 1
+        return payload
+
+    def _store(self, keys, response):
+        results = {item['id']: item for item in response}
+        block = int(results[0]['result'], 16)
+        self._set_block(block)
+        values = {}
+        for i, key in enumerate(keys, start=1):
+            item = results[i]
+            if 'error' in item:
+                values[key] = ContractLogicError(f"{key[0]} reverted: {item['error'].get('message')}")
+                continue
+            values[key] = self._decode(key[0], item['result'])
+            if self._blocks is not None and block == self.block:
+                # without block notifications a cached value could outlive its block, so it is not kept
+                self.per_block[key] = values[key]
+        return values
+
+    def _decode(self, name, result):
+        if name not in self._types:
+            outputs = self.contract.get_function_by_name(name).abi['outputs']
+            self._types[name] = outputs, [collapse_if_tuple(output) for output in outputs]
+        outputs, types = self._types[name]
+        decoded = self.contract.w3.codec.decode(types, bytes.fromhex(result[2:]))
+        # addresses checksummed, as web3 returns them from a contract call
+        decoded = tuple(_checksummed(output, value) for output, value in zip(outputs, decoded))
+        return decoded[0] if len(decoded) == 1 else decoded
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushed)
+
+    def _flushed(self, task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # _flush fails its own calls on a request error, anything else is a bug worth seeing
+            print(f"Batched read failed: {task.exception()!r}")
+
+    async def _flush(self):
+        keys, self._queue = self._queue, []
+        try:
+            if self._session is None:
+                self._session = aiohttp.ClientSession()
+            async with self._session.post(self.endpoint, json=self._payload(keys)) as response:
+                values = self._store(keys, await response.json())
+        except Exception as e:
+            for key in keys:
+                self._inflight.pop(key).set_exception(e)
+            return
+        for key in keys:
+            future = self._inflight.pop(key)
+            if isinstance(values[key], Exception):
+                future.set_exception(values[key])
+            else:
+                future.set_result(values[key])
+
+
+def _checksummed(output, value):
+    # value decoded for an ABI output (or tuple component), with its addresses in checksum form
+    type = output['type']
+    if type.endswith(']'):
+        item = dict(output, type=type[:type.rindex('[')])
+        return tuple(_checksummed(item, v) for v in value)
+    if type == 'tuple':
+        return tuple(_checksummed(component, v) for component, v in zip(output['components'], value))
+    if type == 'address':
+        return to_checksum_address(value)
+    return value
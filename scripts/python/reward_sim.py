@@ -0,0 +1,222 @@
+import time
+import asyncio
+import argparse
+import numpy as np
+
+# Offline mirror of the reward computation of FedMLContract, in integer NumPy arithmetic with the contract's
+# truncations, over a batch of vote tensors at once:
+#   - the works of round r (r < last) are scored with the column sums of the votes given in round r + 1
+#   - the last round keeps the running mean of its votes (int256 division, truncated toward zero, in commit order)
+#     and scores each of its workers 100000 / (1 + sum |votes - mean|)
+#   - coefficient = score * 100000 / round total, reward = entranceFee + (funds / rounds * coefficient) / 100000
+# Monte Carlo sweeps random, honest and adversarial voting; --self-check pins small cases offline, --check replays
+# small tasks on a local chain and compares every withdrawn reward with the simulated one.
+#   python ./scripts/python/reward_sim.py --rounds 10 --workers-per-round 100 --samples 100
+#   python ./scripts/python/reward_sim.py --check --rounds 3 --workers-per-round 3
+#   python ./scripts/python/reward_sim.py --self-check
+
+SCALE = 100000
+VOTE_MAX = 1000  # votes are int(accuracy * 10)
+MAX_ELEMENTS = 2 * 10**7  # votes per simulated chunk, bounds the memory of a sweep
+
+
+def _trunc_div(a, n):
+    # Solidity signed division: rounds toward zero
+    q = np.abs(a) // n
+    return np.where(a < 0, -q, q)
+
+
+def _mul_div(amount, coefficient):
+    # amount * coefficient / SCALE, exact: amount (wei) times a coefficient would overflow int64 directly
+    if amount >= 2**63:
+        coefficient = coefficient.astype(object)
+    q, r = divmod(amount, SCALE)
+    return q * coefficient + (r * coefficient) // SCALE
+
+
+def simulate(votes, funds, fee):
+    # votes[..., r - 1, i, j]: vote of the i-th committer of round r for the j-th work of round r - 1, r = 1..rounds-1
+    # (commit order). Returns the scores, the rewards [..., round, position] and the rounds whose total score is 0,
+    # where the contract reverts on the division (their rewards are set to 0 here).
+    votes = np.asarray(votes, dtype=np.int64)
+    workersPerRound = votes.shape[-1]
+    rounds = votes.shape[-3] + 1
+    scoreboard = votes.sum(axis=-2)
+
+    last = votes[..., -1, :, :]
+    mean = np.zeros(last.shape[:-2] + (workersPerRound,), dtype=np.int64)
+    for n in range(workersPerRound):
+        mean = mean + _trunc_div(last[..., n, :] - mean, n + 1)
+    lastScores = SCALE // (1 + np.abs(last - mean[..., None, :]).sum(axis=-1))
+
+    scores = np.concatenate([scoreboard, lastScores[..., None, :]], axis=-2)
+    totals = scores.sum(axis=-1, keepdims=True)
+    reverted = totals[..., 0] == 0
+    coefficients = scores * SCALE // np.where(totals == 0, 1, totals)
+    rewards = np.where(totals == 0, 0, fee + _mul_div(funds // rounds, coefficients))
+    return scores, rewards, reverted
+
+
+def paid_bounty(rewards, fee):
+    # rewards without the entrance fees given back, per worker: a reverted round pays nothing, not minus the fee
+    return rewards - fee * (rewards > 0)
+
+
+def colluder_share(rewards, colluding, fee):
+    # share of the bounty of every task earned by its colluding workers
+    bounty = paid_bounty(rewards, fee)
+    return (bounty * colluding).sum(axis=(-1, -2)) / np.maximum(bounty.sum(axis=(-1, -2)), 1)
+
+
+def random_votes(rng, samples, rounds, workersPerRound):
+    return rng.integers(0, VOTE_MAX + 1, size=(samples, rounds - 1, workersPerRound, workersPerRound))
+
+
+def honest_votes(rng, samples, rounds, workersPerRound, noise=50):
+    # every work has a true accuracy, each voter measures it on its own test set with some noise
+    quality = rng.uniform(600, 1000, size=(samples, rounds - 1, 1, workersPerRound))
+    measured = quality + rng.normal(0, noise, size=(samples, rounds - 1, workersPerRound, workersPerRound))
+    return np.clip(np.rint(measured), 0, VOTE_MAX).astype(np.int64)
+
+
+def adversarial_votes(rng, samples, rounds, workersPerRound, fraction=0.2, noise=50):
+    # colluding workers vote the maximum for the works of their accomplices of the previous round and 0 for the others
+    votes = honest_votes(rng, samples, rounds, workersPerRound, noise)
+    colluding = rng.random((samples, rounds, workersPerRound)) < fraction
+    collusion = np.where(colluding[:, :-1, None, :], VOTE_MAX, 0)
+    votes = np.where(colluding[:, 1:, :, None], collusion, votes)
+    return votes, colluding
+
+
+def sweep(args):
+    rng = np.random.default_rng(args.seed)
+    workers = args.rounds * args.workers_per_round
+    chunk = max(1, MAX_ELEMENTS // ((args.rounds - 1) * args.workers_per_round ** 2))
+    print(f"{args.samples} tasks of {args.rounds} rounds x {args.workers_per_round} workers ({workers} workers), "
+          f"funds {args.funds} wei, entrance fee {args.fee} wei")
+    for model in args.models:
+        start = time.perf_counter()
+        paid, dust, reverted, shares = [], [], 0, []
+        for offset in range(0, args.samples, chunk):
+            samples = min(chunk, args.samples - offset)
+            colluding = None
+            if model == 'random':
+                votes = random_votes(rng, samples, args.rounds, args.workers_per_round)
+            elif model == 'honest':
+                votes = honest_votes(rng, samples, args.rounds, args.workers_per_round, args.noise)
+            else:
+                votes, colluding = adversarial_votes(rng, samples, args.rounds, args.workers_per_round, args.fraction, args.noise)
+            _, rewards, revertedRounds = simulate(votes, args.funds, args.fee)
+            bounty = paid_bounty(rewards, args.fee).sum(axis=(-1, -2))
+            paid.append(rewards.sum(axis=(-1, -2)))
+            dust.append(args.funds - bounty)
+            reverted += int(revertedRounds.any(axis=-1).sum())
+            if colluding is not None:
+                shares.append(colluder_share(rewards, colluding, args.fee))
+        elapsed = time.perf_counter() - start
+        paid, dust = np.concatenate(paid).astype(float), np.concatenate(dust).astype(float)
+        line = (f"{model:>11}: {elapsed * 1000:7.1f}ms, mean payout {paid.mean() / workers:.4g} wei/worker, "
+                f"undistributed {dust.mean():.4g} wei (max {dust.max():.4g}), tasks with a reverting round {reverted}")
+        if shares:
+            line += f", colluders ({args.fraction:.0%} of the workers) earn {np.concatenate(shares).mean():.1%} of the bounty"
+        print(line)
+
+
+def check_reverting_round():
+    # 2 rounds x 2 workers, nobody votes for the first round: its total score is 0, the contract reverts on it and its
+    # workers (the first one colluding) get nothing. The second worker of the last round colludes and earns half the
+    # bounty, the fee it did not get back in the first round must not count against the colluders
+    votes = np.zeros((1, 2, 2), dtype=np.int64)
+    colluding = np.array([[True, False], [False, True]])
+    _, rewards, reverted = simulate(votes, 10**6, 10**3)
+    assert reverted.tolist() == [True, False] and rewards[0].tolist() == [0, 0], (reverted, rewards)
+    share = colluder_share(rewards, colluding, 10**3)
+    assert share == 0.5, share
+    print(f"reverting round: colluders earn {share:.1%} of the bounty")
+
+
+async def check(args):
+    # small tasks run on a local chain with known votes: every withdrawn reward must match the simulation
+    import chain
+    import ipfs_stub
+    import keys
+    from transactions import TxSubmitter
+    from utils import encode_CID_to_2_bytes_32
+
+    w3 = chain.get_async_w3(args.rpc)
+    accounts = await chain.get_accounts_async(w3)
+    admin = accounts[-1]
+    contract = await chain.deploy_contract_async(w3, admin)
+    workers = args.rounds * args.workers_per_round
+    local = keys.derive_keys(workers, 'fedml-reward-sim')
+    signer = keys.Signer(local, 'thread')
+    txs = TxSubmitter(w3, poll_interval=0.05, signer=signer)
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    try:
+        await keys.fund_accounts(w3, txs, accounts[1], [account.address for account in local], args.fee + 10**17)
+        for case in range(args.cases):
+            votes = random_votes(rng, 1, args.rounds, args.workers_per_round)[0]
+            _, expected, _ = simulate(votes, args.funds, args.fee)
+            part1, part2 = encode_CID_to_2_bytes_32(ipfs_stub.compute_cid(f'reward-sim/{case}'.encode()))
+            receipt = await txs.transact(contract.functions.deployTask(part1, part2, args.rounds, args.workers_per_round, args.fee), {'from': admin})
+            taskId = contract.events.Deployed().process_receipt(receipt)[0].args['taskId']
+            await txs.transact(contract.functions.fund(taskId), {'from': admin, 'value': args.funds})
+            await asyncio.gather(*[txs.transact(contract.functions.register(taskId), {'from': account.address, 'value': args.fee})
+                                   for account in local])
+            await txs.transact(contract.functions.stopFunding(taskId), {'from': admin})
+            await txs.transact(contract.functions.setRandomness(taskId, int(rng.integers(2**32))), {'from': admin})
+            order = (await contract.functions.getTask(taskId).call())[8]
+            for r in range(args.rounds):
+                # sequential commits: the position of a commit is the row of its votes
+                for i, worker in enumerate(order[r * args.workers_per_round:(r + 1) * args.workers_per_round]):
+                    workerVotes = [] if r == 0 else [int(v) for v in votes[r - 1, i]]
+                    await txs.transact(contract.functions.commit(taskId, part1, part2, workerVotes), {'from': worker})
+            lastRound = order[(args.rounds - 1) * args.workers_per_round:]
+            await asyncio.gather(*[txs.transact(contract.functions.computeLastRoundScore(taskId), {'from': worker}) for worker in lastRound])
+            for position, worker in enumerate(order):
+                r, i = divmod(position, args.workers_per_round)
+                receipt = await txs.transact(contract.functions.withdrawReward(taskId), {'from': worker})
+                before, after = await asyncio.gather(w3.eth.get_balance(worker, receipt['blockNumber'] - 1),
+                                                     w3.eth.get_balance(worker, receipt['blockNumber']))
+                reward = after - before + receipt['gasUsed'] * receipt['effectiveGasPrice']
+                if reward != int(expected[r, i]):
+                    mismatches += 1
+                    print(f"Task {taskId} round {r} position {i}: contract paid {reward}, simulated {int(expected[r, i])}")
+            print(f"Task {taskId}: {workers} rewards checked")
+    finally:
+        await txs.stop()
+        signer.shutdown()
+    print(f"{args.cases} tasks, {args.cases * workers} rewards, {mismatches} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized simulation of the task rewards')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--workers-per-round', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=100, help='Monte Carlo tasks per voting model')
+    parser.add_argument('--models', nargs='+', choices=['random', 'honest', 'adversarial'], default=['random', 'honest', 'adversarial'])
+    parser.add_argument('--fraction', type=float, default=0.2, help='colluding workers of the adversarial model')
+    parser.add_argument('--noise', type=float, default=50, help='standard deviation of the honest votes')
+    parser.add_argument('--funds', type=int, default=10**18)
+    parser.add_argument('--fee', type=int, default=10**15)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true', help='compare with the rewards paid by the contract on a local chain')
+    parser.add_argument('--cases', type=int, default=3, help='tasks run by --check')
+    parser.add_argument('--rpc', default=None)
+    parser.add_argument('--self-check', action='store_true', help='check the simulation on small cases with known rewards, offline')
+    args = parser.parse_args()
+    if args.self_check:
+        check_reverting_round()
+        raise SystemExit(0)
+    if args.rounds < 2 or args.workers_per_round < 2:
+        raise SystemExit("a task needs at least 2 rounds and 2 workers per round")
+    if args.check:
+        if args.rpc is None:
+            import chain
+            args.rpc = chain.RPC_URL
+        asyncio.run(check(args))
+    else:
+        sweep(args)
@@ -0,0 +1,122 @@
+import torch
+
+# Streaming aggregation of model weights: the state dicts of the previous round are folded one at a time,
+# as they are downloaded, into flat buffers allocated once. Memory stays at a constant number of model-sized
+# buffers (2 for the means, 2k+4 for a trimmed mean) whatever the number of workers of the round.
+
+
+class FlatLayout:
+    # Offsets of the floating point entries of a state dict in one flat vector
+    def __init__(self, template):
+        self.entries = []  # (name, shape, dtype, start, end)
+        self.numel = 0
+        self.extra = {}  # non floating point entries (e.g. counters), taken from the first model
+        for name, tensor in template.items():
+            if tensor.is_floating_point():
+                self.entries.append((name, tensor.shape, tensor.dtype, self.numel, self.numel + tensor.numel()))
+                self.numel += tensor.numel()
+
+    def flatten(self, state_dict, out):
+        # copy the state dict into out (a preallocated vector), no intermediate concatenation
+        for name, _, _, start, end in self.entries:
+            out[start:end].copy_(state_dict[name].reshape(-1))
+        return out
+
+    def unflatten(self, flat):
+        state_dict = {name: flat[start:end].view(shape).to(dtype) for name, shape, dtype, start, end in self.entries}
+        state_dict.update(self.extra)
+        return state_dict
+
+
+class RunningMean:
+    # mean_n = mean_{n-1} + w_n / W_n * (x_n - mean_{n-1}), updated in place (W_n: sum of the weights so far)
+    def __init__(self, template, weighted=False, dtype=torch.float32):
+        self.weighted = weighted  # the caller passes the weight of every model (its accuracy on the local test set)
+        self.layout = FlatLayout(template)
+        self.mean = torch.zeros(self.layout.numel, dtype=dtype)
+        self._flat = torch.empty(self.layout.numel, dtype=dtype)
+        self.total_weight = 0.0
+        self.count = 0
+
+    def add(self, state_dict, weight=1.0):
+        if weight <= 0:
+            return
+        if self.count == 0:
+            self.layout.extra = {name: tensor for name, tensor in state_dict.items() if not tensor.is_floating_point()}
+        self.layout.flatten(state_dict, self._flat)
+        self.total_weight += weight
+        self.count += 1
+        self._flat.sub_(self.mean)
+        self.mean.add_(self._flat, alpha=weight / self.total_weight)
+
+    def state_dict(self):
+        if self.count == 0:
+            raise ValueError("No model was aggregated")
+        return self.layout.unflatten(self.mean)
+
+
+class TrimmedMean:
+    # Exact coordinate-wise trimmed mean: the k largest and k smallest values of every coordinate are kept in
+    # (k, numel) buffers next to the running sum, and removed from the sum at the end
+    def __init__(self, template, trim=1, dtype=torch.float32):
+        self.weighted = False
+        self.layout = FlatLayout(template)
+        self.trim = trim
+        numel = self.layout.numel
+        self.sum = torch.zeros(numel, dtype=torch.float64)  # float64: the sum is not normalized until the end
+        self.top = torch.full((trim + 1, numel), -float('inf'), dtype=dtype)  # row trim is the scratch row
+        self.bottom = torch.full((trim + 1, numel), float('inf'), dtype=dtype)
+        self.count = 0
+
+    def add(self, state_dict, weight=1.0):
+        if self.count == 0:
+            self.layout.extra = {name: tensor for name, tensor in state_dict.items() if not tensor.is_floating_point()}
+        if self.trim == 0:
+            flat = self.layout.flatten(state_dict, self.top[0])
+            self.sum.add_(flat)
+            self.count += 1
+            return
+        flat = self.layout.flatten(state_dict, self.top[self.trim])
+        self.bottom[self.trim].copy_(flat)
+        self.sum.add_(flat)
+        self.count += 1
+        # sorted in place along the k+1 rows: the new value sinks to the scratch row if it is not among the extremes
+        self.top.copy_(self.top.sort(dim=0, descending=True).values)
+        self.bottom.copy_(self.bottom.sort(dim=0).values)
+
+    def state_dict(self):
+        if self.count <= 2 * self.trim:
+            raise ValueError(f"A trimmed mean of {self.count} models cannot drop {self.trim} values from each side")
+        if self.trim == 0:
+            mean = self.sum / self.count
+        else:
+            trimmed = self.top[:self.trim].sum(dim=0, dtype=torch.float64) + self.bottom[:self.trim].sum(dim=0, dtype=torch.float64)
+            mean = (self.sum - trimmed) / (self.count - 2 * self.trim)
+        return self.layout.unflatten(mean.to(self.top.dtype))
+
+
+AGGREGATIONS = ['best', 'mean', 'weighted', 'trimmed']
+
+def parse_aggregation(aggregation):
+    # 'best', 'mean', 'weighted' or 'trimmed[:k]' (k values dropped from each side, default 1), returns (name, k)
+    name, _, trim = aggregation.partition(':')
+    if name not in AGGREGATIONS or (trim and name != 'trimmed'):
+        raise ValueError(f"Unknown aggregation: {aggregation}")
+    try:
+        trim = int(trim) if trim else 1
+    except ValueError:
+        raise ValueError(f"Unknown aggregation: {aggregation}") from None
+    if trim < 0:
+        raise ValueError(f"Unknown aggregation: {aggregation}")
+    return name, trim
+
+def make_aggregator(aggregation, template, count):
+    # aggregation: 'mean', 'weighted' or 'trimmed[:k]', the trim is reduced when the round has too few models for it
+    name, trim = parse_aggregation(aggregation)
+    if name == 'mean':
+        return RunningMean(template)
+    if name == 'weighted':
+        return RunningMean(template, weighted=True)
+    if name == 'trimmed':
+        return TrimmedMean(template, min(trim, (count - 1) // 2))
+    raise ValueError(f"Unknown aggregation: {aggregation}")
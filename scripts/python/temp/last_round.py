@@ -1,5 +1,5 @@
 import random
-import numpy
+import numpy as np
 
 from web3 import Web3
 import json
@@ -22,7 +22,7 @@ bounty = 123456789000000
 
 local_rankings = [[random.randint(0,100) for _ in range(10)] for _ in range(10)]
 
-local_rankings = numpy.array(local_rankings) #this array exists only when the worker sends its votes to the smart contract
+local_rankings = np.array(local_rankings) #this array exists only when the worker sends its votes to the smart contract
 
 global_ranking = sum(rank for rank in local_rankings) #this is the ranking for the round
 
@@ -65,5 +65,5 @@ m_n = np.zeros(vector_size)
 n = 0
 for i in range(len(matrix)):
     n+=1
-    for j in range(len(matrix)):
+    for j in range(vector_size):
         m_n[j] += (matrix[i,j] - m_n[j])/n
\ No newline at end of file
@@ -1,18 +1,15 @@
+import os
+import sys
 from web3 import Web3
-import json
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chain
 
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
-data = json.load(f)
-abi = data['abi']
-f.close()
-
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-contract = w3.eth.contract(address=contract_address, abi=abi)
+w3 = chain.get_w3()
+contract = chain.get_contract(w3)
 
 address1 = Web3.to_checksum_address('0x70997970c51812dc3a010c7d01b50e0d17dc79c8')
-address2 = w3.eth.accounts[-10]
+address2 = chain.get_accounts(w3)[-10]
 
 balance = w3.eth.get_balance(address1)
 
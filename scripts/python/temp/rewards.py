@@ -27,11 +27,11 @@ topWorkersInRound = 3
 roundsNumber = 7
 
 
-r1 =(bounty * 10^18 * 10^18) /(coefficientsSum *
+r1 =(bounty * 10**18 * 10**18) /(coefficientsSum *
                 roundsNumber -
                 ((workersNumber *
                     (workersInRound - 2 * topWorkersInRound + 1) *
-                    10^18) /
+                    10**18) /
                     (workersInRound - 1) /
                     (workersInRound - topWorkersInRound + 1)))
 
@@ -1,40 +1,218 @@
-from web3 import Web3
+import os
 import json
 import time
-from threading import Timer
+import heapq
+import asyncio
+import argparse
+import chain
+from events import EventDispatcher
+from reads import BatchReader
+from transactions import TxSubmitter
+from metrics import metrics
 
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:8545'))
+# Funding deadlines: every deployed task gets a deadline (deployment block time + funding window), all the
+# deadlines live in one heap served by a single asyncio loop, whatever the number of tasks. When deadlines are
+# due, the state of their tasks is read in one batch and the stopFunding transactions are sent concurrently.
+# Pending deadlines are stored on disk, and the Deployed logs missed while the oracle was down are scanned at startup.
 
-# Get contract abi
-f = open('./artifacts/contracts/FedMLContract.sol/FedMLContract.json')
+STATE_PATH = os.environ.get('FEDML_TIME_ORACLE_STATE', 'state/time_oracle.json')
+DEFAULT_WINDOW = 20  # seconds of funding after the deployment
+RETRY_DELAY = 5
+MAX_RETRIES = 3
 
-data = json.load(f)
-abi = data['abi']
-f.close()
 
-contract_address = Web3.to_checksum_address('0x5fbdb2315678afecb367f032d93f642f64180aa3')
-contract = w3.eth.contract(address=contract_address, abi=abi)
+class DeadlineScheduler:
+    def __init__(self, w3, contract, account, dispatcher, reader, txs, window=DEFAULT_WINDOW, windows_path=None,
+                 state_path=STATE_PATH):
+        self.w3 = w3
+        self.contract = contract
+        self.account = account
+        self.dispatcher = dispatcher
+        self.reader = reader
+        self.txs = txs
+        self.window = window
+        self.windows_path = windows_path  # optional JSON {task id: window in seconds}, read again for every new task
+        self.state_path = state_path
+        self.deadlines = {}  # task id -> deadline (unix time)
+        self._heap = []  # (deadline, task id), entries no longer in self.deadlines are skipped
+        self._retries = {}
+        self._block_times = {}
+        self._deployed = dispatcher.subscribe('Deployed')
+        self._jobs = set()
+        self.jitter = []  # seconds between a deadline and the moment it was served
+        self.stats = {'scheduled': 0, 'stopped': 0, 'already_stopped': 0, 'not_admin': 0, 'retries': 0, 'failed': 0}
 
-deployed_event_filter = contract.events['Deployed'].create_filter(fromBlock='latest')
+    def schedule(self, taskId, deadline):
+        self.deadlines[taskId] = deadline
+        heapq.heappush(self._heap, (deadline, taskId))
 
-accounts = w3.eth.accounts
-#the oracle and the task admin addresses are the same
-my_address = accounts[len(accounts) - 1]
+    async def run(self):
+        self._load_state()
+        while True:
+            timeout = max(0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                events = [await asyncio.wait_for(self._deployed.get(), timeout)]
+            except asyncio.TimeoutError:
+                events = []
+            while not self._deployed.empty():
+                events.append(self._deployed.get_nowait())
+            if events:
+                await self._add(events)
+            await self._fire_due()
 
-params = {"from":my_address}
+    async def _add(self, events):
+        windows = self._load_windows()
+        # the deadline counts from the deployment block, so that tasks found while catching up keep their own
+        blocks = sorted({event['blockNumber'] for event in events if event['blockNumber'] not in self._block_times})
+        for block, timestamp in zip(blocks, await asyncio.gather(*[self._block_time(block) for block in blocks])):
+            self._block_times[block] = timestamp
+        for event in events:
+            taskId = event.args['taskId']
+            if taskId in self.deadlines:
+                continue
+            deadline = self._block_times[event['blockNumber']] + windows.get(str(taskId), self.window)
+            self.schedule(taskId, deadline)
+            self.stats['scheduled'] += 1
+            metrics.inc('deadlines_scheduled')
+            print(f"Task {taskId} deployed, funding stops in {deadline - time.time():.0f}s")
+        self._save_state()
 
-def stopFunding(taskId):
-    return contract.functions.stopFunding(taskId).transact(params)
+    async def _block_time(self, block):
+        return (await self.w3.eth.get_block(block))['timestamp']
+
+    async def _fire_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, taskId = heapq.heappop(self._heap)
+            if self.deadlines.get(taskId) == deadline:
+                due.append((taskId, deadline))
+        if not due:
+            return
+        try:
+            with metrics.span('read_tasks', oracle='time'):
+                tasks = await self.reader.call_many([('getTask', (taskId,), None) for taskId, _ in due])
+        except Exception as e:
+            print(f"Reading {len(due)} due tasks failed, retrying in {RETRY_DELAY}s ({e})")
+            for taskId, _ in due:
+                self.schedule(taskId, now + RETRY_DELAY)
+            return
+        served = time.time()
+        for (taskId, deadline), task in zip(due, tasks):
+            self.jitter.append(served - deadline)
+            metrics.observe('deadline_jitter_seconds', served - deadline)
+            if task[7]:  # the admin already stopped the funding
+                self.stats['already_stopped'] += 1
+                del self.deadlines[taskId]
+            elif task[5] != self.account:
+                # only the admin of a task can stop its funding
+                print(f"Task {taskId} belongs to {task[5]}, not stopping it")
+                self.stats['not_admin'] += 1
+                del self.deadlines[taskId]
+            else:
+                job = asyncio.create_task(self._stop(taskId, deadline))
+                self._jobs.add(job)
+                job.add_done_callback(self._jobs.discard)
+        self._save_state()
+
+    async def _stop(self, taskId, deadline):
+        try:
+            await self.txs.transact(self.contract.functions.stopFunding(taskId), {'from': self.account})
+        except Exception as e:
+            retries = self._retries.get(taskId, 0) + 1
+            if retries > MAX_RETRIES:
+                print(f"Task {taskId}: giving up stopFunding after {retries} attempts ({e})")
+                self.stats['failed'] += 1
+                self.deadlines.pop(taskId, None)
+            else:
+                # the state is read again before the next attempt
+                print(f"Task {taskId}: stopFunding failed, retrying in {RETRY_DELAY}s ({e})")
+                self._retries[taskId] = retries
+                self.stats['retries'] += 1
+                metrics.inc('deadline_retries')
+                self.schedule(taskId, time.time() + RETRY_DELAY)
+            self._save_state()
+            return
+        self.stats['stopped'] += 1
+        metrics.inc('funding_stopped')
+        metrics.record('deadline', 'funding_stopped', task=taskId, deadline=deadline)
+        self._retries.pop(taskId, None)
+        if self.deadlines.get(taskId) == deadline:
+            del self.deadlines[taskId]
+        self._save_state()
+        print(f"Task {taskId}: funding stopped")
+
+    def summary(self):
+        stats = dict(self.stats, pending=len(self.deadlines))
+        jitter = sorted(self.jitter)
+        if jitter:
+            stats['jitter_p50'] = jitter[len(jitter) // 2]
+            stats['jitter_p95'] = jitter[min(len(jitter) - 1, int(len(jitter) * 0.95))]
+            stats['jitter_max'] = jitter[-1]
+        return stats
+
+    def _load_windows(self):
+        if not self.windows_path or not os.path.exists(self.windows_path):
+            return {}
+        with open(self.windows_path) as f:
+            return json.load(f)
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as f:
+            stored = json.load(f).get(self.contract.address, {})
+        for taskId, deadline in stored.items():
+            self.schedule(int(taskId), deadline)
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+        state[self.contract.address] = {str(taskId): deadline for taskId, deadline in self.deadlines.items()}
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+
+async def main(window=DEFAULT_WINDOW, windows_path=None, from_block=0, poll_interval=1):
+    w3 = chain.get_async_w3()
+    contract = chain.get_async_contract(w3)
+    accounts = await chain.get_accounts_async(w3)
+    #the oracle and the task admin addresses are the same
+    my_address = accounts[len(accounts) - 1]
+
+    # without a stored cursor the Deployed logs are scanned from from_block, so that no deadline is missed
+    dispatcher = await EventDispatcher(w3, contract, name='time_oracle', poll_interval=poll_interval, from_block=from_block).start()
+    reader = BatchReader(contract, dispatcher=dispatcher)
+    txs = TxSubmitter(w3, dispatcher)
+    scheduler = DeadlineScheduler(w3, contract, my_address, dispatcher, reader, txs, window, windows_path)
+    print('Timer is ready...\n')
+    try:
+        await scheduler.run()
+    finally:
+        await txs.stop()
+        await dispatcher.stop()
+        await reader.close()
+        print(f"Timer: {scheduler.summary()}")
+        metrics.close()
 
-print('Timer is ready...\n')
-try:
-    while True:
-        for event in deployed_event_filter.get_new_entries():
-            taskId = event.args['taskId']
-            print(f"Task {taskId} deployed, timer started!")
-            t = Timer(20, stopFunding, [taskId])
-            t.start()
 
-            
-except KeyboardInterrupt:
-    print('Exiting oracle...')
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stops the funding of the tasks when their funding window ends')
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW, help='funding window of a task, in seconds')
+    parser.add_argument('--windows', default=None, help='JSON file of per-task windows: {"<task id>": seconds}')
+    parser.add_argument('--from-block', type=int, default=0, help='first block scanned for deployments when there is no stored cursor')
+    parser.add_argument('--poll-interval', type=float, default=1)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args)
+    try:
+        asyncio.run(main(args.window, args.windows, args.from_block, args.poll_interval))
+    except KeyboardInterrupt:
+        print('Exiting oracle...')
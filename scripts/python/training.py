@@ -0,0 +1,321 @@
+import os
+import json
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import torch.multiprocessing
+import ml_utils
+import running_mean
+import model_codec
+from metrics import metrics
+import ipfshttpclient
+
+# Local training of a worker for one round, and the backends that run it.
+# The training function only depends on its arguments, so it can run in the event loop's thread pool
+# or in a separate process that receives nothing but the round number, the address and the CIDs (and, when the
+# previous models were scored ahead, the most accurate one, which a pool process may not have in its caches).
+
+def train_round(roundNumber, address, previousRoundHashes, traindata, testset, device, ipfsclient, lastRound=False,
+                aggregation='best', encoding='fp32', speedups='', scores=None, scoring='exhaustive', best_scored=None):
+    # aggregation: 'best' starts from the best model of the previous round, the others from an aggregate of them all
+    # encoding: wire format of the uploaded model (model_codec), the delta encodings need a downloaded starting model
+    # speedups: optional fast paths of the training and scoring loops (ml_utils.SPEEDUPS)
+    # scores: accuracies already computed for some of the previous models (pipelined mode), {CID: accuracy}
+    # scoring: exhaustive (every model on the whole test set) or adaptive[:delta] (ml_utils.evaluateModelsAdaptive)
+    # best_scored: (CID, state dict) of the most accurate of those models (pipelined mode)
+    labels = {'worker': address[:10], 'round': roundNumber}
+    with metrics.profile(f'worker{address[:10]}', roundNumber), metrics.span('train_round', **labels):
+        return _train_round(roundNumber, address, previousRoundHashes, traindata, testset, device, ipfsclient, lastRound,
+                            aggregation, encoding, ml_utils.parseSpeedups(speedups), scores or {}, ml_utils.parseScoring(scoring),
+                            best_scored, labels)
+
+
+def _train_round(roundNumber, address, previousRoundHashes, traindata, testset, device, ipfsclient, lastRound,
+                 aggregation, encoding, speedups, scores, scoring, best_scored, labels):
+    votes = [0 for _ in previousRoundHashes]
+    best_candidate = None
+    parent = None
+    if roundNumber == 0:
+        model = ml_utils.cnn().to(device)
+    elif aggregation != 'best' and not lastRound:
+        model = ml_utils.cnn().to(device)
+        votes, best_candidate, state_dict = aggregate_round(model, previousRoundHashes, testset, ipfsclient, aggregation,
+                                                            'inference' in speedups, labels, scores)
+        print(f"{address[:10]} {aggregation} of the {len(previousRoundHashes)} models of round {roundNumber - 1}, "
+              f"best: {best_candidate[0]} ({best_candidate[1]:.2f}%)")
+        model.load_state_dict(state_dict)
+    else:
+        #receive models' CIDs from the SC
+        #download models from IPFS
+        model = ml_utils.cnn().to(device)
+        #evaluate the models not scored yet in a single pass and select the best one
+        missing = [hash for hash in previousRoundHashes if hash not in scores]
+        state_dicts = {}
+        if missing:
+            with metrics.span('download', **labels):
+                state_dicts = {hash: ml_utils.loadModelFromIPFS(ipfsclient, hash) for hash in missing}
+            with metrics.span('evaluate', **labels):
+                accuracies = evaluate(model, list(state_dicts.values()), testset, 'inference' in speedups, scoring,
+                                      int(address[2:10], 16) ^ roundNumber, labels)
+            scores = {**scores, **dict(zip(missing, accuracies.tolist()))}
+        accuracies = [scores[hash] for hash in previousRoundHashes]
+        votes = [int(accuracy * 10) for accuracy in accuracies]
+
+        best_index = max(range(len(accuracies)), key=accuracies.__getitem__)
+        best_accuracy = accuracies[best_index]
+        best_candidate = (previousRoundHashes[best_index], best_accuracy)
+        print(f"{address[:10]} best model of round {roundNumber - 1}: {previousRoundHashes[best_index]} ({best_accuracy:.2f}%)")
+        if lastRound: #worker of the last round
+            return None, votes, best_candidate
+
+        best_state_dict = state_dicts.get(best_candidate[0])
+        if best_state_dict is None and best_scored is not None and best_scored[0] == best_candidate[0]:
+            # scored ahead of the round: its state dict came back with the scores (the score job may have run in
+            # another pool process, whose caches this one does not share)
+            best_state_dict = best_scored[1]
+        if best_state_dict is None:
+            best_state_dict = ml_utils.loadModelFromIPFS(ipfsclient, best_candidate[0])
+        model.load_state_dict(best_state_dict)
+        parent = (previousRoundHashes[best_index], best_state_dict)
+
+    weightsPath = f'rounds/round{roundNumber}/cnn{address[:10]}.params'
+    accuracyPath = f'rounds/round{roundNumber}/accuracy{address[:10]}.json'
+
+    with metrics.span('train', **labels):
+        accuracy = train_epochs(model, traindata, device, speedups)
+
+    if not os.path.exists(f'rounds/round{roundNumber}'):
+        os.makedirs(f'rounds/round{roundNumber}', exist_ok=True)
+
+    # Save accuracy to a JSON file
+    with open(accuracyPath, 'w') as f:
+        json.dump(accuracy, f)
+
+    base, delta = model_codec.parse_encoding(encoding)
+    if delta and parent is None:
+        encoding = base  # nothing to take the difference from (first round or aggregated starting model)
+    with metrics.span('upload', **labels):
+        hashFile, blob = ml_utils.saveModelToIPFS(ipfsclient, model.state_dict(), encoding, parent)
+    metrics.inc('uploaded_bytes', len(blob), **labels)
+    # local copy of what was uploaded
+    with open(weightsPath, 'wb') as f:
+        f.write(blob)
+    return hashFile, votes, best_candidate
+
+
+def train_epochs(model, traindata, device, speedups=frozenset()):
+    # Local training, returns the training accuracy of every epoch
+    torch = ml_utils.torch
+    channels_last = 'channels_last' in speedups
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    # the compiled module shares its parameters with model, whose state dict keeps the usual keys
+    forward = torch.compile(model) if 'compile' in speedups else model
+    device_type = torch.device(device or 'cpu').type
+    autocast = 'bf16' in speedups and ml_utils.bf16Supported(device)
+
+    # Define loss function and optimizer (assuming you want to do this as well)
+    criterion = ml_utils.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr = ml_utils.LEARNING_RATE)
+
+    model.train()
+    accuracy = []
+    for epoch in range(ml_utils.EPOCHS):  # number of epochs
+        correct = torch.zeros((), dtype=torch.long, device=device) if 'metrics' in speedups else 0
+        total = 0
+        for data, target in traindata:
+            data, target = data.to(device), target.to(device)
+            if channels_last:
+                data = data.contiguous(memory_format=torch.channels_last)
+            optimizer.zero_grad()
+            with torch.autocast(device_type, dtype=torch.bfloat16, enabled=autocast):
+                output = forward(data)
+                loss = criterion(output, target)
+            loss.backward()
+            optimizer.step()
+
+            total += target.size(0)
+            if 'metrics' in speedups:
+                correct += (output.detach().argmax(dim=1) == target).sum()  # no host synchronization per batch
+            else:
+                _, predicted = torch.max(output.data, 1)
+                correct += (predicted == target).sum().item()
+
+        epoch_accuracy = 100 * int(correct) / total
+        accuracy.append(epoch_accuracy)
+    if channels_last:
+        model.to(memory_format=torch.contiguous_format)  # the uploaded state dict keeps the usual layout
+    return accuracy
+
+
+def evaluate(model, state_dicts, testset, inferenceMode, scoring, seed, labels):
+    # the votes keep one accuracy per model either way, adaptive scoring only measures the clearly worse ones on fewer samples
+    mode, delta = scoring
+    budget = len(state_dicts) * testset[1].size(0)
+    if mode == 'adaptive' and len(state_dicts) > 1:
+        accuracies, evaluations = ml_utils.evaluateModelsAdaptive(model, state_dicts, *testset, inferenceMode=inferenceMode,
+                                                                  delta=delta, seed=seed)
+    else:
+        accuracies, evaluations = ml_utils.evaluateModels(model, state_dicts, *testset, inferenceMode=inferenceMode), budget
+    metrics.inc('evaluated_samples', evaluations, **labels)
+    metrics.inc('evaluation_budget', budget, **labels)
+    return accuracies
+
+
+def aggregate_round(model, previousRoundHashes, testset, ipfsclient, aggregation, inferenceMode=False, labels=None, scores=None):
+    # Models are downloaded, scored and folded into the aggregate one at a time, only one is held in memory
+    labels = labels or {}
+    scores = scores or {}
+    aggregator = None
+    votes = []
+    best_candidate = None
+    for hash in previousRoundHashes:
+        with metrics.span('download', **labels):
+            state_dict = ml_utils.loadModelFromIPFS(ipfsclient, hash)
+        accuracy = scores.get(hash)
+        if accuracy is None:
+            with metrics.span('evaluate', **labels):
+                accuracy = ml_utils.evaluateModels(model, [state_dict], *testset, inferenceMode=inferenceMode)[0].item()
+        votes.append(int(accuracy * 10))
+        if best_candidate is None or accuracy > best_candidate[1]:
+            best_candidate = (hash, accuracy)
+        if aggregator is None:
+            aggregator = running_mean.make_aggregator(aggregation, state_dict, len(previousRoundHashes))
+        with metrics.span('aggregate', **labels):
+            aggregator.add(state_dict, accuracy if aggregator.weighted else 1.0)
+    return votes, best_candidate, aggregator.state_dict()
+
+
+def score_models(hashes, testset, device, ipfsclient, inferenceMode=False, labels=None):
+    # Accuracy of the given models on the local test set, computed while their round is still open (pipelined mode),
+    # and (CID, state dict) of the most accurate one, the starting model of the round if none of the others beats it
+    labels = labels or {}
+    model = ml_utils.cnn().to(device)
+    with metrics.span('prefetch_download', **labels):
+        state_dicts = [ml_utils.loadModelFromIPFS(ipfsclient, hash) for hash in hashes]
+    with metrics.span('prefetch_evaluate', **labels):
+        accuracies = ml_utils.evaluateModels(model, state_dicts, *testset, inferenceMode=inferenceMode).tolist()
+    best = max(range(len(hashes)), key=accuracies.__getitem__)
+    return accuracies, (hashes[best], state_dicts[best])
+
+
+class InProcessBackend:
+    # Current behaviour: every worker trains inside the coordinator process, on the event loop's executor
+    def __init__(self, device, ipfsclient, executor=None):  # executor None -> asyncio default ThreadPoolExecutor
+        self.device = device
+        self.ipfsclient = ipfsclient
+        self.executor = executor
+
+    async def train(self, worker, previousRoundHashes, lastRound=False):
+        loop = asyncio.get_running_loop()
+        job = functools.partial(worker.train, previousRoundHashes, self.device, self.ipfsclient, lastRound)
+        return await loop.run_in_executor(self.executor, job)
+
+    async def score(self, worker, hashes):
+        loop = asyncio.get_running_loop()
+        job = functools.partial(worker.score, hashes, self.device, self.ipfsclient)
+        return await loop.run_in_executor(self.executor, job)
+
+    def shutdown(self):
+        pass
+
+
+# State of a pool process, set once by _init_process
+_shared = None
+_shards = {}
+
+def _init_process(data, targets, tensorBacked, shards, batch_size, batch_size_test, threads, ipfs_factory):
+    global _shared
+    # one pool process per core: a single intra-op thread each avoids oversubscribing the CPU
+    ml_utils.torch.set_num_threads(threads)
+    _shared = {
+        'data': data,  # shared memory, read-only
+        'targets': targets,
+        'tensorBacked': tensorBacked,
+        'shards': shards,
+        'batch_size': batch_size,
+        'batch_size_test': batch_size_test,
+        'device': ml_utils.getDevice(),
+        'ipfsclient': ipfs_factory(),
+    }
+
+def _get_shard(shard):
+    # Loaders are built lazily per shard, on top of the shared tensors (no copy of the images)
+    if shard not in _shards:
+        train_idx, test_idx = _shared['shards'][shard]
+        if _shared['tensorBacked']:
+            traindata = ml_utils.tensorBatches(_shared['data'], _shared['targets'], train_idx, _shared['batch_size'], shuffle=True)
+            testdata = ml_utils.tensorBatches(_shared['data'], _shared['targets'], test_idx, _shared['batch_size_test'])
+            _shards[shard] = (traindata, ml_utils.collateDataLoader(testdata))
+            return _shards[shard]
+        trainset = ml_utils.tensorMNIST(_shared['data'], _shared['targets'], train_idx)
+        testset = ml_utils.tensorMNIST(_shared['data'], _shared['targets'], test_idx)
+        traindata = ml_utils.DataLoader(trainset, batch_size=_shared['batch_size'], shuffle=True)
+        testdata = ml_utils.DataLoader(testset, batch_size=_shared['batch_size_test'], shuffle=False)
+        _shards[shard] = (traindata, ml_utils.collateDataLoader(testdata))
+    return _shards[shard]
+
+# The jobs return their result and the metrics recorded in the pool process since its last job (metrics.drain)
+
+def _train_job(shard, roundNumber, address, previousRoundHashes, lastRound, aggregation, encoding, speedups, scores, scoring, best_scored):
+    traindata, testset = _get_shard(shard)
+    result = train_round(roundNumber, address, previousRoundHashes, traindata, testset,
+                         _shared['device'], _shared['ipfsclient'], lastRound, aggregation, encoding, speedups, scores, scoring, best_scored)
+    return result, metrics.drain()
+
+def _score_job(shard, address, hashes, speedups):
+    _, testset = _get_shard(shard)
+    result = score_models(hashes, testset, _shared['device'], _shared['ipfsclient'],
+                          'inference' in ml_utils.parseSpeedups(speedups), {'worker': address[:10]})
+    return result, metrics.drain()
+
+
+class ProcessPoolBackend:
+    # Every worker trains in a pool of processes, only the CID, the votes, the best candidate and the metrics come back
+    def __init__(self, datasets, processes=None, threads_per_process=None, ipfs_factory=ipfshttpclient.connect):
+        processes = processes or os.cpu_count()
+        threads_per_process = threads_per_process or max(1, os.cpu_count() // processes)
+
+        # every shard indexes the same MNIST tensors, share them once instead of pickling one copy per worker
+        tensorBacked = isinstance(datasets[0][0], ml_utils.tensorBatches)
+        if tensorBacked:
+            # the memory-mapped arrays cannot be moved to shared memory in place, copy them there once
+            data, targets = datasets[0][0].data.clone(), datasets[0][0].targets.clone()
+            shards = [(train.indices, test.indices) for train, test in datasets]
+        else:
+            data, targets = datasets[0][0].dataset.dataset.data, datasets[0][0].dataset.dataset.targets
+            shards = [(ml_utils.torch.tensor(train.dataset.indices), ml_utils.torch.tensor(test.dataset.indices))
+                      for train, test in datasets]
+        data, targets = data.share_memory_(), targets.share_memory_()
+
+        context = torch.multiprocessing.get_context('spawn')
+        self.pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=context, initializer=_init_process,
+            initargs=(data, targets, tensorBacked, shards, datasets[0][0].batch_size, datasets[0][1].batch_size,
+                      threads_per_process, ipfs_factory))
+
+    async def train(self, worker, previousRoundHashes, lastRound=False):
+        loop = asyncio.get_running_loop()
+        job = functools.partial(_train_job, worker.shard, worker.round, worker.address, previousRoundHashes, lastRound,
+                                worker.aggregation, worker.encoding, worker.speedups, worker.scores, worker.scoring, worker.best_scored)
+        (hashFile, votes, worker.best_candidate), delta = await loop.run_in_executor(self.pool, job)
+        metrics.merge(delta)
+        return hashFile, votes
+
+    async def score(self, worker, hashes):
+        loop = asyncio.get_running_loop()
+        job = functools.partial(_score_job, worker.shard, worker.address, hashes, worker.speedups)
+        result, delta = await loop.run_in_executor(self.pool, job)
+        metrics.merge(delta)
+        return result
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def make_backend(name, datasets, device, ipfsclient, processes=None, threads_per_process=None, ipfs_factory=ipfshttpclient.connect):
+    if name == 'thread':
+        return InProcessBackend(device, ipfsclient)
+    if name == 'process':
+        return ProcessPoolBackend(datasets, processes, threads_per_process, ipfs_factory)
+    raise ValueError(f"Unknown training backend: {name}")
@@ -0,0 +1,207 @@
+import time
+import asyncio
+from collections import OrderedDict
+import chain
+from metrics import metrics
+
+# Transaction pipeline: nonces are tracked locally per account, transactions are sent without waiting for them
+# to be mined, and a single block-driven watcher confirms all the pending receipts.
+# With a signer (keys.Signer), the transactions of its local accounts are signed here and sent raw.
+
+RECENT_TX_LIMIT = 10000
+
+
+class TxSubmitter:
+    def __init__(self, w3, dispatcher=None, poll_interval=0.5, signer=None):
+        self.w3 = w3
+        self.dispatcher = dispatcher  # when given, its block notifications drive the watcher
+        self.poll_interval = poll_interval
+        self.signer = signer
+        self._gas_price = None  # (block, future of eth_gasPrice read at that block)
+        self._chain_id = None
+        self._nonces = {}
+        self._locks = {}
+        self._pending = {}  # tx hash -> (future, label, submit time)
+        self._recent = OrderedDict()  # tx hash -> block number, for hashes mined before they were registered
+        self._scanned = None
+        self._watcher = None
+        self.records = []  # (label, latency, gas used, status)
+        self.stats = {'submitted': 0, 'confirmed': 0, 'reverted': 0, 'gas_used': 0}
+        self._first_submit = None
+        self._last_confirm = None
+
+    async def submit(self, fn, tx, label=None, on_sent=None):
+        # Send a contract call (or a plain transfer when fn is None) and return a future resolved with its receipt
+        # on_sent: called with the hash once the node accepted the transaction, before it is mined
+        await self._ensure_watcher()
+        address = tx['from']
+        label = label or (fn.fn_name if fn is not None else 'transfer')
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        # sends of the same account are serialized so that the node receives the nonces in order
+        async with lock:
+            if address not in self._nonces:
+                self._nonces[address] = await self.w3.eth.get_transaction_count(address, 'pending')
+            params = dict(tx, nonce=self._nonces[address])
+            start = time.perf_counter()
+            if self._first_submit is None:
+                self._first_submit = start
+            try:
+                if self.signer is not None and address in self.signer:
+                    tx_hash = await self._send_raw(fn, params)
+                elif fn is None:
+                    tx_hash = await self.w3.eth.send_transaction(params)
+                else:
+                    tx_hash = await fn.transact(params)
+            except Exception:
+                # rejected by the node (e.g. reverted while estimating gas, or underpriced): the nonce was not used,
+                # resync it, and the gas price too
+                del self._nonces[address]
+                self._gas_price = None
+                self.stats['reverted'] += 1
+                metrics.inc('tx_rejected', label=label)
+                self.records.append((label, time.perf_counter() - start, 0, 0))
+                raise
+            self._nonces[address] += 1
+        self.stats['submitted'] += 1
+        if on_sent is not None:
+            on_sent(bytes(tx_hash))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[bytes(tx_hash)] = (future, label, start)
+        if bytes(tx_hash) in self._recent:
+            await self._confirm([bytes(tx_hash)])
+        return future
+
+    async def transact(self, fn, tx, label=None):
+        # submit and wait for the receipt, raising if the transaction reverted
+        receipt = await (await self.submit(fn, tx, label))
+        if receipt['status'] != 1:
+            raise RuntimeError(f"Transaction {receipt['transactionHash'].hex()} ({label or getattr(fn, 'fn_name', 'transfer')}) reverted")
+        return receipt
+
+    async def drain(self):
+        # wait for every pending transaction
+        futures = [future for future, _, _ in self._pending.values()]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+    def summary(self):
+        latencies = sorted(latency for _, latency, _, status in self.records if status == 1)
+        stats = dict(self.stats)
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            stats['latency_max'] = latencies[-1]
+        by_label = {}
+        for label, latency, gas_used, status in self.records:
+            entry = by_label.setdefault(label, {'count': 0, 'reverted': 0, 'gas_used': 0, 'latency_sum': 0})
+            entry['count'] += 1
+            entry['reverted'] += status != 1
+            entry['gas_used'] += gas_used
+            entry['latency_sum'] += latency
+        stats['by_label'] = {label: {'count': e['count'], 'reverted': e['reverted'], 'gas_used': e['gas_used'],
+                                     'mean_latency': e['latency_sum'] / e['count']} for label, e in by_label.items()}
+        if self._first_submit is not None and self._last_confirm is not None and self._last_confirm > self._first_submit:
+            stats['tx_per_s'] = stats['confirmed'] / (self._last_confirm - self._first_submit)
+        return stats
+
+    async def _send_raw(self, fn, params):
+        # the chain id is read once, the gas price at every block, the gas of a contract call is estimated (a
+        # reverting call is rejected before signing, as with transact)
+        if self._chain_id is None:
+            self._chain_id = await chain.get_chain_id_async(self.w3)
+        params = dict(params, chainId=self._chain_id)
+        if 'gasPrice' not in params:
+            params['gasPrice'] = await self._current_gas_price()
+        if fn is not None:
+            params = await fn.build_transaction(params)
+        else:
+            params.setdefault('gas', 21000)
+        raw = await self.signer.sign(params)
+        return await self.w3.eth.send_raw_transaction(raw)
+
+    async def _current_gas_price(self):
+        # one eth_gasPrice per block seen by the watcher, shared by the concurrent sends of that block
+        block = self._scanned
+        if self._gas_price is None or self._gas_price[0] != block:
+            self._gas_price = (block, asyncio.ensure_future(self.w3.eth.gas_price))
+        entry = self._gas_price
+        try:
+            return await asyncio.shield(entry[1])
+        except Exception:
+            if self._gas_price is entry:
+                self._gas_price = None  # read again by the next send
+            raise
+
+    async def _ensure_watcher(self):
+        if self._watcher is None:
+            self._scanned = await self.w3.eth.block_number
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        blocks = self.dispatcher.subscribe_blocks() if self.dispatcher else None
+        try:
+            while True:
+                if blocks is not None:
+                    latest = await blocks.get()
+                else:
+                    await asyncio.sleep(self.poll_interval)
+                    latest = await self.w3.eth.block_number
+                # a failed scan is retried on the same blocks, even when no new block comes
+                while True:
+                    try:
+                        await self._scan(latest)
+                        break
+                    except Exception as e:
+                        print(f"Transaction watcher error (retrying): {e}")
+                        await asyncio.sleep(self.poll_interval)
+        finally:
+            if blocks is not None:
+                self.dispatcher.unsubscribe(blocks)
+
+    async def _scan(self, latest):
+        while self._scanned < latest:
+            number = self._scanned + 1
+            block = await self.w3.eth.get_block(number)
+            mined = []
+            for tx_hash in block['transactions']:
+                tx_hash = bytes(tx_hash)
+                self._recent[tx_hash] = number
+                if tx_hash in self._pending:
+                    mined.append(tx_hash)
+            while len(self._recent) > RECENT_TX_LIMIT:
+                self._recent.popitem(last=False)
+            if mined:
+                await self._confirm(mined)
+            # only once its receipts are confirmed: a failure scans the block again
+            self._scanned = number
+
+    async def _confirm(self, tx_hashes):
+        # one concurrent batch of receipt requests for all the transactions mined in the block
+        receipts = await asyncio.gather(*[self.w3.eth.get_transaction_receipt(h) for h in tx_hashes])
+        now = time.perf_counter()
+        self._last_confirm = now
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            entry = self._pending.pop(tx_hash, None)
+            if entry is None:
+                continue
+            future, label, start = entry
+            self.stats['confirmed'] += 1
+            self.stats['gas_used'] += receipt['gasUsed']
+            if receipt['status'] != 1:
+                self.stats['reverted'] += 1
+            self.records.append((label, now - start, receipt['gasUsed'], receipt['status']))
+            metrics.observe('tx_confirm_seconds', now - start, label=label)
+            metrics.inc('tx_gas', receipt['gasUsed'], label=label)
+            if receipt['status'] != 1:
+                metrics.inc('tx_reverted', label=label)
+            if not future.done():
+                future.set_result(receipt)
@@ -1,4 +1,6 @@
 import base64
+import base58
+import numpy as np
 
 def encode_CID_to_2_bytes_32(CID):
     #encode to bytes
@@ -14,3 +16,94 @@ def encode_CID_to_2_bytes_32(CID):
 def decode_2_bytes_32_to_CID(part1, part2):
 
     return base64.b64decode(part1+part2).decode()
+
+
+# Compact commit payload: the binary CID instead of the base64 of its text, and the votes as big-endian uint16.
+#   CIDv0 (Qm...):          part1 = sha2-256 digest, part2 = 0
+#   CIDv1 (b..., sha2-256): part1 = digest, part2 = version | codec | 0x12 0x20, zero padded
+# The legacy base64 form never has a zero byte, so decode_CID tells the two apart and reads both: a compact part2
+# is zero after its first 4 bytes, so only the CIDv1 whose prefix fits there (one byte codecs) are written compact.
+SHA2_256 = b'\x12\x20'
+COMPACT_PREFIX = 4
+VOTE_MAX = 2**16 - 1
+
+
+def encode_CID(CID):
+    if CID.startswith('Qm') and len(CID) == 46:
+        multihash = base58.b58decode(CID)
+        return [multihash[2:], bytes(32)]
+    if CID.startswith('b'):
+        padded = CID[1:].upper() + '=' * (-len(CID[1:]) % 8)
+        binary = base64.b32decode(padded)
+        prefix, digest = binary[:-32], binary[-32:]
+        if prefix.endswith(SHA2_256) and len(prefix) <= COMPACT_PREFIX:
+            parts = [digest, prefix.ljust(32, b'\0')]
+            if _compact_to_CID(*parts) == CID:  # e.g. not a non-canonical base32 spelling
+                return parts
+    # other CIDs keep the legacy encoding
+    return encode_CID_to_2_bytes_32(CID)
+
+
+def is_compact(part2):
+    return bytes(part2[COMPACT_PREFIX:]) == bytes(32 - COMPACT_PREFIX)
+
+
+def decode_CID(part1, part2):
+    part1, part2 = bytes(part1), bytes(part2)
+    if not is_compact(part2):
+        return decode_2_bytes_32_to_CID(part1, part2)
+    return _compact_to_CID(part1, part2)
+
+
+def _compact_to_CID(part1, part2):
+    if part2 == bytes(32):
+        return base58.b58encode(SHA2_256 + part1).decode()
+    prefix = part2.rstrip(b'\0')
+    return 'b' + base64.b32encode(prefix + part1).decode().lower().rstrip('=')
+
+
+def pack_votes(votes):
+    votes = np.asarray(votes, dtype=np.int64)
+    if votes.size and (votes.min() < 0 or votes.max() > VOTE_MAX):
+        raise ValueError(f"Votes must be between 0 and {VOTE_MAX}")
+    return votes.astype('>u2').tobytes()
+
+
+def unpack_votes(packed):
+    return np.frombuffer(packed, dtype='>u2').astype(np.int64)
+
+
+def decode_round_work(commits):
+    # Whole getRoundWork result -> (CIDs, votes matrix): the compact rows are found with one vectorized test,
+    # the votes of all the commits become one array (rows of -1 for the commits without votes, e.g. round 0)
+    if not commits:
+        return [], np.zeros((0, 0), dtype=np.int64)
+    parts2 = np.frombuffer(b''.join(bytes(commit[2]) for commit in commits), dtype=np.uint8).reshape(len(commits), 32)
+    compact = ~parts2[:, COMPACT_PREFIX:].any(axis=1)
+    cids = [_compact_to_CID(bytes(commit[1]), bytes(commit[2])) if row_compact else decode_2_bytes_32_to_CID(commit[1], commit[2])
+            for commit, row_compact in zip(commits, compact)]
+    width = max(len(commit[3]) for commit in commits)
+    votes = np.full((len(commits), width), -1, dtype=np.int64)
+    for i, commit in enumerate(commits):
+        votes[i, :len(commit[3])] = commit[3]
+    return cids, votes
+
+
+def check_round_trip():
+    # every CID form must come back unchanged from both encodings
+    digest = bytes(range(32))
+    cids = [base58.b58encode(SHA2_256 + digest).decode()]  # CIDv0
+    for codec in [b'\x55', b'\x70', b'\xa9\x02']:  # raw, dag-pb, dag-json (two byte varint, legacy form)
+        cids.append('b' + base64.b32encode(b'\x01' + codec + SHA2_256 + digest).decode().lower().rstrip('='))
+    for CID in cids:
+        parts = encode_CID(CID)
+        assert decode_CID(*parts) == CID, CID
+        if max(len(part) for part in parts) <= 32:  # what a bytes32 can hold, the legacy form of a CIDv1 does not fit
+            onchain = [bytes(part).ljust(32, b'\0') for part in parts]
+            assert decode_round_work([('0x0', *onchain, [])])[0] == [CID], CID
+        assert decode_CID(*encode_CID_to_2_bytes_32(CID)) == CID, CID
+    print(f"{len(cids)} CIDs round-tripped")
+
+
+if __name__ == '__main__':
+    check_round_trip()
@@ -101,7 +101,48 @@ export const encodeCIDto2Bytes32 = (ipfsCID) => {
   return [part1, part2];
 }
 
+const BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz';
+const BASE32 = 'abcdefghijklmnopqrstuvwxyz234567';
+
+const toBase58 = (bytes) => {
+  let n = BigInt('0x' + Buffer.from(bytes).toString('hex'));
+  let out = '';
+  while (n > 0n) {
+    out = BASE58[Number(n % 58n)] + out;
+    n /= 58n;
+  }
+  for (let i = 0; i < bytes.length && bytes[i] === 0; i++) out = '1' + out;
+  return out;
+}
+
+const toBase32 = (bytes) => {
+  let bits = 0, value = 0, out = '';
+  for (const byte of bytes) {
+    value = (value << 8) | byte;
+    bits += 8;
+    while (bits >= 5) {
+      out += BASE32[(value >>> (bits - 5)) & 31];
+      bits -= 5;
+    }
+  }
+  if (bits > 0) out += BASE32[(value << (5 - bits)) & 31];
+  return out;
+}
+
+//compact form written by the Python workers (utils.encode_CID): part1 is the sha2-256 digest, part2 the CIDv1 prefix
+//(zero for a CIDv0, at most 4 bytes otherwise), zero padded. The base64 form never contains a zero byte.
+const decodeCompactCID = (part1, part2) => {
+  const digest = Buffer.from(Web3.utils.hexToBytes(part1));
+  const prefix = Buffer.from(Web3.utils.hexToBytes(part2));
+  if (prefix.subarray(4).some((byte) => byte !== 0) || digest.every((byte) => byte === 0)) return null;
+  const end = prefix.findLastIndex((byte) => byte !== 0) + 1;
+  if (end === 0) return toBase58(Buffer.concat([Buffer.from([0x12, 0x20]), digest]));
+  return 'b' + toBase32(Buffer.concat([prefix.subarray(0, end), digest]));
+}
+
 export const decode2Bytes32toCID = (part1, part2) => {
+  const compact = decodeCompactCID(part1, part2);
+  if (compact) return compact;
   //convert to base64
   const base64str = Web3.utils.hexToAscii(part1) + Web3.utils.hexToAscii(part2);
   //convert to ascii (CID)